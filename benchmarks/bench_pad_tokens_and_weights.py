@@ -0,0 +1,54 @@
+"""
+pad_tokens_and_weights against the list based implementation, 3-chunk prompts at batch sizes 1 to 16.
+
+python benchmarks/bench_pad_tokens_and_weights.py
+"""
+import copy
+import random
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'tests'))
+
+import numpy as np
+
+import lpw_reference
+from diffusers_mastodon_bot.community_pipeline import lpw_stable_diffusion as lpw
+
+
+def main():
+    rng = random.Random(0)
+    chunk_length = 77
+    max_length = (chunk_length - 2) * 3 + 2
+
+    print(f'{"batch":>5} {"no_boseos_middle":>16} {"before us":>10} {"after us":>10} {"speedup":>8}')
+    for no_boseos_middle in [False, True]:
+        for batch_size in [1, 2, 4, 8, 16]:
+            # every prompt spans all 3 chunks
+            tokens = [[rng.randrange(2, 1000) for _ in range(max_length - 2 - rng.randrange(10))]
+                      for _ in range(batch_size)]
+            weights = [[rng.choice([1.0, 1.1, 0.5]) for _ in token] for token in tokens]
+
+            def before():
+                # the reference pads in place, and callers made arrays of the lists afterwards
+                padded_tokens, padded_weights = lpw_reference.pad_tokens_and_weights(
+                    [list(token) for token in tokens], [list(weight) for weight in weights],
+                    max_length, 0, 1, no_boseos_middle=no_boseos_middle, chunk_length=chunk_length
+                )
+                return np.array(padded_tokens, dtype=np.int64), np.array(padded_weights, dtype=np.float64)
+
+            def after():
+                return lpw.pad_tokens_and_weights(
+                    tokens, weights, max_length, 0, 1, no_boseos_middle=no_boseos_middle, chunk_length=chunk_length
+                )
+
+            before_sec = min(timeit.repeat(before, number=500, repeat=7)) / 500
+            after_sec = min(timeit.repeat(after, number=500, repeat=7)) / 500
+            print(f'{batch_size:>5} {str(no_boseos_middle):>16} {before_sec * 1e6:>10.1f} {after_sec * 1e6:>10.1f} '
+                  f'{before_sec / after_sec:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
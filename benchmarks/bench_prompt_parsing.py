@@ -0,0 +1,53 @@
+"""
+parse_prompt_attention against the implementation before the fast path and the cache.
+
+python benchmarks/bench_prompt_parsing.py
+"""
+import random
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'tests'))
+
+import lpw_reference
+from diffusers_mastodon_bot.community_pipeline import lpw_stable_diffusion as lpw
+
+
+def bench(name, fn, prompts, number):
+    sec = min(timeit.repeat(lambda: [fn(prompt) for prompt in prompts], number=number, repeat=5))
+    per_prompt_us = sec / number / len(prompts) * 1e6
+    print(f'  {name:<28} {per_prompt_us:8.2f} us/prompt')
+    return per_prompt_us
+
+
+def main():
+    rng = random.Random(0)
+
+    plain = [
+        'suzuran from arknights at cozy cafe with tea, extremely cute, round face, big fox ears, '
+        + ' '.join(rng.choice(['masterpiece', 'high res', 'detailed', 'cat', 'sky']) for _ in range(20))
+        for _ in range(200)
+    ]
+    weighted = [
+        f'a ((house:1.{i % 10})) [on] a (hill:0.5), sun, (((sky))), ' + lpw_reference.random_prompt(rng, 12)
+        for i in range(200)
+    ]
+
+    for label, prompts in [('plain prompts', plain), ('weighted prompts', weighted)]:
+        print(label)
+        before = bench('before', lpw_reference.parse_prompt_attention, prompts, 20)
+
+        def uncached(prompt):
+            lpw._parse_prompt_attention_cached.cache_clear()
+            return lpw.parse_prompt_attention(prompt)
+
+        bench('after, cache miss', uncached, prompts, 20)
+        lpw._parse_prompt_attention_cached.cache_clear()
+        after = bench('after, cache hit', lpw.parse_prompt_attention, prompts, 20)
+        print(f'  {"speedup (hit)":<28} {before / after:8.1f}x')
+
+
+if __name__ == '__main__':
+    main()
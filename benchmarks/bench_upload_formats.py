@@ -0,0 +1,71 @@
+"""
+bytes and encode latency of each upload format, for a 2x2 grid of 512x704 images.
+
+python benchmarks/bench_upload_formats.py [saved images ...]
+
+without images, a synthetic image is used (smooth gradients, blurred noise and some edges).
+real outputs from output_save_path give more representative numbers.
+"""
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import PIL.Image
+import PIL.ImageDraw
+import PIL.ImageFilter
+
+from diffusers_mastodon_bot.upload_format import UploadFormat
+from diffusers_mastodon_bot.utils import image_grid
+
+
+specs = ['png:6', 'png:1', 'png:9', 'jpeg:95', 'jpeg:90', 'jpeg:80', 'webp:95', 'webp:85', 'webp:75']
+
+
+def synthetic_image(seed: int, width: int = 512, height: int = 704) -> PIL.Image.Image:
+    rng = random.Random(seed)
+    gradient = PIL.Image.linear_gradient('L').resize((width, height)).rotate(rng.randrange(360))
+    noise = PIL.Image.effect_noise((width, height), 64).filter(PIL.ImageFilter.GaussianBlur(3))
+    image = PIL.Image.merge('RGB', [gradient, noise, gradient.transpose(PIL.Image.Transpose.FLIP_LEFT_RIGHT)])
+
+    draw = PIL.ImageDraw.Draw(image)
+    for _ in range(40):
+        x, y = rng.randrange(width), rng.randrange(height)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        draw.ellipse((x, y, x + rng.randrange(8, 80), y + rng.randrange(8, 80)), outline=color, width=2)
+    return image
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('images', nargs='*', help='png files to tile, the first 4 are used')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    if len(args.images) > 0:
+        images = [PIL.Image.open(path).convert('RGB') for path in args.images[:4]]
+        images = (images * 4)[:4]
+    else:
+        images = [synthetic_image(seed) for seed in range(4)]
+    grid = image_grid(images, 2, 2)
+    print(f'grid {grid.size[0]}x{grid.size[1]}, {args.repeat} runs each')
+
+    print(f'{"format":>8} {"bytes":>10} {"vs png:6":>9} {"encode ms":>10}')
+    baseline = None
+    for spec in specs:
+        upload_format = UploadFormat.parse(spec)
+        took = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            encoded = upload_format.encode(grid)
+            took.append(time.perf_counter() - start)
+        if baseline is None:
+            baseline = len(encoded)
+        print(f'{spec:>8} {len(encoded):>10} {len(encoded) / baseline:>8.0%} {min(took) * 1000:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,13 @@
 import logging
+import math
+import random
 from typing import *
 
 import unicodedata
 import atexit
 import re
+import signal
+import threading
 from pathlib import Path
 from enum import Enum
 
@@ -11,15 +15,28 @@ import traceback
 
 import diffusers.pipelines
 import mastodon
+import requests
+import requests.adapters
 from mastodon import Mastodon
 
 from diffusers_mastodon_bot.bot_context import BotContext
+from diffusers_mastodon_bot.bot_job_queue import BotJob, BotJobQueue
+from diffusers_mastodon_bot.diffusion_cost_model import DiffusionCostModel
+from diffusers_mastodon_bot.fair_share_scheduler import FairShareScheduler
+from diffusers_mastodon_bot.job_journal import JobJournal
+from diffusers_mastodon_bot.notification_catch_up import NotificationCatchUp
+from diffusers_mastodon_bot.pipeline_pool import PipelinePool, PipelineWorker
+from diffusers_mastodon_bot.resident_negative_embeddings import ResidentNegativeEmbeddings
+from diffusers_mastodon_bot.result_cache import ResultCache
+from diffusers_mastodon_bot.status_dedupe_index import StatusDedupeIndex
+from diffusers_mastodon_bot.upload_format import UploadFormat
 from diffusers_mastodon_bot.bot_request_handlers.bot_request_context import BotRequestContext
 from diffusers_mastodon_bot.bot_request_handlers.bot_request_handler import BotRequestHandler
+from diffusers_mastodon_bot.bot_request_handlers.diffusion_batcher import DiffusionBatcher
 from diffusers_mastodon_bot.bot_request_handlers.game.diffuse_game_handler import DiffuseGameHandler
 from diffusers_mastodon_bot.bot_request_handlers.diffuse_me_handler import DiffuseMeHandler
 from diffusers_mastodon_bot.bot_request_handlers.proc_args_context import ProcArgsContext
-from diffusers_mastodon_bot.utils import rip_out_html
+from diffusers_mastodon_bot.utils import rip_out_html, autocast_for
 
 
 logger = logging.getLogger(__name__)
@@ -50,6 +67,41 @@ class AppStreamListener(mastodon.StreamListener):
                  tag_behind_on_image_post=False,
                  proc_kwargs: Union[None, Dict[str, Any]] = None,
                  pipe_kwargs: Union[None, Dict[str, Any]] = None,
+                 job_worker_count=1,
+                 job_queue_max_size=16,
+                 busy_message: Optional[str] = None,
+                 batch_window_sec=0.3,
+                 job_journal_path: Optional[str] = './state/job_journal.sqlite3',
+                 job_max_resumes=2,
+                 job_crashed_message: Optional[str] = None,
+                 notification_state_path: Optional[str] = './state/last_notification_id.txt',
+                 notification_page_size=80,
+                 status_dedupe_capacity=8192,
+                 status_dedupe_ttl_sec: Optional[float] = 60 * 60 * 24,
+                 status_dedupe_path: Optional[str] = './state/seen_status_ids.txt',
+                 account_weights: Optional[Dict[str, float]] = None,
+                 usage_half_life_sec: float = 60 * 60,
+                 rate_limit_burst_images: Optional[float] = None,
+                 rate_limit_images_per_hour: Optional[float] = None,
+                 rate_limited_message: Optional[str] = None,
+                 cost_model_path: Optional[str] = './state/cost_model.json',
+                 cost_model_initial_sec_per_work: float = 0.1,
+                 job_gpu_sec_budget: Optional[float] = None,
+                 over_budget_action: str = 'downscale',
+                 over_budget_min_steps: int = 20,
+                 over_budget_message: Optional[str] = None,
+                 progress_interval_sec: Optional[float] = None,
+                 progress_preview=False,
+                 pipeline_pool: Optional[PipelinePool] = None,
+                 resident_negative_embeddings=True,
+                 result_cache_path: Optional[str] = './state/result_cache',
+                 result_cache_mb=512,
+                 seed_from_prompt=False,
+                 upload_concurrency=4,
+                 upload_retries=3,
+                 upload_retry_backoff_sec=1.0,
+                 upload_format='png',
+                 archive_queue_size=64,
                  ):
         self.mastodon: Mastodon = mastodon_client
         self.mention_to_url = mention_to_url
@@ -72,11 +124,9 @@ class AppStreamListener(mastodon.StreamListener):
             if 1 <= (max_image_count / (image_tile_xy[0] * image_tile_xy[1])) <= 4 \
             else 1
 
-        self.max_batch_process = max_batch_process
-        if self.max_batch_process is not None and self.max_batch_process >= 2:
-            logger.warn('due to negative prompt bug in batch, it is temporary disabled. changing batch to 1... '
-                         'https://github.com/huggingface/diffusers/issues/779')
-            self.max_batch_process = 1
+        # negative prompts are encoded per sample by the lpw pipeline,
+        # so https://github.com/huggingface/diffusers/issues/779 does not apply anymore.
+        self.max_batch_process = max_batch_process if max_batch_process is not None else 1
 
         self.default_negative_prompt = default_negative_prompt
 
@@ -123,26 +173,193 @@ class AppStreamListener(mastodon.StreamListener):
             image_max_attachment_count=self.image_max_attachment_count,
             default_visibility=default_visibility,
             device_name=self.device,
+            progress_interval_sec=progress_interval_sec,
+            progress_preview=progress_preview,
+            upload_concurrency=upload_concurrency,
+            upload_retries=upload_retries,
+            upload_retry_backoff_sec=upload_retry_backoff_sec,
+            upload_format=upload_format,
+            archive_queue_size=archive_queue_size,
         )
 
+        self.pool_mastodon_connections(upload_concurrency)
+
+        self.bot_ctx.cost_model = DiffusionCostModel(
+            initial_sec_per_work=cost_model_initial_sec_per_work,
+            persist_path=cost_model_path
+        )
+
+        # single worker of the given pipeline, if no pool is given
+        if pipeline_pool is None:
+            pipeline_pool = PipelinePool([PipelineWorker('0', self.device, self.diffusers_pipeline)])
+
+        primary_worker = pipeline_pool.worker_of(self.diffusers_pipeline)
+        if primary_worker is None:
+            raise ValueError('diffusers_pipeline should be one of the pipeline pool workers')
+        self.bot_ctx.pipe_lock = primary_worker.lock
+
+        for worker in pipeline_pool.workers:
+            worker.batcher = DiffusionBatcher(
+                pipe=worker.pipe,
+                pipe_lock=worker.lock,
+                device_name=worker.device_name,
+                max_batch_size=self.max_batch_process,
+                window_sec=batch_window_sec,
+                scheduler_name=self.pipe_kwargs['scheduler'] if self.pipe_kwargs is not None else None,
+                cost_model=self.bot_ctx.cost_model,
+                concurrency=worker.concurrency,
+            )
+
+        self.bot_ctx.pipeline_pool = pipeline_pool
+
+        if result_cache_path is not None:
+            self.bot_ctx.result_cache = ResultCache(result_cache_path, max_bytes=int(result_cache_mb * 1024 * 1024))
+
+        # without args.seed, derive the seed from the request instead of random,
+        # so an exact repost gives the same images (from the result cache)
+        self.seed_from_prompt = seed_from_prompt
+
+        if resident_negative_embeddings:
+            self.warm_up_resident_negative_embeddings()
+
         self.req_handlers = req_handlers
 
+        self.busy_message = busy_message
+        if self.busy_message is None:
+            self.busy_message = '요청이 너무 많아요. 잠시 후에 다시 시도해주세요.'
+
+        self.job_journal = JobJournal(job_journal_path) if job_journal_path is not None else None
+
+        # a job which was running when the bot went down more than this many times is failed instead of resumed,
+        # so a job crashing the process (e.g. killed by an out of memory) does not crash loop the bot
+        self.job_max_resumes = job_max_resumes
+        self.job_crashed_message = job_crashed_message
+        if self.job_crashed_message is None:
+            self.job_crashed_message = '이 요청을 처리하다가 봇이 여러 번 멈춰서 더 이상 시도하지 않을게요. 요청을 바꿔서 다시 보내주세요.'
+
+        self.rate_limited_message = rate_limited_message
+        if self.rate_limited_message is None:
+            self.rate_limited_message = '요청 한도를 넘었어요. 약 {wait} 후에 다시 시도해주세요.'
+
+        # predicted gpu-seconds over this is rejected, downscaled or deferred. None to disable.
+        self.job_gpu_sec_budget = job_gpu_sec_budget
+        if over_budget_action not in ['reject', 'downscale', 'defer']:
+            raise ValueError(f'unknown over_budget_action {over_budget_action}')
+        self.over_budget_action = over_budget_action
+        self.over_budget_min_steps = over_budget_min_steps
+
+        self.over_budget_message = over_budget_message
+        if self.over_budget_message is None:
+            self.over_budget_message = '요청이 너무 커요. (예상 {estimated}초, 최대 {budget}초) 이미지 수나 steps를 줄여주세요.'
+
+        self.scheduler = FairShareScheduler(
+            max_size=job_queue_max_size,
+            account_weights=account_weights,
+            usage_half_life_sec=usage_half_life_sec,
+            rate_limit_burst=rate_limit_burst_images,
+            rate_limit_per_hour=rate_limit_images_per_hour,
+        )
+
+        self.job_queue = BotJobQueue(
+            scheduler=self.scheduler,
+            worker_count=job_worker_count,
+            journal=self.job_journal
+        )
+        self.job_queue.start()
+
+        self.status_dedupe = StatusDedupeIndex(
+            capacity=status_dedupe_capacity,
+            ttl_sec=status_dedupe_ttl_sec,
+            persist_path=status_dedupe_path
+        )
+
+        # set by catch_up_notifications before the stream connects
+        self.needs_catch_up_after_connect = False
+
+        self.notification_catch_up = NotificationCatchUp(
+            mastodon=self.mastodon,
+            state_path=notification_state_path,
+            page_size=notification_page_size
+        ) if notification_state_path is not None else None
+
         def exit_toot():
             if toot_on_start_end:
                 self.mastodon.account_update_credentials(display_name=f'[OFF] {self.default_bot_name}')
             pass
 
         atexit.register(exit_toot)
+        # saved images still in the queue
+        atexit.register(self.bot_ctx.archive_writer.close)
+        # systemd stops the bot with SIGTERM, which skips atexit unless it ends the interpreter normally
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.on_sigterm)
 
         print('listening')
         if toot_on_start_end:
             self.mastodon.account_update_credentials(display_name=f'[ON] {self.default_bot_name}')
 
-    def on_notification(self, notification):
+    def on_sigterm(self, signum, frame):
+        logger.info('got SIGTERM, writing saved images before exiting')
+        # within TimeoutStopSec of the service
+        self.bot_ctx.archive_writer.close(timeout_sec=10.0)
+        # runs atexit handlers too
+        raise SystemExit(0)
+
+    def pool_mastodon_connections(self, upload_concurrency: int):
+        """
+        keeps enough keep-alive connections for concurrent uploads, besides replies and the stream.
+        the default adapter of requests keeps 10 per host, and drops connections over it after use.
+        """
+        session = getattr(self.mastodon, 'session', None)
+        if not isinstance(session, requests.Session):
+            logger.info('mastodon client has no requests session, connections are not pooled')
+            return
+
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=max(10, upload_concurrency + 4))
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+    def warm_up_resident_negative_embeddings(self):
+        """
+        encodes the empty and the default negative prompt once on every pipeline worker.
+        negative_with_default is exactly the stripped default, when no negative prompt is given.
+        """
+        texts = ['']
+        if self.default_negative_prompt is not None:
+            texts.append(self.default_negative_prompt.strip())
+
+        for worker in self.bot_ctx.pipeline_pool.workers:
+            resident = getattr(worker.pipe, 'resident_negative_embeddings', None)
+            if resident is None:
+                resident = ResidentNegativeEmbeddings(texts)
+                worker.pipe.resident_negative_embeddings = resident
+            else:
+                resident.set_texts(texts)
+
+            try:
+                with worker.lock, autocast_for(worker.device_name):
+                    resident.warm_up(worker.pipe)
+            except Exception as ex:
+                # it is built on first use again
+                logger.error(f'error on resident negative embeddings warm up:\n'
+                             + "\n  ".join(traceback.format_exception(ex)))
+
+    def on_notification(self, notification, catching_up: bool = False):
+        """
+        :param catching_up: replayed by the notification catch up, which has moved its cursor past it already
+        """
         # noti_type = notification['type']
         # if noti_type != 'mention':
         #     return
 
+        if not catching_up:
+            # before this notification moves the cursor
+            self.catch_up_after_connect()
+
+        if self.notification_catch_up is not None and not self.notification_catch_up.mark_seen(notification['id']):
+            logger.info(f'skipping duplicated notification {notification["id"]}')
+            return
+
         if 'status' not in notification:
             logger.info('no status found on notification')
             return
@@ -150,13 +367,21 @@ class AppStreamListener(mastodon.StreamListener):
         status = notification['status']
 
         try:
-            result = self.handle_updates(status)
+            result = self.handle_updates(status, catching_up=catching_up)
             if result.value >= 500:
                 logger.warning(f'response failed for {status["url"]}: {result}')
         except Exception as ex:
             logger.error(f'error on notification respond:\n' + "\n  ".join(traceback.format_exception(ex)))
             pass
 
+    def on_delete(self, status_id):
+        try:
+            cancelled_count = self.job_queue.cancel(status_id)
+            if cancelled_count > 0:
+                logger.info(f'status {status_id} is deleted, cancelled {cancelled_count} jobs')
+        except Exception as ex:
+            logger.error(f'error on delete event:\n' + "\n  ".join(traceback.format_exception(ex)))
+
     # self response, without notification
     def on_update(self, status: Dict[str, Any]):
         super().on_update(status)
@@ -175,10 +400,25 @@ class AppStreamListener(mastodon.StreamListener):
 
     class HandleUpdateResult(Enum):
         success = 200
+        queued = 202
+        duplicate = 208
         no_eligible = 404
+        over_budget = 413
+        rate_limited = 429
         internal_error = 500
+        busy = 503
+
+    def handle_updates(self, status: Dict[str, Any], catching_up: bool = False) -> HandleUpdateResult:
+        """
+        parses the status and enqueues a job for the first eligible handler.
+        runs on the streaming thread, so nothing heavy should happen here.
+        :param catching_up: enqueue over the queue size limit instead of replying busy,
+            as a caught up notification is not replayed again
+        """
+        if not self.status_dedupe.check_and_add(status['id']):
+            logger.info(f'skipping already handled status {status["url"]} ({self.status_dedupe.stats()})')
+            return AppStreamListener.HandleUpdateResult.duplicate
 
-    def handle_updates(self, status: Dict[str, Any]) -> HandleUpdateResult:
         req_ctx = BotRequestContext(
             status=status,
             mastodon=self.mastodon,
@@ -201,13 +441,209 @@ class AppStreamListener(mastodon.StreamListener):
                 pipe_kwargs=self.pipe_kwargs
             )
 
-            if handler.respond_to(ctx=req_ctx, args_ctx=args_ctx):
-                return AppStreamListener.HandleUpdateResult.success
-            else:
-                return AppStreamListener.HandleUpdateResult.internal_error
+            job = BotJob(handler=handler, req_ctx=req_ctx, args_ctx=args_ctx)
+
+            deferred = False
+            # images taken from the account's rate limit bucket
+            admitted_cost = 0
+            if req_ctx.not_from_self():
+                within_budget, estimated_sec = self.fit_to_budget(handler, req_ctx, args_ctx)
+                if not within_budget:
+                    if self.over_budget_action == 'defer':
+                        logger.info(f'deferring {status["url"]}, estimated {estimated_sec:.1f}s')
+                        deferred = True
+                    else:
+                        logger.info(f'rejecting {status["url"]}, estimated {estimated_sec:.1f}s')
+                        self.reply_in_background(req_ctx, status, self.over_budget_message
+                                                 .replace('{estimated}', str(math.ceil(estimated_sec)))
+                                                 .replace('{budget}', str(math.floor(self.job_gpu_sec_budget))))
+                        return AppStreamListener.HandleUpdateResult.over_budget
+
+                admitted_cost = handler.estimated_image_count(req_ctx, args_ctx)
+                admitted, wait_sec = self.scheduler.try_admit(job.account, admitted_cost)
+                if not admitted:
+                    logger.info(f'rate limited {job.account}, wait {wait_sec:.0f}s')
+                    wait_text = f'{math.ceil(wait_sec / 60)}분'
+                    self.reply_in_background(req_ctx, status, self.rate_limited_message.replace('{wait}', wait_text))
+                    return AppStreamListener.HandleUpdateResult.rate_limited
+
+            if catching_up:
+                self.job_queue.put(job, deferred=deferred)
+                return AppStreamListener.HandleUpdateResult.queued
+
+            if self.job_queue.try_put(job, deferred=deferred):
+                return AppStreamListener.HandleUpdateResult.queued
+
+            logger.warning(f'job queue is full, rejecting {status["url"]}')
+            self.scheduler.refund(job.account, admitted_cost)
+            self.reply_in_background(req_ctx, status, self.busy_message)
+            return AppStreamListener.HandleUpdateResult.busy
 
         return AppStreamListener.HandleUpdateResult.no_eligible
 
+    def reply_in_background(self, req_ctx: BotRequestContext, status: Dict[str, Any], body: str):
+        """
+        replies on the upload executor, so a slow api call does not hold the stream thread.
+        """
+        def reply():
+            try:
+                req_ctx.reply_to(status, body)
+            except Exception as ex:
+                logger.error(f'error on replying to {status["url"]}:\n' + "\n  ".join(traceback.format_exception(ex)))
+
+        self.bot_ctx.upload_executor.submit(reply)
+
+    def estimate_gpu_sec(self, handler: BotRequestHandler, req_ctx: BotRequestContext,
+                         args_ctx: ProcArgsContext) -> float:
+        image_count = handler.estimated_image_count(req_ctx, args_ctx)
+        if image_count <= 0:
+            return 0.0
+
+        proc_kwargs = args_ctx.proc_kwargs
+        steps = handler.estimated_steps(req_ctx, args_ctx)
+        return self.bot_ctx.cost_model.predict(
+            width=proc_kwargs.get('width', 512),
+            height=proc_kwargs.get('height', 512),
+            steps=steps if steps is not None else DiffusionCostModel.default_steps,
+            image_count=image_count,
+            scheduler=DiffusionCostModel.scheduler_of(self.diffusers_pipeline)
+        )
+
+    def fit_to_budget(self, handler: BotRequestHandler, req_ctx: BotRequestContext,
+                      args_ctx: ProcArgsContext) -> Tuple[bool, float]:
+        """
+        checks the predicted gpu-seconds against the budget.
+        with 'downscale' action, lowers image count then steps of args_ctx until it fits.
+        :return: (within budget, estimated gpu-seconds)
+        """
+        estimated_sec = self.estimate_gpu_sec(handler, req_ctx, args_ctx)
+        if self.job_gpu_sec_budget is None or estimated_sec <= self.job_gpu_sec_budget:
+            return True, estimated_sec
+
+        if self.over_budget_action != 'downscale':
+            return False, estimated_sec
+
+        original_image_count = args_ctx.target_image_count
+        original_steps = args_ctx.proc_kwargs.get('num_inference_steps', DiffusionCostModel.default_steps)
+
+        while estimated_sec > self.job_gpu_sec_budget and args_ctx.target_image_count > 1:
+            args_ctx.target_image_count -= 1
+            estimated_sec = self.estimate_gpu_sec(handler, req_ctx, args_ctx)
+
+        while estimated_sec > self.job_gpu_sec_budget \
+                and args_ctx.proc_kwargs.get('num_inference_steps', DiffusionCostModel.default_steps) \
+                > self.over_budget_min_steps:
+            steps = args_ctx.proc_kwargs.get('num_inference_steps', DiffusionCostModel.default_steps)
+            args_ctx.proc_kwargs['num_inference_steps'] = max(self.over_budget_min_steps, steps - 5)
+            estimated_sec = self.estimate_gpu_sec(handler, req_ctx, args_ctx)
+
+        if estimated_sec > self.job_gpu_sec_budget:
+            # do not keep half-applied downscale
+            args_ctx.target_image_count = original_image_count
+            args_ctx.proc_kwargs['num_inference_steps'] = original_steps
+            return False, self.estimate_gpu_sec(handler, req_ctx, args_ctx)
+
+        logger.info(f'downscaled {req_ctx.status["url"]} to {args_ctx.target_image_count} images, '
+                    f'{args_ctx.proc_kwargs.get("num_inference_steps")} steps (estimated {estimated_sec:.1f}s)')
+        return True, estimated_sec
+
+    def catch_up_notifications(self):
+        """
+        feeds notifications missed while disconnected into on_notification.
+        call before (re)connecting the stream, it runs once more after connecting (see catch_up_after_connect).
+        """
+        if self.notification_catch_up is None:
+            return
+
+        self._catch_up()
+        self.needs_catch_up_after_connect = True
+
+    def catch_up_after_connect(self):
+        """
+        catches up once more on the first heartbeat or notification of a new stream connection,
+        for notifications which came between the last catch up page and the connection.
+        ones seen twice are skipped by notification id, and statuses by StatusDedupeIndex.
+        """
+        if not self.needs_catch_up_after_connect:
+            return
+        self.needs_catch_up_after_connect = False
+
+        self._catch_up()
+
+    def _catch_up(self):
+        try:
+            self.notification_catch_up.catch_up(
+                lambda notification: self.on_notification(notification, catching_up=True)
+            )
+        except Exception as ex:
+            logger.error(f'error on notification catch up:\n' + "\n  ".join(traceback.format_exception(ex)))
+
+    def handle_heartbeat(self):
+        super().handle_heartbeat()
+        self.catch_up_after_connect()
+
+    def resume_journaled_jobs(self):
+        """
+        re-enqueues jobs which were queued or running when the bot went down, in arrival order.
+        """
+        if self.job_journal is None:
+            return
+
+        entries = self.job_journal.unfinished()
+        if len(entries) == 0:
+            return
+
+        logger.info(f'resuming {len(entries)} unfinished jobs from journal')
+
+        handlers_by_name = {JobJournal.handler_name(handler): handler for handler in self.req_handlers}
+
+        for entry in entries:
+            handler = handlers_by_name.get(entry['handler_name'])
+            if handler is None:
+                logger.warning(f'no handler {entry["handler_name"]} for journaled job {entry["id"]}, dropping')
+                self.job_journal.set_state(entry['id'], JobJournal.STATE_DROPPED)
+                continue
+
+            try:
+                status = self.mastodon.status(entry['status_id'])
+            except Exception as ex:
+                logger.warning(f'can not fetch status {entry["status_id"]} for journaled job {entry["id"]}, '
+                               f'dropping: {ex}')
+                self.job_journal.set_state(entry['id'], JobJournal.STATE_DROPPED)
+                continue
+
+            req_ctx = BotRequestContext(
+                status=status,
+                mastodon=self.mastodon,
+                bot_ctx=self.bot_ctx
+            )
+
+            if entry['state'] == JobJournal.STATE_RUNNING:
+                attempts = self.job_journal.add_attempt(entry['id'])
+                if attempts > self.job_max_resumes:
+                    logger.error(f'journaled job {entry["id"]} was running when the bot went down {attempts} times, '
+                                 f'failing it')
+                    self.job_journal.set_state(entry['id'], JobJournal.STATE_FAILED)
+                    try:
+                        req_ctx.reply_to(status, self.job_crashed_message)
+                    except Exception as ex:
+                        logger.warning(f'can not reply to {status["url"]} for failed journaled job: {ex}')
+                    continue
+
+            # also restores handler payloads
+            if not handler.is_eligible_for(req_ctx):
+                logger.info(f'journaled job {entry["id"]} is not eligible anymore, dropping')
+                self.job_journal.set_state(entry['id'], JobJournal.STATE_DROPPED)
+                continue
+
+            self.job_queue.put(BotJob(
+                handler=handler,
+                req_ctx=req_ctx,
+                args_ctx=entry['args_ctx'],
+                created_at=entry['created_at'],
+                journal_id=entry['id'],
+            ))
+
     # TODO: refactor into own class
     def process_common_params(self, status):
         logger.info(f'html : {status["content"]}')
@@ -262,6 +698,13 @@ class AppStreamListener(mastodon.StreamListener):
                 elif before_args_name in ['guidance_scale']:
                     proc_kwargs[before_args_name] = min(float(args_value), 100.0)
 
+                elif before_args_name in ['seed']:
+                    proc_kwargs[before_args_name] = int(args_value) % (2 ** 32)
+
+                elif before_args_name in ['format']:
+                    # kept as text, so it stays in saved args and the job journal
+                    proc_kwargs[before_args_name] = str(UploadFormat.parse(args_value))
+
                 elif before_args_name in ['strength']:
                     actual_value = None
                     if args_value.strip() == 'low':
@@ -302,6 +745,13 @@ class AppStreamListener(mastodon.StreamListener):
             "negative_with_default": content_txt_negative_with_default
         }
 
+        # images get seed, seed + 1, ... and it is fixed here so journaled jobs resume with the same seeds
+        if proc_kwargs.get('seed') is None:
+            if self.seed_from_prompt:
+                proc_kwargs['seed'] = ResultCache.seed_of(content_txt, content_txt_negative_with_default)
+            else:
+                proc_kwargs['seed'] = random.randrange(2 ** 32)
+
         return prompts, proc_kwargs, target_image_count
 
     def on_unknown_event(self, name, unknown_event=None):
@@ -0,0 +1,167 @@
+import logging
+import os
+import queue
+import threading
+import time
+import traceback
+from pathlib import Path
+from typing import *
+
+
+logger = logging.getLogger(__name__)
+
+
+class ArchiveWriter:
+    """
+    writes saved images and args files on a background thread, so a slow disk does not delay replies.
+    each file is written to a temp file next to it and renamed, so a crash never leaves a half written file.
+
+    the queue is bounded. when it is full (the disk is stuck), files are dropped with an error
+    rather than holding requests.
+    """
+
+    class Stats(TypedDict):
+        queue_depth: int
+        max_queue_depth: int
+        written: int
+        failed: int
+        dropped: int
+        bytes: int
+        write_sec_avg: float
+        write_sec_max: float
+
+    def __init__(self,
+                 max_queue_size: int = 64,
+                 slow_write_sec: float = 1.0,
+                 log_every: int = 100
+                 ):
+        """
+        :param max_queue_size: files waiting to be written at most
+        :param slow_write_sec: writes taking longer than this are logged as warnings
+        :param log_every: log stats every this many written files, 0 to disable
+        """
+        self.slow_write_sec = slow_write_sec
+        self.log_every = log_every
+
+        # (path, data), None to stop
+        self.queue: queue.Queue = queue.Queue(maxsize=max(1, max_queue_size))
+
+        self.lock = threading.Lock()
+        self.max_queue_depth = 0
+        self.written = 0
+        self.failed = 0
+        self.dropped = 0
+        self.total_bytes = 0
+        self.total_write_sec = 0.0
+        self.max_write_sec = 0.0
+
+        self.closed = False
+        self.thread = threading.Thread(target=self._loop, name='archive-writer', daemon=True)
+        self.thread.start()
+
+    def write(self, path: str, data: bytes) -> bool:
+        """
+        queues data to be written to path, never waits for the disk or the queue.
+        :return: False if dropped, because the writer is closed or the queue is full
+        """
+        if self.closed:
+            logger.error(f'archive writer is closed, dropping {path}')
+            with self.lock:
+                self.dropped += 1
+            return False
+
+        try:
+            self.queue.put_nowait((path, data))
+        except queue.Full:
+            logger.error(f'archive queue is full ({self.queue.maxsize} files), dropping {path}')
+            with self.lock:
+                self.dropped += 1
+            return False
+
+        with self.lock:
+            self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        return True
+
+    def _loop(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self._write_now(*item)
+            finally:
+                self.queue.task_done()
+
+    def _write_now(self, path: str, data: bytes):
+        file = Path(path)
+        temp_file = file.with_name(file.name + '.tmp')
+
+        start_time = time.time()
+        try:
+            temp_file.write_bytes(data)
+            os.replace(temp_file, file)
+        except Exception as ex:
+            logger.error(f'error on writing {path}:\n' + "\n  ".join(traceback.format_exception(ex)))
+            with self.lock:
+                self.failed += 1
+            try:
+                temp_file.unlink()
+            except OSError:
+                pass
+            return
+        took_sec = time.time() - start_time
+
+        if took_sec > self.slow_write_sec:
+            logger.warning(f'writing {path} ({len(data)} bytes) took {took_sec:.2f}s, '
+                           f'{self.queue.qsize()} files waiting')
+
+        with self.lock:
+            self.written += 1
+            self.total_bytes += len(data)
+            self.total_write_sec += took_sec
+            self.max_write_sec = max(self.max_write_sec, took_sec)
+
+            if self.log_every > 0 and self.written % self.log_every == 0:
+                logger.info(f'archive writer: {self._stats()}')
+
+    def flush(self):
+        """
+        waits until every queued file is written.
+        """
+        self.queue.join()
+
+    def close(self, timeout_sec: Optional[float] = 30.0):
+        """
+        writes what is queued and stops the thread. called at exit and on SIGTERM by the listener.
+        """
+        if self.closed:
+            return
+        self.closed = True
+
+        try:
+            # a stuck disk keeps the queue full
+            self.queue.put(None, timeout=timeout_sec)
+        except queue.Full:
+            logger.error(f'archive writer is stuck, {self.queue.qsize()} files not written')
+            return
+        self.thread.join(timeout=timeout_sec)
+        if self.thread.is_alive():
+            logger.error(f'archive writer did not finish in {timeout_sec}s, {self.queue.qsize()} files not written')
+        else:
+            logger.info(f'archive writer closed: {self.stats()}')
+
+    def stats(self) -> Stats:
+        with self.lock:
+            return self._stats()
+
+    def _stats(self) -> Stats:
+        return {
+            "queue_depth": self.queue.qsize(),
+            "max_queue_depth": self.max_queue_depth,
+            "written": self.written,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "bytes": self.total_bytes,
+            "write_sec_avg": self.total_write_sec / self.written if self.written > 0 else 0.0,
+            "write_sec_max": self.max_write_sec,
+        }
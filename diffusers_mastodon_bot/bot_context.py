@@ -1,5 +1,13 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import *
 
+from diffusers_mastodon_bot.archive_writer import ArchiveWriter
+from diffusers_mastodon_bot.pipeline_pool import PipelinePool
+from diffusers_mastodon_bot.diffusion_cost_model import DiffusionCostModel
+from diffusers_mastodon_bot.result_cache import ResultCache
+from diffusers_mastodon_bot.upload_format import UploadFormat
+
 
 class BotContext:
     def __init__(self,
@@ -17,6 +25,13 @@ class BotContext:
                  image_max_attachment_count: int,
                  default_visibility: str,
                  device_name: str,
+                 progress_interval_sec: Optional[float] = None,
+                 progress_preview: bool = False,
+                 upload_concurrency: int = 4,
+                 upload_retries: int = 3,
+                 upload_retry_backoff_sec: float = 1.0,
+                 upload_format: str = 'png',
+                 archive_queue_size: int = 64,
                  ):
         self.bot_acct_url = bot_acct_url
         self.output_save_path = output_save_path
@@ -32,3 +47,30 @@ class BotContext:
         self.image_max_attachment_count = image_max_attachment_count
         self.default_visibility = default_visibility
         self.device_name = device_name
+        # None to disable progress edits of the in-progress status
+        self.progress_interval_sec = progress_interval_sec
+        self.progress_preview = progress_preview
+
+        # media uploads of all requests share this, so the uplink is not flooded
+        self.upload_executor = ThreadPoolExecutor(max_workers=max(1, upload_concurrency),
+                                                  thread_name_prefix='image-upload')
+        # retries of each upload on network or server errors, waiting backoff * 2^n between
+        self.upload_retries = upload_retries
+        self.upload_retry_backoff_sec = upload_retry_backoff_sec
+        # codec of attachments without args.format, e.g. 'webp:85', 'jpeg:90', 'png:1'
+        self.upload_format = UploadFormat.parse(upload_format)
+
+        # saved images and args files are written through this, off the request path
+        self.archive_writer = ArchiveWriter(max_queue_size=archive_queue_size)
+
+        # lock of the pipeline handlers hold, for using its tokenizer and text encoder directly
+        self.pipe_lock = threading.RLock()
+
+        # diffusion runs on a worker of this pool when set, each worker batches its own text2img requests
+        self.pipeline_pool: Optional[PipelinePool] = None
+
+        # measured pipeline runtimes are fed into this when set
+        self.cost_model: Optional[DiffusionCostModel] = None
+
+        # text2img images are looked up here by seed before running, and stored after
+        self.result_cache: Optional[ResultCache] = None
@@ -0,0 +1,168 @@
+import logging
+import threading
+import time
+import traceback
+from dataclasses import dataclass, field
+from typing import *
+
+from diffusers_mastodon_bot.bot_request_handlers.bot_request_context import BotRequestContext
+from diffusers_mastodon_bot.bot_request_handlers.request_cancelled_error import RequestCancelledError
+from diffusers_mastodon_bot.bot_request_handlers.bot_request_handler import BotRequestHandler
+from diffusers_mastodon_bot.bot_request_handlers.proc_args_context import ProcArgsContext
+from diffusers_mastodon_bot.fair_share_scheduler import FairShareScheduler
+from diffusers_mastodon_bot.job_journal import JobJournal
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class BotJob:
+    handler: BotRequestHandler
+    req_ctx: BotRequestContext
+    args_ctx: ProcArgsContext
+    created_at: float = field(default_factory=time.time)
+    journal_id: Optional[int] = None
+
+    @property
+    def account(self) -> str:
+        return self.req_ctx.status['account']['acct']
+
+
+class BotJobQueue:
+    """
+    bounded job queue between the stream listener and the request handlers.
+    the listener only enqueues, worker threads run `handler.respond_to`.
+    jobs are taken in fair-share order across accounts, see FairShareScheduler.
+    """
+
+    def __init__(self,
+                 scheduler: FairShareScheduler,
+                 worker_count: int = 1,
+                 journal: Optional[JobJournal] = None
+                 ):
+        self.scheduler = scheduler
+        self.worker_count = max(1, worker_count)
+        self.journal = journal
+
+        self.workers: List[threading.Thread] = []
+
+        # status id -> queued or running jobs, for cancellation
+        self.active_jobs: Dict[int, List[BotJob]] = {}
+        self.active_jobs_lock = threading.Lock()
+
+    def start(self):
+        for i in range(self.worker_count):
+            worker = threading.Thread(target=self._work_loop, name=f'bot-job-worker-{i}', daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def try_put(self, job: BotJob, deferred: bool = False) -> bool:
+        """
+        :param job: job to enqueue
+        :param deferred: run only when no regular job is waiting
+        :return: False if the queue is full, never blocks
+        """
+        self._journal_add(job)
+        self._add_active(job)
+
+        if not self.scheduler.try_put(job.account, job, deferred):
+            self._remove_active(job)
+            self._journal_set_state(job, JobJournal.STATE_REJECTED)
+            return False
+
+        logger.info(f'job queued for {job.req_ctx.status["url"]} '
+                    f'(queue size: {self.scheduler.qsize()}{", deferred" if deferred else ""})')
+        return True
+
+    def put(self, job: BotJob, deferred: bool = False):
+        """
+        enqueue regardless of the size limit, for jobs that are already accepted
+        (e.g. resumed from journal, or caught up notifications the cursor has moved past)
+        """
+        self._journal_add(job)
+        self._add_active(job)
+        self.scheduler.put(job.account, job, deferred)
+
+        logger.info(f'job queued for {job.req_ctx.status["url"]} '
+                    f'(queue size: {self.scheduler.qsize()}{", deferred" if deferred else ""}, over limit allowed)')
+
+    def cancel(self, status_id: Any) -> int:
+        """
+        cancels jobs of the status. queued jobs are dropped, running jobs stop at the next step.
+        :return: count of cancelled jobs
+        """
+        with self.active_jobs_lock:
+            jobs = list(self.active_jobs.get(int(status_id), []))
+
+        for job in jobs:
+            job.req_ctx.cancel()
+            if self.scheduler.remove(job.account, job):
+                self._remove_active(job)
+                self._journal_set_state(job, JobJournal.STATE_CANCELLED)
+                logger.info(f'dropped queued job for {job.req_ctx.status["url"]}')
+            else:
+                logger.info(f'cancelling running job for {job.req_ctx.status["url"]}')
+
+        return len(jobs)
+
+    def _add_active(self, job: BotJob):
+        with self.active_jobs_lock:
+            self.active_jobs.setdefault(int(job.req_ctx.status['id']), []).append(job)
+
+    def _remove_active(self, job: BotJob):
+        status_id = int(job.req_ctx.status['id'])
+        with self.active_jobs_lock:
+            jobs = self.active_jobs.get(status_id, [])
+            if job in jobs:
+                jobs.remove(job)
+            if len(jobs) == 0 and status_id in self.active_jobs:
+                del self.active_jobs[status_id]
+
+    def _journal_add(self, job: BotJob):
+        if self.journal is not None and job.journal_id is None:
+            job.journal_id = self.journal.add(job.req_ctx.status['id'], job.handler, job.args_ctx)
+
+    def _journal_set_state(self, job: BotJob, state: str):
+        if self.journal is not None and job.journal_id is not None:
+            self.journal.set_state(job.journal_id, state)
+
+    def qsize(self) -> int:
+        return self.scheduler.qsize()
+
+    def _work_loop(self):
+        while True:
+            account, job = self.scheduler.get()
+            try:
+                if job.req_ctx.is_cancelled():
+                    self._journal_set_state(job, JobJournal.STATE_CANCELLED)
+                    continue
+
+                self._journal_set_state(job, JobJournal.STATE_RUNNING)
+                result = self.run_job(job)
+
+                if job.req_ctx.is_cancelled():
+                    self._journal_set_state(job, JobJournal.STATE_CANCELLED)
+                else:
+                    self._journal_set_state(job, JobJournal.STATE_DONE if result else JobJournal.STATE_FAILED)
+            except Exception as ex:
+                logger.error(f'error on job bookkeeping:\n' + "\n  ".join(traceback.format_exception(ex)))
+            finally:
+                self._remove_active(job)
+                self.scheduler.finish(account, job.req_ctx.gpu_seconds)
+
+    @staticmethod
+    def run_job(job: BotJob) -> bool:
+        status = job.req_ctx.status
+        try:
+            logger.info(f'job started for {status["url"]} (waited {time.time() - job.created_at:.1f}s)')
+            result = job.handler.respond_to(ctx=job.req_ctx, args_ctx=job.args_ctx)
+            if not result:
+                logger.warning(f'response failed for {status["url"]}')
+            return result
+        except RequestCancelledError:
+            logger.info(f'job cancelled for {status["url"]}')
+            return False
+        except Exception as ex:
+            logger.error(f'error on job for {status["url"]}:\n' + "\n  ".join(traceback.format_exception(ex)))
+            return False
@@ -1,7 +1,9 @@
+import threading
 import typing
 from mastodon import Mastodon
 
 from diffusers_mastodon_bot.bot_context import BotContext
+from diffusers_mastodon_bot.bot_request_handlers.request_cancelled_error import RequestCancelledError
 from typing import *
 
 
@@ -25,6 +27,28 @@ class BotRequestContext:
 
         self.payload: Dict[typing.Type, Dict[str, Any]] = {}
 
+        # pipeline time of this request's own images, for per-account fair share.
+        # batcher threads add to it, use add_gpu_seconds
+        self.gpu_seconds: float = 0.0
+        self.gpu_seconds_lock = threading.Lock()
+
+        # set from the stream thread, checked by DiffusionRunner between steps
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def is_cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    def add_gpu_seconds(self, gpu_seconds: float):
+        with self.gpu_seconds_lock:
+            self.gpu_seconds += gpu_seconds
+
+    def raise_if_cancelled(self):
+        if self.cancel_event.is_set():
+            raise RequestCancelledError(f'request {self.status["id"]} is cancelled')
+
     def contains_tag_name(self, tag_name):
         return tag_name in self.tag_name_list
 
@@ -37,6 +61,32 @@ class BotRequestContext:
         account = self.status['account']
         return account['url'] != self.bot_ctx.bot_acct_url
 
+    def mention_text_of(self, status: Dict[str, Any]) -> str:
+        """
+        :return: '@acct' of the author and mentioned users of the status, except the bot itself
+        """
+        def unique_list(obj_list):
+            unique_store = set()
+            obj_unique_list = []
+            for m in obj_list:
+                if m in unique_store:
+                    continue
+                obj_unique_list.append(m)
+            return obj_unique_list
+
+        # different type but it works
+        user_objects = [status['account']] + status['mentions']
+
+        mention_targets = [
+            '@' + user_dict['acct']
+            for user_dict in user_objects
+            if user_dict['url'] != self.bot_ctx.bot_acct_url
+        ]
+
+        mention_targets = unique_list(mention_targets)
+
+        return ' '.join(mention_targets)
+
     def reply_to(self, status: Dict[str, Any], body: str, tag_behind: bool = False, keep_context: bool = False, **kwargs):
         """
         reply wrap method for easy reply
@@ -51,27 +101,7 @@ class BotRequestContext:
             kwargs['visibility'] = self.reply_visibility
 
         if tag_behind or not keep_context:
-            def unique_list(obj_list):
-                unique_store = set()
-                obj_unique_list = []
-                for m in obj_list:
-                    if m in unique_store:
-                        continue
-                    obj_unique_list.append(m)
-                return obj_unique_list
-
-            # different type but it works
-            user_objects = [status['account']] + status['mentions']
-
-            mention_targets = [
-                '@' + user_dict['acct']
-                for user_dict in user_objects
-                if user_dict['url'] != self.bot_ctx.bot_acct_url
-            ]
-
-            mention_targets = unique_list(mention_targets)
-
-            mention_text = ' '.join(mention_targets)
+            mention_text = self.mention_text_of(status)
 
             if tag_behind:
                 body = body[: max(500 - len(mention_text) - 1, 0)] + '\n' + mention_text
@@ -16,3 +16,15 @@ class BotRequestHandler(abc.ABC):
     @abc.abstractmethod
     def respond_to(self, ctx: BotRequestContext, args_ctx: ProcArgsContext) -> bool:
         pass
+
+    def estimated_image_count(self, ctx: BotRequestContext, args_ctx: ProcArgsContext) -> int:
+        """
+        images this request will generate, used for rate limiting. called after is_eligible_for.
+        """
+        return 0
+
+    def estimated_steps(self, ctx: BotRequestContext, args_ctx: ProcArgsContext) -> Optional[int]:
+        """
+        denoising steps run for each image, used for the gpu-seconds budget. None for the pipeline default.
+        """
+        return args_ctx.proc_kwargs.get('num_inference_steps')
@@ -19,6 +19,7 @@ from torch import autocast
 from .bot_request_handler import BotRequestHandler
 from .bot_request_context import BotRequestContext
 from .diffusion_runner import DiffusionRunner
+from ..diffusion_cost_model import DiffusionCostModel
 from .proc_args_context import ProcArgsContext
 from ..utils import image_grid
 
@@ -67,8 +68,6 @@ class DiffuseItHandler(BotRequestHandler):
         self.allow_self_request_only = allow_self_request_only
         self.re_strip_special_token = re.compile('<\|.*?\|>')
 
-        self.generator = torch.Generator(device='cuda')
-
     def is_eligible_for(self, ctx: BotRequestContext) -> bool:
         contains_hash = ctx.contains_tag_name(self.tag_name)
         if not contains_hash:
@@ -80,6 +79,39 @@ class DiffuseItHandler(BotRequestHandler):
             not ctx.not_from_self()
         )
 
+    def estimated_image_count(self, ctx: BotRequestContext, args_ctx: ProcArgsContext) -> int:
+        return args_ctx.target_image_count
+
+    def estimated_steps(self, ctx: BotRequestContext, args_ctx: ProcArgsContext) -> Optional[int]:
+        # img2img runs only the strength fraction of the steps given to the pipeline
+        pipeline_steps = DiffuseItHandler.pipeline_steps_of(args_ctx)
+        return DiffusionCostModel.steps_run(
+            pipeline_steps if pipeline_steps is not None else DiffusionCostModel.default_steps,
+            DiffuseItHandler.strength_of(args_ctx)
+        )
+
+    @staticmethod
+    def strength_of(args_ctx: ProcArgsContext) -> float:
+        strength = args_ctx.proc_kwargs['strength'] if 'strength' in args_ctx.proc_kwargs else None
+        if strength is None:
+            strength = DiffusionCostModel.default_strength  # pipeline default
+        return strength
+
+    @staticmethod
+    def pipeline_steps_of(args_ctx: ProcArgsContext) -> Optional[int]:
+        """
+        steps given to the pipeline, increased by strength to run like the requested steps.
+        :return: None for the pipeline default
+        """
+        if 'num_inference_steps' not in args_ctx.proc_kwargs or args_ctx.proc_kwargs['num_inference_steps'] is None:
+            return None
+
+        num_inference_steps = int(args_ctx.proc_kwargs['num_inference_steps'])
+        strength = DiffuseItHandler.strength_of(args_ctx)
+        if strength > 0:
+            return int(num_inference_steps / strength)
+        return num_inference_steps
+
     def respond_to(self, ctx: BotRequestContext, args_ctx: ProcArgsContext) -> bool:
         # start
         positive_input_form = args_ctx.prompts['positive']
@@ -153,21 +185,17 @@ class DiffuseItHandler(BotRequestHandler):
 
         # increase steps by strength, to run like default
         num_inference_steps_original = None
-        if 'num_inference_steps' in args_ctx.proc_kwargs \
-            and args_ctx.proc_kwargs['num_inference_steps'] is not None:
-            strength = args_ctx.proc_kwargs['strength'] if 'strength' in args_ctx.proc_kwargs else None
-            if strength is None:
-                strength = 0.8  # pipeline default
-            if strength > 0:
-                num_inference_steps_original = int(args_ctx.proc_kwargs['num_inference_steps'])
-                args_ctx.proc_kwargs['num_inference_steps'] = int(num_inference_steps_original / strength)
+        pipeline_steps = DiffuseItHandler.pipeline_steps_of(args_ctx)
+        if pipeline_steps is not None and DiffuseItHandler.strength_of(args_ctx) > 0:
+            num_inference_steps_original = int(args_ctx.proc_kwargs['num_inference_steps'])
+            args_ctx.proc_kwargs['num_inference_steps'] = pipeline_steps
 
         diffusion_result: DiffusionRunner.Result = DiffusionRunner.run_img2img_and_upload(
             self.pipe,
             ctx,
             args_ctx,
             init_image = image,
-            generator=self.generator
+            in_progress_status=in_progress_status
         )
 
         logger.info(f'building reply text')
@@ -176,7 +204,7 @@ class DiffuseItHandler(BotRequestHandler):
             ctx,
             args_ctx,
             diffusion_result,
-            detecting_args=['guidance_scale', 'strength'],
+            detecting_args=['guidance_scale', 'strength', 'seed'],
             args_custom_text=f'args.num_inference_steps (actual): {args_ctx.proc_kwargs["num_inference_steps"]} (input: {num_inference_steps_original})' \
                 if num_inference_steps_original is not None \
                 else None,
@@ -48,6 +48,9 @@ class DiffuseMeHandler(BotRequestHandler):
             not ctx.not_from_self()
         )
 
+    def estimated_image_count(self, ctx: BotRequestContext, args_ctx: ProcArgsContext) -> int:
+        return args_ctx.target_image_count
+
     def respond_to(self, ctx: BotRequestContext, args_ctx: ProcArgsContext) -> bool:
         # start
         positive_input_form = args_ctx.prompts['positive']
@@ -59,7 +62,9 @@ class DiffuseMeHandler(BotRequestHandler):
             and args_ctx.proc_kwargs['num_inference_steps'] is not None:
             args_ctx.proc_kwargs['num_inference_steps'] = int(args_ctx.proc_kwargs['num_inference_steps'])
 
-        diffusion_result: DiffusionRunner.Result = DiffusionRunner.run_diffusion_and_upload(self.pipe, ctx, args_ctx)
+        diffusion_result: DiffusionRunner.Result = DiffusionRunner.run_diffusion_and_upload(
+            self.pipe, ctx, args_ctx, in_progress_status=in_progress_status
+        )
 
         logger.info(f'building reply text')
 
@@ -67,7 +72,7 @@ class DiffuseMeHandler(BotRequestHandler):
             ctx,
             args_ctx,
             diffusion_result,
-            detecting_args=['num_inference_steps', 'guidance_scale'],
+            detecting_args=['num_inference_steps', 'guidance_scale', 'seed'],
             positive_input_form=positive_input_form,
             negative_input_form=negative_input_form
         )
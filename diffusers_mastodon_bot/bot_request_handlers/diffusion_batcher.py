@@ -0,0 +1,294 @@
+import logging
+import threading
+import time
+import traceback
+from concurrent.futures import Future
+from typing import *
+
+import PIL
+import torch
+
+from diffusers_mastodon_bot.bot_request_handlers.request_cancelled_error import RequestCancelledError
+from diffusers_mastodon_bot.community_pipeline.lpw_stable_diffusion \
+    import StableDiffusionLongPromptWeightingPipeline as StableDiffusionLpw, embeddings_multiples_of
+from diffusers_mastodon_bot.diffusion_cost_model import DiffusionCostModel
+from diffusers_mastodon_bot.utils import autocast_for
+
+
+logger = logging.getLogger(__name__)
+
+
+class DiffusionBatcher:
+    """
+    collects text2img samples of concurrent requests and runs them as one pipeline call.
+    samples can be batched together when width, height, steps, guidance scale and scheduler are the same,
+    and their prompts are padded to the same embedding length (see embeddings_multiples_of).
+    each sample keeps its own positive and negative prompt.
+    a batch stops early only when all requests in it are cancelled.
+    """
+
+    class Sample(TypedDict):
+        positive: str
+        negative: Optional[str]
+        # with the prompts, the image depends only on this, not on which samples share the batch
+        seed: int
+
+    class BatchResult(TypedDict):
+        images: List[PIL.Image.Image]
+        nsfw: List[bool]
+
+    class _PendingRequest:
+        def __init__(self, key: Tuple, proc_kwargs: Dict[str, Any], samples: List['DiffusionBatcher.Sample'],
+                     is_cancelled: Optional[Callable[[], bool]],
+                     callback: Optional[Callable[[int, int, torch.Tensor], None]],
+                     on_images: Optional[Callable[[int, List[PIL.Image.Image], bool], None]],
+                     on_gpu_seconds: Optional[Callable[[float], None]]):
+            self.key = key
+            self.proc_kwargs = proc_kwargs
+            self.samples = samples
+            self.is_cancelled = is_cancelled if is_cancelled is not None else (lambda: False)
+            self.callback = callback
+            self.on_images = on_images
+            self.on_gpu_seconds = on_gpu_seconds
+            self.submitted_at = time.time()
+            self.next_index = 0
+            self.done_count = 0
+            self.images: List[Optional[PIL.Image.Image]] = [None] * len(samples)
+            self.nsfw: List[bool] = [False] * len(samples)
+            self.future: Future = Future()
+
+        def left_count(self) -> int:
+            return len(self.samples) - self.next_index
+
+    def __init__(self,
+                 pipe: StableDiffusionLpw,
+                 pipe_lock: Union[threading.RLock, threading.BoundedSemaphore],
+                 device_name: str,
+                 max_batch_size: int = 1,
+                 window_sec: float = 0.3,
+                 scheduler_name: Optional[str] = None,
+                 cost_model: Optional[DiffusionCostModel] = None,
+                 concurrency: int = 1
+                 ):
+        """
+        :param concurrency: batches running at once, each on its own thread. pipe_lock should allow as many.
+        """
+        self.pipe = pipe
+        self.pipe_lock = pipe_lock
+        self.device_name = device_name
+        self.max_batch_size = max(1, max_batch_size)
+        self.window_sec = window_sec
+        self.scheduler_name = scheduler_name if scheduler_name is not None else type(pipe.scheduler).__name__
+        self.cost_model = cost_model
+
+        self.pending: List[DiffusionBatcher._PendingRequest] = []
+        self.condition = threading.Condition()
+
+        self.threads = [
+            threading.Thread(target=self._run_loop, name=f'diffusion-batcher-{device_name}-{i}', daemon=True)
+            for i in range(max(1, concurrency))
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def batch_key(self, proc_kwargs: Dict[str, Any], embeddings_multiples: int) -> Tuple:
+        return (
+            proc_kwargs.get('width'),
+            proc_kwargs.get('height'),
+            proc_kwargs.get('num_inference_steps'),
+            proc_kwargs.get('guidance_scale'),
+            self.scheduler_name,
+            embeddings_multiples,
+        )
+
+    def embeddings_multiples_of(self, samples: List[Sample]) -> int:
+        """
+        :return: embedding length (in text encoder lengths) the prompts of samples are padded to
+        :raise ValueError: if samples need different lengths, they can not be in one request
+        """
+        multiples = {
+            embeddings_multiples_of(
+                self.pipe, sample['positive'], sample['negative'] if sample['negative'] is not None else ''
+            )
+            for sample in samples
+        }
+        if len(multiples) > 1:
+            raise ValueError(f'samples of a request need different embedding lengths: {sorted(multiples)}')
+        return multiples.pop() if len(multiples) > 0 else 1
+
+    def submit(self, proc_kwargs: Dict[str, Any], samples: List[Sample],
+               is_cancelled: Optional[Callable[[], bool]] = None,
+               callback: Optional[Callable[[int, int, torch.Tensor], None]] = None,
+               on_images: Optional[Callable[[int, List[PIL.Image.Image], bool], None]] = None,
+               on_gpu_seconds: Optional[Callable[[float], None]] = None) -> Future:
+        """
+        :param proc_kwargs: width, height, num_inference_steps, guidance_scale (None for pipeline default)
+        :param samples: prompts for each image to generate, padded to the same embedding length
+        :param is_cancelled: polled between batches and steps, future raises RequestCancelledError when True
+        :param callback: pipeline step callback, gets latents of this request's samples only
+        :param on_images: (first sample index, images, has nsfw) of this request's samples in each finished batch,
+            called on the batcher thread, so it should only hand them off
+        :param on_gpu_seconds: this request's share of each batch's pipeline time, by its rows in the batch.
+            called on the batcher thread, also for cancelled batches
+        :return: future of BatchResult, images in the same order with samples
+        """
+        request = DiffusionBatcher._PendingRequest(
+            self.batch_key(proc_kwargs, self.embeddings_multiples_of(samples)), proc_kwargs, samples, is_cancelled, callback, on_images, on_gpu_seconds
+        )
+
+        if len(samples) == 0:
+            request.future.set_result({"images": [], "nsfw": []})
+            return request.future
+
+        with self.condition:
+            self.pending.append(request)
+            self.condition.notify_all()
+
+        return request.future
+
+    def _drop_cancelled(self):
+        for request in [request for request in self.pending if request.is_cancelled()]:
+            self.pending.remove(request)
+            if not request.future.done():
+                request.future.set_exception(RequestCancelledError('cancelled while waiting for batch'))
+
+    def _pending_sample_count(self, key: Tuple) -> int:
+        return sum(request.left_count() for request in self.pending if request.key == key)
+
+    def _take_batch(self, key: Tuple) -> List[Tuple['DiffusionBatcher._PendingRequest', int]]:
+        # round-robin across requests, so a small request is not stuck behind a 16 image one
+        requests = [request for request in self.pending if request.key == key]
+        batch = []
+
+        while len(batch) < self.max_batch_size and any(request.left_count() > 0 for request in requests):
+            for request in requests:
+                if len(batch) >= self.max_batch_size:
+                    break
+                if request.left_count() <= 0:
+                    continue
+                batch.append((request, request.next_index))
+                request.next_index += 1
+
+        self.pending = [request for request in self.pending if request.left_count() > 0]
+        return batch
+
+    def _run_loop(self):
+        while True:
+            with self.condition:
+                self._drop_cancelled()
+                while len(self.pending) == 0:
+                    self.condition.wait()
+                    self._drop_cancelled()
+
+                head = self.pending[0]
+                deadline = head.submitted_at + self.window_sec
+                while self._pending_sample_count(head.key) < self.max_batch_size:
+                    wait_sec = deadline - time.time()
+                    if wait_sec <= 0:
+                        break
+                    self.condition.wait(timeout=wait_sec)
+
+                self._drop_cancelled()
+                if head not in self.pending:
+                    continue
+
+                batch = self._take_batch(head.key)
+
+            self._run_batch(head.proc_kwargs, batch)
+
+    @staticmethod
+    def _charge(batch: List[Tuple['DiffusionBatcher._PendingRequest', int]],
+                requests_in_batch: List['DiffusionBatcher._PendingRequest'], took_sec: float):
+        for request in requests_in_batch:
+            if request.on_gpu_seconds is None:
+                continue
+            own_rows = sum(1 for r, _ in batch if r is request)
+            try:
+                request.on_gpu_seconds(took_sec * own_rows / len(batch))
+            except Exception as ex:
+                logger.warning(f'error on gpu seconds callback: {ex}')
+
+    def _run_batch(self, proc_kwargs: Dict[str, Any], batch: List[Tuple['DiffusionBatcher._PendingRequest', int]]):
+        requests_in_batch = list({id(request): request for request, _ in batch}.values())
+        logger.info(f'running batch of {len(batch)} samples from {len(requests_in_batch)} requests')
+
+        manual_proc_kwargs = {
+            key: proc_kwargs[key]
+            for key in ['width', 'height', 'num_inference_steps', 'guidance_scale']
+            if proc_kwargs.get(key) is not None
+        }
+
+        # request -> its rows in the batch
+        callback_targets = [
+            (request, [batch_index for batch_index, (r, _) in enumerate(batch) if r is request])
+            for request in requests_in_batch
+            if request.callback is not None
+        ]
+
+        def callback(step: int, timestep: int, latents: torch.Tensor):
+            for request, batch_indices in callback_targets:
+                try:
+                    request.callback(step, timestep, latents[batch_indices])
+                except Exception as ex:
+                    logger.warning(f'error on step callback: {ex}')
+
+        try:
+            with self.pipe_lock, autocast_for(self.device_name):
+                start_time = time.time()
+                pipe_results = self.pipe.text2img(
+                    [request.samples[i]['positive'] for request, i in batch],
+                    negative_prompt=[
+                        request.samples[i]['negative'] if request.samples[i]['negative'] is not None else ''
+                        for request, i in batch
+                    ],
+                    generator=[
+                        torch.Generator(device='cpu').manual_seed(request.samples[i]['seed']) for request, i in batch
+                    ],
+                    callback=callback if len(callback_targets) > 0 else None,
+                    is_cancelled_callback=lambda: all(request.is_cancelled() for request in requests_in_batch),
+                    **manual_proc_kwargs
+                )
+                took_sec = time.time() - start_time
+
+            self._charge(batch, requests_in_batch, took_sec)
+
+            if pipe_results is None:
+                raise RequestCancelledError('cancelled while running batch')
+        except Exception as ex:
+            if not isinstance(ex, RequestCancelledError):
+                logger.error(f'error on batch:\n' + "\n  ".join(traceback.format_exception(ex)))
+            with self.condition:
+                for request, _ in batch:
+                    if request in self.pending:
+                        self.pending.remove(request)
+                    if not request.future.done():
+                        request.future.set_exception(ex)
+            return
+
+        if self.cost_model is not None:
+            self.cost_model.observe_pipe_call(self.pipe, manual_proc_kwargs, len(batch), took_sec)
+
+        nsfw_content_detected = pipe_results.nsfw_content_detected
+
+        for batch_index, (request, i) in enumerate(batch):
+            request.images[i] = pipe_results.images[batch_index]
+            request.nsfw[i] = bool(nsfw_content_detected[batch_index]) if nsfw_content_detected is not None else False
+            request.done_count += 1
+
+        for request in requests_in_batch:
+            if request.on_images is None:
+                continue
+            # samples of a request are taken in order, so they are contiguous in the batch
+            indices = [i for r, i in batch if r is request]
+            try:
+                request.on_images(
+                    indices[0],
+                    [request.images[i] for i in indices],
+                    any(request.nsfw[i] for i in indices)
+                )
+            except Exception as ex:
+                logger.warning(f'error on images callback: {ex}')
+
+        for request in requests_in_batch:
+            if request.done_count == len(request.samples) and not request.future.done():
+                request.future.set_result({"images": request.images, "nsfw": request.nsfw})
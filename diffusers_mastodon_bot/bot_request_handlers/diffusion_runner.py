@@ -3,7 +3,9 @@ import io
 import json
 import logging
 import math
+import random
 import re
+import threading
 import time
 from datetime import datetime
 from pathlib import Path
@@ -11,18 +13,25 @@ from typing import *
 import traceback
 
 import diffusers.pipelines
+import mastodon
 import torch
 import transformers
 import PIL
-import PIL.PngImagePlugin
-from torch import autocast
+import PIL.Image
 from transformers import CLIPTokenizer, CLIPTextModel
 from transformers.modeling_outputs import BaseModelOutputWithPooling
 
 from .bot_request_handler import BotRequestHandler
 from .bot_request_context import BotRequestContext
+from .diffusion_batcher import DiffusionBatcher
+from .image_stream import ImageStream
 from .proc_args_context import ProcArgsContext
-from ..utils import image_grid
+from .progress_reporter import ProgressReporter
+from .request_cancelled_error import RequestCancelledError
+from ..diffusion_cost_model import DiffusionCostModel
+from ..result_cache import ResultCache
+from ..upload_format import UploadFormat
+from ..utils import image_grid, autocast_for, png_text_chunk, png_with_chunks
 
 from diffusers_mastodon_bot.community_pipeline.lpw_stable_diffusion \
     import StableDiffusionLongPromptWeightingPipeline as StableDiffusionLpw
@@ -35,6 +44,8 @@ class DiffusionRunner:
     class Result(TypedDict):
         image_filenames: List[str]
         images_list_posted: List[Any]
+        # uploads which failed after retries, left out of images_list_posted
+        upload_failed_count: int
         has_any_nsfw: bool
         time_took: str
 
@@ -101,6 +112,38 @@ class DiffusionRunner:
 
         return processing_body[0:400]
 
+    @staticmethod
+    def seeds_of(args_ctx: ProcArgsContext) -> List[int]:
+        """
+        :return: seed of each image, `seed`, `seed + 1`, ... of proc_kwargs
+        """
+        base_seed = args_ctx.proc_kwargs.get('seed')
+        if base_seed is None:
+            # not parsed from a status, fix it here so saved args have it
+            base_seed = random.randrange(2 ** 32)
+            args_ctx.proc_kwargs['seed'] = base_seed
+
+        return [(int(base_seed) + i) % (2 ** 32) for i in range(args_ctx.target_image_count)]
+
+    @staticmethod
+    def generators_of(seeds: List[int]) -> List[torch.Generator]:
+        # on cpu, so a seed gives the same image on any device
+        return [torch.Generator(device='cpu').manual_seed(seed) for seed in seeds]
+
+    @staticmethod
+    def result_cache_key_of(pipe: Any, args_ctx: ProcArgsContext, seed: int) -> str:
+        proc_kwargs = args_ctx.proc_kwargs
+        return ResultCache.key_of(
+            pipe,
+            positive=args_ctx.prompts['positive'],
+            negative=args_ctx.prompts['negative_with_default'],
+            seed=seed,
+            width=proc_kwargs.get('width'),
+            height=proc_kwargs.get('height'),
+            num_inference_steps=proc_kwargs.get('num_inference_steps'),
+            guidance_scale=proc_kwargs.get('guidance_scale'),
+        )
+
     @staticmethod
     def run_sth_and_upload(
         ctx: BotRequestContext,
@@ -109,56 +152,279 @@ class DiffusionRunner:
         filename_root: str,
         run_diffusion_fn: Callable,
         run_diffusion_fn_kwargs: Dict['str', Any] = {},
+        use_result_cache: bool = False,
     ) -> Result:
+        """
+        runs diffusion as a producer, each finished batch is saved and uploaded while the next one is generated.
+        :param run_diffusion_fn: (ctx, args_ctx, pipe, seeds, on_images, **kwargs) -> has any nsfw,
+            calls on_images(offset in seeds, images, has nsfw) for each finished batch, in order
+        :param use_result_cache: look up images in the result cache first, only for text2img
+        """
 
         result: DiffusionRunner.Result = {
             "image_filenames": [],
             "images_list_posted": [],
+            "upload_failed_count": 0,
             "has_any_nsfw": False,
             "time_took": ''
         }
 
-        with autocast(ctx.bot_ctx.device_name):
-            start_time = time.time()
-            
-            generated_images_raw_pil, has_any_nsfw = run_diffusion_fn(ctx, args_ctx, pipe, **run_diffusion_fn_kwargs)
-            result["has_any_nsfw"] = has_any_nsfw
-            
-            end_time = time.time()
+        seeds = DiffusionRunner.seeds_of(args_ctx)
+
+        result_cache = ctx.bot_ctx.result_cache if use_result_cache else None
+        cache_keys: List[str] = []
+        # index -> png bytes
+        cached_images: Dict[int, bytes] = {}
+        if result_cache is not None:
+            cache_keys = [DiffusionRunner.result_cache_key_of(pipe, args_ctx, seed) for seed in seeds]
+            for idx, cache_key in enumerate(cache_keys):
+                png_bytes = result_cache.get(cache_key)
+                if png_bytes is not None:
+                    cached_images[idx] = png_bytes
+            if len(cached_images) > 0:
+                logger.info(f'{len(cached_images)} of {len(seeds)} images are from result cache')
+
+        stream = DiffusionRunner.create_image_stream(
+            ctx, args_ctx, filename_root, seeds, result_cache, cache_keys
+        )
 
-            time_took = end_time - start_time
-            time_took = int(time_took * 1000) / 1000
+        for idx, png_bytes in cached_images.items():
+            image = PIL.Image.open(io.BytesIO(png_bytes))
+            image.load()
+            stream.add(idx, image, encoded=png_bytes)
 
-            result["time_took"] = f'{time_took}s'
+        run_indices = [idx for idx in range(len(seeds)) if idx not in cached_images]
+        seeds_to_run = [seeds[idx] for idx in run_indices]
 
-        if ctx.bot_ctx.save_image:
-            save_result = DiffusionRunner.save_images(
-                ctx, args_ctx, filename_root, generated_images_raw_pil,
-                save_args=ctx.bot_ctx.save_args, save_args_text=ctx.bot_ctx.save_args_text
-            )
-            result["image_filenames"] = save_result
+        def on_images(offset: int, images: List[PIL.Image.Image], has_nsfw: bool):
+            for i, image in enumerate(images):
+                # nsfw images are blacked out, do not cache them
+                stream.add(run_indices[offset + i], image, cacheable=not has_nsfw)
+
+        start_time = time.time()
+
+        try:
+            has_any_nsfw = False
+            pool = ctx.bot_ctx.pipeline_pool
+            if len(seeds_to_run) == 0:
+                pass
+            elif pool is not None and pool.worker_of(pipe) is not None:
+                # handlers hold the primary pipeline, the pool may run it on another device
+                with pool.checkout(len(seeds_to_run)) as worker:
+                    logger.info(f'running on pipeline worker {worker.name} ({worker.device_name})')
+                    has_any_nsfw = run_diffusion_fn(
+                        ctx, args_ctx, worker.pipe, seeds_to_run, on_images, **run_diffusion_fn_kwargs
+                    )
+            else:
+                has_any_nsfw = run_diffusion_fn(ctx, args_ctx, pipe, seeds_to_run, on_images, **run_diffusion_fn_kwargs)
+        except Exception:
+            stream.cancel()
+            raise
+        result["has_any_nsfw"] = has_any_nsfw
+
+        end_time = time.time()
+
+        # ctx.gpu_seconds is charged by the pipeline calls, this includes waits and uploads
+        time_took = end_time - start_time
+        time_took = int(time_took * 1000) / 1000
+
+        # nobody to reply to
+        if ctx.is_cancelled():
+            stream.cancel()
+        ctx.raise_if_cancelled()
 
-        uploaded_images = DiffusionRunner.upload_images(ctx, generated_images_raw_pil)
+        result["time_took"] = f'{time_took}s'
+
+        image_filenames, uploaded_images, upload_failed_count = stream.finish()
+        result["image_filenames"] = image_filenames
         result["images_list_posted"] = uploaded_images
+        result["upload_failed_count"] = upload_failed_count
+
+        if ctx.bot_ctx.save_image and ctx.bot_ctx.save_args and ctx.bot_ctx.save_args_text:
+            text_filename = str(Path(ctx.bot_ctx.output_save_path, filename_root + '.txt').resolve())
+            if not ctx.bot_ctx.archive_writer.write(text_filename,
+                                                    DiffusionRunner.args_info_data_of(args_ctx).encode('utf8')):
+                logger.warning(f'args text of {ctx.status["url"]} is not saved')
 
         return result
 
+    @staticmethod
+    def create_image_stream(ctx: BotRequestContext, args_ctx: ProcArgsContext, filename_root: str,
+                            seeds: List[int], result_cache: Optional[ResultCache], cache_keys: List[str]
+                            ) -> ImageStream:
+        layout = DiffusionRunner.grid_layout_by_cfg(
+            images_count=len(seeds),
+            image_tile_x=ctx.bot_ctx.image_tile_xy[0],
+            image_tile_y=ctx.bot_ctx.image_tile_xy[1],
+            image_tile_auto_expand=ctx.bot_ctx.image_tile_auto_expand,
+            max_attachment_count=ctx.bot_ctx.image_max_attachment_count
+        )
+
+        save_fn = None
+        if ctx.bot_ctx.save_image:
+            # built once, spliced into each encoded image
+            args_chunks = DiffusionRunner.args_png_chunks_of(args_ctx) if ctx.bot_ctx.save_args else None
+
+            def save_fn(idx: int, png_bytes: bytes) -> Optional[str]:
+                image_filename = str(Path(ctx.bot_ctx.output_save_path, filename_root + f'_{idx}' + '.png').resolve())
+
+                if args_chunks is not None:
+                    png_bytes = png_with_chunks(
+                        png_bytes, args_chunks + [png_text_chunk("diffusers_mastodon_bot_seed", str(seeds[idx]))]
+                    )
+
+                if not ctx.bot_ctx.archive_writer.write(image_filename, png_bytes):
+                    logger.warning(f'image {idx} of {ctx.status["url"]} is not saved')
+                    return None
+                return image_filename
+
+        cache_fn = None
+        if result_cache is not None:
+            def cache_fn(idx: int, png_bytes: bytes):
+                result_cache.put(cache_keys[idx], png_bytes)
+
+        upload_format = DiffusionRunner.upload_format_of(ctx, args_ctx)
+
+        def upload_fn(group_index: int, images: List[PIL.Image.Image], encoded_images: List[Optional[bytes]]):
+            group, grid_size = layout[group_index]
+            if grid_size is None and encoded_images[0] is not None:
+                media_bytes = encoded_images[0]
+            else:
+                image = images[0] if grid_size is None else image_grid(images, grid_size[0], grid_size[1])
+                # keeps zlib and libwebp work off the upload threads, which are mostly waiting on the network
+                media_bytes = ImageStream.encode_executor.submit(upload_format.encode, image).result()
+
+            logger.info(f'uploading attachment {group_index + 1} of {len(layout)} '
+                        f'as {upload_format}, {len(media_bytes)} bytes')
+            return DiffusionRunner.media_post_with_retry(ctx, media_bytes, upload_format.mime_type)
+
+        return ImageStream(
+            groups=[group for group, _ in layout],
+            group_uses_encoded=[grid_size is None and upload_format.same_as_archive for _, grid_size in layout],
+            encode_fn=lambda idx, image: DiffusionRunner.encode_png(image),
+            upload_fn=upload_fn,
+            upload_executor=ctx.bot_ctx.upload_executor,
+            save_fn=save_fn,
+            cache_fn=cache_fn,
+        )
+
+    @staticmethod
+    def upload_format_of(ctx: BotRequestContext, args_ctx: ProcArgsContext) -> UploadFormat:
+        """
+        args.format of the request, or the bot default.
+        """
+        spec = args_ctx.proc_kwargs.get('format')
+        if spec is not None:
+            try:
+                return UploadFormat.parse(spec)
+            except ValueError as ex:
+                logger.warning(f'ignoring upload format {spec}: {ex}')
+        return ctx.bot_ctx.upload_format
+
+    # worth trying again, others (e.g. 422 unsupported file) would fail the same way
+    retryable_upload_errors = (
+        mastodon.MastodonNetworkError,
+        mastodon.MastodonServerError,
+        mastodon.MastodonRatelimitError,
+    )
+
+    @staticmethod
+    def media_post_with_retry(ctx: BotRequestContext, media_file: bytes, mime_type: str) -> Dict[str, Any]:
+        """
+        media_post, retried on network and server errors with exponential backoff and jitter.
+        raises the last error when retries run out.
+        """
+        attempt = 0
+        while True:
+            try:
+                return ctx.mastodon.media_post(media_file, mime_type)
+            except DiffusionRunner.retryable_upload_errors as ex:
+                if attempt >= ctx.bot_ctx.upload_retries or ctx.is_cancelled():
+                    raise
+
+                delay_sec = ctx.bot_ctx.upload_retry_backoff_sec * (2 ** attempt) * random.uniform(0.5, 1.0)
+                logger.warning(f'error on image upload (attempt {attempt + 1}), retrying in {delay_sec:.1f}s: {ex}')
+                time.sleep(delay_sec)
+                attempt += 1
+
+    @staticmethod
+    def args_info_data_of(args_ctx: ProcArgsContext) -> str:
+        info_data_obj = {
+            "args_ctx": args_ctx,
+            "args_version": "0.1.0"
+        }
+        return json.dumps(info_data_obj, default=vars)
+
+    @staticmethod
+    def args_png_chunks_of(args_ctx: ProcArgsContext) -> List[bytes]:
+        return [png_text_chunk("diffusers_mastodon_bot_args", DiffusionRunner.args_info_data_of(args_ctx), compress=True)]
+
     @staticmethod
     def run_diffusion_and_upload(pipe: diffusers.pipelines.StableDiffusionPipeline,
                                  ctx: BotRequestContext,
-                                 args_ctx: ProcArgsContext) -> Result:
+                                 args_ctx: ProcArgsContext,
+                                 in_progress_status: Optional[Dict[str, Any]] = None) -> Result:
+        """
+        :param in_progress_status: status to edit with progress, if enabled in bot context
+        """
         return DiffusionRunner.run_sth_and_upload(
             ctx,
             args_ctx,
             pipe,
             filename_root=datetime.now().strftime('%Y-%m-%d_%H-%M-%S_sd'),
             run_diffusion_fn=DiffusionRunner.run_diffusion,
+            run_diffusion_fn_kwargs={
+                "in_progress_status": in_progress_status
+            },
+            use_result_cache=True
+        )
+
+    @staticmethod
+    def pipe_env_of(ctx, pipe: Any) -> Tuple[threading.RLock, str, Optional[DiffusionBatcher]]:
+        """
+        :return: (lock, device name, batcher) of the pipeline
+        """
+        pool = ctx.bot_ctx.pipeline_pool
+        worker = pool.worker_of(pipe) if pool is not None else None
+        if worker is not None:
+            return worker.lock, worker.device_name, worker.batcher
+
+        return ctx.bot_ctx.pipe_lock, ctx.bot_ctx.device_name, None
+
+    @staticmethod
+    def create_progress_reporter(ctx, args_ctx, in_progress_status: Optional[Dict[str, Any]],
+                                 image_count: int, batch_size: int,
+                                 strength: Optional[float] = None) -> Optional[ProgressReporter]:
+        steps = args_ctx.proc_kwargs.get('num_inference_steps')
+        if steps is None:
+            steps = 50  # pipeline default
+        if strength is not None:
+            steps = int(steps * strength)
+
+        return ProgressReporter.create(
+            ctx,
+            in_progress_status,
+            total_batches=math.ceil(image_count / max(1, batch_size)),
+            steps_per_batch=steps
         )
 
     @staticmethod
-    def run_diffusion(ctx, args_ctx, pipe: StableDiffusionLpw) -> Tuple[List[PIL.Image.Image], bool]:
-        left_images_count = args_ctx.target_image_count
-        generated_images_raw_pil = []
+    def run_diffusion(ctx, args_ctx, pipe: StableDiffusionLpw, seeds: List[int],
+                      on_images: Callable[[int, List[PIL.Image.Image], bool], None],
+                      in_progress_status: Optional[Dict[str, Any]] = None) -> bool:
+        """
+        :param seeds: one image for each
+        :param on_images: (offset in seeds, images, has nsfw) of each finished batch
+        :return: has any nsfw
+        """
+        pipe_lock, device_name, batcher = DiffusionRunner.pipe_env_of(ctx, pipe)
+        if batcher is not None:
+            return DiffusionRunner.run_diffusion_batched(ctx, args_ctx, batcher, seeds, on_images, in_progress_status)
+
+        progress_reporter = DiffusionRunner.create_progress_reporter(
+            ctx, args_ctx, in_progress_status, len(seeds), ctx.bot_ctx.max_batch_process
+        )
+
         has_any_nsfw = False
 
         def key_or_none(key):
@@ -171,34 +437,85 @@ class DiffusionRunner:
             "guidance_scale": key_or_none('guidance_scale')
         }
 
-        while left_images_count > 0:
-            cur_process_count = min(ctx.bot_ctx.max_batch_process, left_images_count)
+        for batch_start in range(0, len(seeds), ctx.bot_ctx.max_batch_process):
+            ctx.raise_if_cancelled()
+
+            batch_seeds = seeds[batch_start:batch_start + ctx.bot_ctx.max_batch_process]
+            cur_process_count = len(batch_seeds)
             logger.info(
-                f"processing {args_ctx.target_image_count - left_images_count + 1} of {args_ctx.target_image_count}, "
+                f"processing {batch_start + 1} of {len(seeds)}, "
                 + f"by {cur_process_count}")
 
-            pipe_results = pipe.text2img(
-                [args_ctx.prompts['positive']] * cur_process_count,
-                negative_prompt=([args_ctx.prompts['negative_with_default']] * cur_process_count
-                                 if args_ctx.prompts['negative_with_default'] is not None
-                                 else None),
-                **manual_proc_kwargs
-            )
+            with pipe_lock, autocast_for(device_name):
+                start_time = time.time()
+                pipe_results = pipe.text2img(
+                    [args_ctx.prompts['positive']] * cur_process_count,
+                    negative_prompt=([args_ctx.prompts['negative_with_default']] * cur_process_count
+                                     if args_ctx.prompts['negative_with_default'] is not None
+                                     else None),
+                    generator=DiffusionRunner.generators_of(batch_seeds),
+                    callback=progress_reporter.callback if progress_reporter is not None else None,
+                    is_cancelled_callback=ctx.is_cancelled,
+                    **manual_proc_kwargs
+                )
+                took_sec = time.time() - start_time
+
+            ctx.add_gpu_seconds(took_sec)
+
+            if pipe_results is None:
+                raise RequestCancelledError(f'cancelled while processing {ctx.status["url"]}')
+
+            if ctx.bot_ctx.cost_model is not None:
+                ctx.bot_ctx.cost_model.observe_pipe_call(pipe, manual_proc_kwargs, cur_process_count, took_sec)
+
+            batch_has_nsfw = DiffusionRunner.has_any_nsfw_of(pipe_results)
+            has_any_nsfw = has_any_nsfw or batch_has_nsfw
+
+            # save and upload while the next batch runs
+            on_images(batch_start, pipe_results.images, batch_has_nsfw)
+
+        return has_any_nsfw
+
+    @staticmethod
+    def run_diffusion_batched(ctx, args_ctx, batcher: DiffusionBatcher, seeds: List[int],
+                              on_images: Callable[[int, List[PIL.Image.Image], bool], None],
+                              in_progress_status: Optional[Dict[str, Any]] = None
+                              ) -> bool:
+        logger.info(f"submitting {len(seeds)} images to batcher")
+
+        # other requests may share batches, so batch count is a guess
+        progress_reporter = DiffusionRunner.create_progress_reporter(
+            ctx, args_ctx, in_progress_status, len(seeds), batcher.max_batch_size
+        )
 
-            generated_images_raw_pil.extend(pipe_results.images)
-            if pipe_results.nsfw_content_detected:
-                has_any_nsfw = True
+        samples: List[DiffusionBatcher.Sample] = [
+            {
+                "positive": args_ctx.prompts['positive'],
+                "negative": args_ctx.prompts['negative_with_default'],
+                "seed": seed,
+            }
+            for seed in seeds
+        ]
 
-            left_images_count -= ctx.bot_ctx.max_batch_process
+        batch_result: DiffusionBatcher.BatchResult = \
+            batcher.submit(
+                args_ctx.proc_kwargs,
+                samples,
+                is_cancelled=ctx.is_cancelled,
+                callback=progress_reporter.callback if progress_reporter is not None else None,
+                on_images=on_images,
+                on_gpu_seconds=ctx.add_gpu_seconds
+            ).result()
 
-        return generated_images_raw_pil, has_any_nsfw
+        return any(batch_result["nsfw"])
 
     @staticmethod
     def run_img2img_and_upload(pipe: diffusers.pipelines.StableDiffusionImg2ImgPipeline,
                                 ctx: BotRequestContext,
                                 args_ctx: ProcArgsContext,
                                 init_image: PIL.Image.Image,
-                                generator: Optional[torch.Generator] = None
+                                generator: Optional[torch.Generator] = None,
+                                in_progress_status: Optional[Dict[str, Any]] = None
                                 ) -> Result:
         filename_root = datetime.now().strftime('%Y-%m-%d_%H-%M-%S_im2im')
 
@@ -210,7 +527,8 @@ class DiffusionRunner:
             run_diffusion_fn=DiffusionRunner.run_img2img,
             run_diffusion_fn_kwargs={
                 "init_image": init_image,
-                "generator": generator
+                "generator": generator,
+                "in_progress_status": in_progress_status
             }
         )
 
@@ -227,9 +545,17 @@ class DiffusionRunner:
         return result
 
     @staticmethod
-    def run_img2img(ctx, args_ctx, pipe: StableDiffusionLpw, init_image: PIL.Image.Image, generator: Optional[torch.Generator] = None) -> Tuple[List[PIL.Image.Image], bool]:
-        left_images_count = args_ctx.target_image_count
-        generated_images_raw_pil = []
+    def run_img2img(ctx, args_ctx, pipe: StableDiffusionLpw, seeds: List[int],
+                    on_images: Callable[[int, List[PIL.Image.Image], bool], None],
+                    init_image: PIL.Image.Image,
+                    generator: Optional[torch.Generator] = None,
+                    in_progress_status: Optional[Dict[str, Any]] = None) -> bool:
+        """
+        :param seeds: one image for each
+        :param on_images: (offset in seeds, images, has nsfw) of each finished batch
+        :param generator: used instead of seeds if given
+        :return: has any nsfw
+        """
         has_any_nsfw = False
 
         def key_or_none(key):
@@ -246,29 +572,59 @@ class DiffusionRunner:
         if manual_proc_kwargs['strength'] is None:
             del manual_proc_kwargs['strength']
 
-        while left_images_count > 0:
-            cur_process_count = min(ctx.bot_ctx.max_batch_process, left_images_count)
+        progress_reporter = DiffusionRunner.create_progress_reporter(
+            ctx, args_ctx, in_progress_status, len(seeds), ctx.bot_ctx.max_batch_process,
+            strength=manual_proc_kwargs.get('strength', DiffusionCostModel.default_strength)
+        )
+
+        pipe_lock, device_name, _ = DiffusionRunner.pipe_env_of(ctx, pipe)
+
+        for batch_start in range(0, len(seeds), ctx.bot_ctx.max_batch_process):
+            ctx.raise_if_cancelled()
+
+            batch_seeds = seeds[batch_start:batch_start + ctx.bot_ctx.max_batch_process]
+            cur_process_count = len(batch_seeds)
             logger.info(
-                f"processing {args_ctx.target_image_count - left_images_count + 1} of {args_ctx.target_image_count}, "
+                f"processing {batch_start + 1} of {len(seeds)}, "
                 + f"by {cur_process_count}")
 
-            pipe_results = pipe.img2img(
-                image=init_image,
-                prompt=[args_ctx.prompts['positive']] * cur_process_count,
-                negative_prompt=([args_ctx.prompts['negative_with_default']] * cur_process_count
-                                    if args_ctx.prompts['negative_with_default'] is not None
-                                    else None),
-                generator=generator,
-                **manual_proc_kwargs
-            )
+            with pipe_lock, autocast_for(device_name):
+                start_time = time.time()
+                pipe_results = pipe.img2img(
+                    image=init_image,
+                    prompt=[args_ctx.prompts['positive']] * cur_process_count,
+                    negative_prompt=([args_ctx.prompts['negative_with_default']] * cur_process_count
+                                        if args_ctx.prompts['negative_with_default'] is not None
+                                        else None),
+                    generator=generator if generator is not None else DiffusionRunner.generators_of(batch_seeds),
+                    callback=progress_reporter.callback if progress_reporter is not None else None,
+                    is_cancelled_callback=ctx.is_cancelled,
+                    **manual_proc_kwargs
+                )
+                took_sec = time.time() - start_time
+
+            ctx.add_gpu_seconds(took_sec)
+
+            if pipe_results is None:
+                raise RequestCancelledError(f'cancelled while processing {ctx.status["url"]}')
 
-            generated_images_raw_pil.extend(pipe_results.images)
-            if pipe_results.nsfw_content_detected:
-                has_any_nsfw = True
+            if ctx.bot_ctx.cost_model is not None:
+                ctx.bot_ctx.cost_model.observe_pipe_call(
+                    pipe, manual_proc_kwargs, cur_process_count, took_sec,
+                    strength=manual_proc_kwargs.get('strength', DiffusionCostModel.default_strength)
+                )
 
-            left_images_count -= ctx.bot_ctx.max_batch_process
+            batch_has_nsfw = DiffusionRunner.has_any_nsfw_of(pipe_results)
+            has_any_nsfw = has_any_nsfw or batch_has_nsfw
 
-        return generated_images_raw_pil, has_any_nsfw
+            on_images(batch_start, pipe_results.images, batch_has_nsfw)
+
+        return has_any_nsfw
+
+    @staticmethod
+    def has_any_nsfw_of(pipe_results: Any) -> bool:
+        # None without safety checker, list of bool otherwise
+        return pipe_results.nsfw_content_detected is not None and any(pipe_results.nsfw_content_detected)
 
     @staticmethod
     def save_images(
@@ -277,18 +633,21 @@ class DiffusionRunner:
             filename_root: str,
             generated_images_raw_pil: List[PIL.Image.Image],
             save_args: bool = True,
-            save_args_text: bool = False
+            save_args_text: bool = False,
+            seeds: Optional[List[int]] = None
     ) -> List[str]:
+        """
+        :param seeds: seed of each image, written into png metadata with args
+        :return: filenames, written in the background by the archive writer. dropped files are left out
+        """
 
         image_filenames = []
 
         info_data: Optional[str] = None
+        args_chunks: List[bytes] = []
         if save_args:
-            info_data_obj = {
-                "args_ctx": args_ctx,
-                "args_version": "0.1.0"
-            }
-            info_data = json.dumps(info_data_obj, default=vars)
+            info_data = DiffusionRunner.args_info_data_of(args_ctx)
+            args_chunks = [png_text_chunk("diffusers_mastodon_bot_args", info_data, compress=True)]  # zText
 
         # save anyway
         for idx in range(len(generated_images_raw_pil)):
@@ -296,89 +655,64 @@ class DiffusionRunner:
 
             image: PIL.Image.Image = generated_images_raw_pil[idx]
 
-            png_metadata = None
-            if save_args:
-                png_metadata = PIL.PngImagePlugin.PngInfo()
-                png_metadata.add_text("diffusers_mastodon_bot_args", info_data, zip=True)  # zText
+            chunks = list(args_chunks)
+            if save_args and seeds is not None:
+                chunks.append(png_text_chunk("diffusers_mastodon_bot_seed", str(seeds[idx])))
 
-            image.save(image_filename, "PNG", pnginfo=png_metadata)
+            png_bytes = png_with_chunks(DiffusionRunner.encode_png(image), chunks)
+            if not ctx.bot_ctx.archive_writer.write(image_filename, png_bytes):
+                logger.warning(f'image {idx} of {ctx.status["url"]} is not saved')
+                continue
 
             image_filenames.append(image_filename)
 
         if save_args and save_args_text:
             text_filename = str(Path(ctx.bot_ctx.output_save_path, filename_root + '.txt').resolve())
-            Path(text_filename).write_text(info_data)
+            if not ctx.bot_ctx.archive_writer.write(text_filename, info_data.encode('utf8')):
+                logger.warning(f'args text of {ctx.status["url"]} is not saved')
 
         return image_filenames
 
     @staticmethod
-    def upload_images(ctx: BotRequestContext, generated_images_raw_pil: List[PIL.Image.Image]) -> List[PIL.Image.Image]:
-
-        logger.info(f'preparing images to upload')
-
-        pil_image_grids = DiffusionRunner.image_grid_by_cfg(
-            pil_images=generated_images_raw_pil,
-            image_tile_x = ctx.bot_ctx.image_tile_xy[0],
-            image_tile_y = ctx.bot_ctx.image_tile_xy[1],
-            image_tile_auto_expand = ctx.bot_ctx.image_tile_auto_expand,
-            max_attachment_count = ctx.bot_ctx.image_max_attachment_count
-        )
-
-        logger.info(f'uploading {len(generated_images_raw_pil)} images')
-
-        posted_images = []
-
-        for pil_image in pil_image_grids:
-            try:
-                # pil to png
-                # https://stackoverflow.com/a/33117447/4394750
-                img_byte_arr = io.BytesIO()
-                pil_image.save(img_byte_arr, format='PNG')
-                png_bytes = img_byte_arr.getvalue()
-
-                upload_result = ctx.mastodon.media_post(png_bytes, 'image/png')
-                posted_images.append(upload_result)
-            except Exception as ex:
-                logger.error(f'error on image upload:\n' + "\n  ".join(traceback.format_exception(ex)))
-                pass
-
-        return posted_images
+    def encode_png(image: PIL.Image.Image) -> bytes:
+        # https://stackoverflow.com/a/33117447/4394750
+        img_byte_arr = io.BytesIO()
+        image.save(img_byte_arr, format='PNG')
+        return img_byte_arr.getvalue()
 
     @staticmethod
-    def image_grid_by_cfg(
-            pil_images: List[PIL.Image.Image],
+    def grid_layout_by_cfg(
+            images_count: int,
             image_tile_x: int,
             image_tile_y: int,
             image_tile_auto_expand: bool,
             max_attachment_count: int
-    ):
+    ) -> List[Tuple[List[int], Optional[Tuple[Any, Any]]]]:
         """
-        :param pil_images: raw PIL images
-        :param image_tile_x: columns to tile
-        :param image_tile_y: rows to tile
-        :param image_tile_auto_expand: changes tile x and y dynamically to spread images across attachment
-        :param max_attachment_count: 4 (mastodon)
-        :return:
+        which images go into which attachment, known from the image count alone.
+        :return: (image indices, (rows, cols) of the grid or None to use the image as is) of each attachment
         """
-        images_count = len(pil_images)
+        indices = list(range(images_count))
         if images_count == 1:
-            return pil_images
+            return [(indices, None)]
 
         image_grid_unit = int(image_tile_x * image_tile_y)
 
-        images_grouped: List[List[PIL.Image.Image]] = []
+        indices_grouped: List[List[int]] = []
 
         # maximum square size, smaller than image_tile_x & image_tile_y
         fitting_square = math.pow(math.floor(math.sqrt(image_grid_unit)), 2)
 
         # spread
-        if image_tile_auto_expand and len(pil_images) < max_attachment_count * image_grid_unit:
+        if image_tile_auto_expand and images_count < max_attachment_count * image_grid_unit:
             for start_i in range(0, max_attachment_count):
                 # [0::10] https://stackoverflow.com/a/1403693/4394750
-                cur_images_group = pil_images[start_i::max_attachment_count]
-                images_grouped.append(cur_images_group)
+                cur_indices_group = indices[start_i::max_attachment_count]
+                # less images than attachments
+                if len(cur_indices_group) > 0:
+                    indices_grouped.append(cur_indices_group)
 
-            first_group_len = len(images_grouped[0])
+            first_group_len = len(indices_grouped[0])
 
             fitting_square = math.pow(math.floor(math.sqrt(first_group_len)), 2)
 
@@ -393,28 +727,31 @@ class DiffusionRunner:
 
         # group by predefined grid size
         else:
-            for i in range(0, len(pil_images), image_grid_unit):
-                cur_images_group = pil_images[i: i + image_grid_unit]
-                images_grouped.append(cur_images_group)
+            for i in range(0, images_count, image_grid_unit):
+                cur_indices_group = indices[i: i + image_grid_unit]
+                indices_grouped.append(cur_indices_group)
 
-        pil_image_grids = []
+        layout = []
 
-        for image_group in images_grouped:
-            image_slice_len = len(image_group)
+        for indices_group in indices_grouped:
+            image_slice_len = len(indices_group)
 
             # calculate
             max_y = image_tile_y \
                 if image_slice_len >= image_tile_x \
-                else image_tile_y % len(image_group)
+                else image_tile_y % len(indices_group)
             max_x = math.ceil(image_slice_len / image_tile_y)
 
             if fitting_square > max_x * max_y:
                 max_x = fitting_square
                 max_y = max_y
 
-            grid_image = image_grid(image_group, max_x, max_y)
-            pil_image_grids.append(grid_image)
-        return pil_image_grids
+            # a 1x1 grid is the image itself
+            if image_grid_unit == 1 and image_slice_len == 1:
+                layout.append((indices_group, None))
+            else:
+                layout.append((indices_group, (max_x, max_y)))
+        return layout
 
     @staticmethod
     def make_reply_message_contents(
@@ -443,6 +780,9 @@ class DiffusionRunner:
         if diffusion_result["has_any_nsfw"]:
             reply_message += '\n\n' + 'nsfw content detected, some of result will be a empty image'
 
+        if diffusion_result.get("upload_failed_count", 0) > 0:
+            reply_message += '\n\n' + f'failed to upload {diffusion_result["upload_failed_count"]} of the images'
+
         reply_message += '\n\n' + f'prompt: \n{positive_input_form}'
 
         if negative_input_form is not None:
@@ -29,7 +29,7 @@ from diffusers_mastodon_bot.utils import image_grid
 
 import statistics
 import math
-from threading import Timer
+from threading import Timer, RLock
 
 
 logger = logging.getLogger(__name__)
@@ -65,6 +65,9 @@ class DiffuseGameHandler(BotRequestHandler):
         self.current_game: Optional[DiffuseGameStatus] = None
         self.current_game_timer: Optional[Timer] = None
 
+        # job workers and the game timer both touch current_game
+        self.game_lock = RLock()
+
     def is_eligible_for(self, ctx: BotRequestContext) -> bool:
         # new game
         is_new_game = (
@@ -93,19 +96,29 @@ class DiffuseGameHandler(BotRequestHandler):
 
         return False
 
+    def estimated_image_count(self, ctx: BotRequestContext, args_ctx: ProcArgsContext) -> int:
+        if ctx.get_payload(type(self), 'req_type') == DiffuseGameHandler.RequestType.NewGame:
+            return args_ctx.target_image_count
+        return 0
+
     def respond_to(self, ctx: BotRequestContext, args_ctx: ProcArgsContext) -> bool:
         reply_type: DiffuseGameHandler.RequestType = ctx.get_payload(type(self), 'req_type')  # type: ignore
 
-        if reply_type == DiffuseGameHandler.RequestType.NewGame:
-            self.handle_new_game(ctx, args_ctx)
-            return True
-        elif reply_type == DiffuseGameHandler.RequestType.AnswerSubmission:
-            self.handle_answer_submission(ctx, args_ctx)
-            return True
+        with self.game_lock:
+            if reply_type == DiffuseGameHandler.RequestType.NewGame:
+                self.handle_new_game(ctx, args_ctx)
+                return True
+            elif reply_type == DiffuseGameHandler.RequestType.AnswerSubmission:
+                self.handle_answer_submission(ctx, args_ctx)
+                return True
 
         return False
 
     def close_game(self, any_ctx: BotRequestContext, early_end_status: Optional[Dict[str, Any]] = None):
+        with self.game_lock:
+            self._close_game(any_ctx, early_end_status)
+
+    def _close_game(self, any_ctx: BotRequestContext, early_end_status: Optional[Dict[str, Any]] = None):
         logger.info("closing game")
 
         this_game = self.current_game
@@ -207,12 +220,13 @@ class DiffuseGameHandler(BotRequestHandler):
         )
 
         def calc_weighted_embeddings(positive: str, negative: Optional[str]):
-            text_embeddings, uncond_embeddings = get_weighted_text_embeddings(
-                pipe=self.pipe,
-                prompt=positive,
-                uncond_prompt=negative,
-                max_embeddings_multiples=3,
-            )
+            with ctx.bot_ctx.pipe_lock:
+                text_embeddings, uncond_embeddings = get_weighted_text_embeddings(
+                    pipe=self.pipe,
+                    prompt=positive,
+                    uncond_prompt=negative,
+                    max_embeddings_multiples=3,
+                )
             return text_embeddings, uncond_embeddings
 
         self.current_game = DiffuseGameStatus(
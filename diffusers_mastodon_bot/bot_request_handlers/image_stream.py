@@ -0,0 +1,156 @@
+import logging
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import *
+
+import PIL
+import PIL.Image
+
+
+logger = logging.getLogger(__name__)
+
+
+class ImageStream:
+    """
+    saves and uploads images of a request while later images are still being generated.
+    images are added as each pipeline batch finishes, and an attachment is uploaded
+    as soon as every image of its grid is there.
+
+    each image is encoded once as png, and the bytes are shared by the result cache, the saved file
+    and the upload of an attachment which is the image itself in the same png.
+    """
+
+    # shared by all requests. encoding is mostly zlib, which releases the gil.
+    encode_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='image-encode')
+
+    class Encoded(NamedTuple):
+        png_bytes: Optional[bytes]
+        filename: Optional[str]
+
+    def __init__(self,
+                 groups: List[List[int]],
+                 group_uses_encoded: List[bool],
+                 encode_fn: Callable[[int, PIL.Image.Image], bytes],
+                 upload_fn: Callable[[int, List[PIL.Image.Image], List[Optional[bytes]]], Any],
+                 upload_executor: ThreadPoolExecutor,
+                 save_fn: Optional[Callable[[int, bytes], Optional[str]]] = None,
+                 cache_fn: Optional[Callable[[int, bytes], None]] = None,
+                 ):
+        """
+        :param groups: image indices of each attachment, in attachment order
+        :param group_uses_encoded: for each attachment, True if it is the png bytes of its only image as they are
+        :param encode_fn: (index, image) -> png bytes
+        :param upload_fn: (group index, images, png bytes of each image if encoded) -> media_post result,
+            encodes by itself for grids or other formats
+        :param upload_executor: bounds uploads running at once, usually shared across requests
+        :param save_fn: (index, png bytes) -> saved filename or None if it is not saved, None to not save
+        :param cache_fn: (index, png bytes) to keep newly encoded images, None to not cache
+        """
+        self.groups = groups
+        self.group_uses_encoded = group_uses_encoded
+        self.encode_fn = encode_fn
+        self.upload_fn = upload_fn
+        self.upload_executor = upload_executor
+        self.save_fn = save_fn
+        self.cache_fn = cache_fn
+
+        # images uploaded as is need their bytes, grids and other formats are encoded by upload_fn
+        self.uploaded_as_is = {
+            group[0] for group, uses_encoded in zip(groups, group_uses_encoded) if uses_encoded
+        }
+
+        self.lock = threading.Lock()
+        self.images: Dict[int, PIL.Image.Image] = {}
+        self.encode_futures: Dict[int, Future] = {}
+        self.upload_futures: Dict[int, Future] = {}
+
+    def add(self, index: int, image: PIL.Image.Image, encoded: Optional[bytes] = None, cacheable: bool = True):
+        """
+        :param encoded: png bytes of the image, if there already (e.g. from the result cache)
+        :param cacheable: pass newly encoded bytes to cache_fn
+        """
+        with self.lock:
+            self.images[index] = image
+            self.encode_futures[index] = ImageStream.encode_executor.submit(
+                self._encode_and_save, index, image, encoded, cacheable
+            )
+
+            for group_index, group in enumerate(self.groups):
+                if group_index in self.upload_futures or index not in group:
+                    continue
+                if all(i in self.images for i in group):
+                    self.upload_futures[group_index] = \
+                        self.upload_executor.submit(self._upload_group, group_index, group)
+
+    def _encode_and_save(self, index: int, image: PIL.Image.Image, encoded: Optional[bytes],
+                         cacheable: bool) -> Encoded:
+        cache_fn = self.cache_fn if cacheable else None
+
+        if encoded is None and (
+            self.save_fn is not None or cache_fn is not None or index in self.uploaded_as_is
+        ):
+            encoded = self.encode_fn(index, image)
+            if cache_fn is not None:
+                cache_fn(index, encoded)
+
+        filename = None
+        if self.save_fn is not None:
+            filename = self.save_fn(index, encoded)
+
+        return ImageStream.Encoded(png_bytes=encoded, filename=filename)
+
+    def _upload_group(self, group_index: int, group: List[int]) -> Any:
+        images = [self.images[i] for i in group]
+
+        encoded_images = []
+        for i in group:
+            try:
+                encoded_images.append(self.encode_futures[i].result().png_bytes)
+            except Exception as ex:
+                # the upload encodes by itself
+                logger.warning(f'error on encoding image {i}: {ex}')
+                encoded_images.append(None)
+
+        return self.upload_fn(group_index, images, encoded_images)
+
+    def cancel(self):
+        """
+        drops saves and uploads which did not start yet.
+        """
+        with self.lock:
+            for future in list(self.encode_futures.values()) + list(self.upload_futures.values()):
+                future.cancel()
+
+    def finish(self) -> Tuple[List[str], List[Any], int]:
+        """
+        waits for every save and upload. call after all images are added.
+        :return: (saved filenames in index order, media_post results in attachment order, failed upload count)
+        """
+        with self.lock:
+            encode_futures = [self.encode_futures[i] for i in sorted(self.encode_futures.keys())]
+            missing = [i for i, group in enumerate(self.groups) if i not in self.upload_futures]
+            upload_futures = [self.upload_futures[i] for i in sorted(self.upload_futures.keys())]
+
+        if len(missing) > 0:
+            logger.warning(f'attachments {missing} are missing images, not uploading')
+
+        filenames = []
+        for future in encode_futures:
+            try:
+                filename = future.result().filename
+                if filename is not None:
+                    filenames.append(filename)
+            except Exception as ex:
+                logger.error(f'error on image save:\n' + "\n  ".join(traceback.format_exception(ex)))
+
+        posted_images = []
+        failed_count = len(missing)
+        for future in upload_futures:
+            try:
+                posted_images.append(future.result())
+            except Exception as ex:
+                failed_count += 1
+                logger.error(f'error on image upload:\n' + "\n  ".join(traceback.format_exception(ex)))
+
+        return filenames, posted_images, failed_count
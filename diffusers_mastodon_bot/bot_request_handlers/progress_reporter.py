@@ -0,0 +1,174 @@
+import io
+import logging
+import math
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import *
+
+import PIL
+import PIL.Image
+import torch
+
+from .bot_request_context import BotRequestContext
+
+
+logger = logging.getLogger(__name__)
+
+
+class ProgressReporter:
+    """
+    edits the in-progress status with step count and eta while denoising.
+    `callback` goes into the pipeline's `callback`, and it only does cheap work on the gpu thread.
+    edits and uploads run on a background thread, and an update is skipped while the previous one is in flight.
+    """
+
+    # approximate sd 1.x latent -> rgb projection, (4, 3), fitted against vae decoded images
+    latent_rgb_factors = [
+        [0.298, 0.207, 0.208],
+        [0.187, 0.286, 0.173],
+        [-0.158, 0.189, 0.264],
+        [-0.184, -0.271, -0.473],
+    ]
+
+    # single thread, edits of one status should not be reordered
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='progress-reporter')
+
+    def __init__(self,
+                 ctx: BotRequestContext,
+                 in_progress_status: Dict[str, Any],
+                 total_batches: int,
+                 steps_per_batch: int,
+                 interval_sec: float = 15,
+                 preview: bool = False,
+                 preview_size: int = 128,
+                 ):
+        """
+        :param in_progress_status: status to edit, replied by the bot
+        :param total_batches: pipeline calls expected for the request
+        :param steps_per_batch: denoising steps run by each pipeline call
+        :param interval_sec: minimum seconds between edits
+        :param preview: attach a low-res preview made from latents
+        :param preview_size: longer side of the preview, in pixels
+        """
+        self.ctx = ctx
+        self.in_progress_status = in_progress_status
+        self.total_steps = max(1, total_batches * steps_per_batch)
+        self.steps_per_batch = max(1, steps_per_batch)
+        self.interval_sec = interval_sec
+        self.preview = preview
+        self.preview_size = preview_size
+
+        self.mention_text = ctx.mention_text_of(ctx.status)
+
+        self.lock = threading.Lock()
+        self.started_at: Optional[float] = None
+        self.last_reported_at = time.time()
+        self.completed_batches = 0
+        self.last_step = -1
+        self.in_flight: Optional[Future] = None
+
+    @staticmethod
+    def create(ctx: BotRequestContext, in_progress_status: Optional[Dict[str, Any]],
+               total_batches: int, steps_per_batch: int) -> Optional['ProgressReporter']:
+        """
+        :return: reporter configured from bot context, None if disabled
+        """
+        if in_progress_status is None or ctx.bot_ctx.progress_interval_sec is None:
+            return None
+
+        return ProgressReporter(
+            ctx,
+            in_progress_status,
+            total_batches=total_batches,
+            steps_per_batch=steps_per_batch,
+            interval_sec=ctx.bot_ctx.progress_interval_sec,
+            preview=ctx.bot_ctx.progress_preview,
+        )
+
+    def callback(self, step: int, timestep: int, latents: torch.Tensor):
+        now = time.time()
+
+        with self.lock:
+            if self.started_at is None:
+                self.started_at = now
+
+            # step restarts from 0 on each pipeline call
+            if step <= self.last_step:
+                self.completed_batches += 1
+            self.last_step = step
+
+            if now - self.last_reported_at < self.interval_sec:
+                return
+            if self.in_flight is not None and not self.in_flight.done():
+                return
+
+            self.last_reported_at = now
+
+            done_steps = min(self.total_steps, self.completed_batches * self.steps_per_batch + step + 1)
+            eta_sec = (now - self.started_at) / done_steps * (self.total_steps - done_steps)
+
+            preview_image = None
+            if self.preview:
+                try:
+                    preview_image = self.latents_to_preview(latents)
+                except Exception as ex:
+                    logger.warning(f'failed to make preview: {ex}')
+
+            self.in_flight = ProgressReporter.executor.submit(self._edit_status, done_steps, eta_sec, preview_image)
+
+    def _edit_status(self, done_steps: int, eta_sec: float, preview_image: Optional[PIL.Image.Image]):
+        try:
+            body = f'처리중... {done_steps}/{self.total_steps} steps, 약 {math.ceil(eta_sec)}초 남음'
+
+            media_ids = None
+            if preview_image is not None:
+                image_byte_arr = io.BytesIO()
+                preview_image.save(image_byte_arr, format='PNG')
+                media_ids = [self.ctx.mastodon.media_post(image_byte_arr.getvalue(), 'image/png')['id']]
+
+            ProgressReporter.status_update(
+                self.ctx.mastodon,
+                self.in_progress_status['id'],
+                status=(self.mention_text + ' ' + body).strip(),
+                media_ids=media_ids,
+                # previews did not go through the safety checker
+                sensitive=True if media_ids is not None else None,
+            )
+        except Exception as ex:
+            logger.warning(f'error on progress update:\n' + "\n  ".join(traceback.format_exception(ex)))
+
+    @staticmethod
+    def status_update(mastodon: Any, status_id: Any, status: str,
+                      media_ids: Optional[List[Any]] = None, sensitive: Optional[bool] = None) -> Dict[str, Any]:
+        """
+        edits a status. Mastodonplus.py (< 2.0) has no status_update, so PUT /api/v1/statuses/:id is sent directly.
+        """
+        if hasattr(mastodon, 'status_update'):
+            return mastodon.status_update(status_id, status=status, media_ids=media_ids, sensitive=sensitive)
+
+        params: Dict[str, Any] = {"status": status}
+        if media_ids is not None:
+            params["media_ids"] = [str(media_id) for media_id in media_ids]
+        if sensitive is not None:
+            params["sensitive"] = sensitive
+        # json body, form encoding would need media_ids[] keys
+        return mastodon._Mastodon__api_request('PUT', f'/api/v1/statuses/{status_id}', params, use_json=True)
+
+    def latents_to_preview(self, latents: torch.Tensor) -> PIL.Image.Image:
+        """
+        projects the first sample's latents to rgb with a fixed linear map, no vae involved.
+        :param latents: (batch, 4, h/8, w/8)
+        """
+        factors = torch.tensor(ProgressReporter.latent_rgb_factors, dtype=latents.dtype, device=latents.device)
+        # (4, h, w) -> (h, w, 3)
+        rgb = torch.einsum('chw,cr->hwr', latents[0], factors)
+        rgb = ((rgb + 1) / 2).clamp(0, 1).mul(255).round().to(torch.uint8).cpu().numpy()
+
+        image = PIL.Image.fromarray(rgb)
+        scale = self.preview_size / max(image.width, image.height)
+        return image.resize(
+            (max(1, int(image.width * scale)), max(1, int(image.height * scale))),
+            resample=PIL.Image.Resampling.BILINEAR
+        )
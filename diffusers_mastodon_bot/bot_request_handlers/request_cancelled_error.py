@@ -0,0 +1,5 @@
+class RequestCancelledError(Exception):
+    """
+    raised when the request is cancelled while processing, e.g. the requester deleted the toot
+    """
+    pass
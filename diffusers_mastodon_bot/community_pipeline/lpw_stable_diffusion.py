@@ -10,9 +10,13 @@ Q. Why source copy-paste?
 A. autocompletion
 """
 
+import collections
+import copy
+import functools
 import inspect
 import re
-from typing import Callable, List, Optional, Union
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Union
 
 import numpy as np
 import torch
@@ -69,6 +73,9 @@ re_attention = re.compile(
     re.X,
 )
 
+# prompts without any of these parse to [[text, 1.0]]
+re_attention_special = re.compile(r"[()\[\]:\\]")
+
 
 def parse_prompt_attention(text):
     """
@@ -104,7 +111,20 @@ def parse_prompt_attention(text):
      ['sky', 1.4641000000000006],
      ['.', 1.1]]
     """
+    if re_attention_special.search(text) is None:
+        return [[text, 1.0]]
+
+    # fresh lists from the immutable cached pairs, callers may modify the result
+    return [[fragment, weight] for fragment, weight in _parse_prompt_attention_cached(text)]
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_prompt_attention_cached(text):
+    # tuples only, so nothing can change a cached parse through a returned value
+    return tuple((fragment, weight) for fragment, weight in parse_prompt_attention_uncached(text))
 
+
+def parse_prompt_attention_uncached(text):
     res = []
     round_brackets = []
     square_brackets = []
@@ -156,6 +176,53 @@ def parse_prompt_attention(text):
     return res
 
 
+# (tokenizer name, fragment) -> token ids without starting and ending token
+fragment_token_cache: collections.OrderedDict = collections.OrderedDict()
+fragment_token_cache_size = 16384
+fragment_token_cache_lock = threading.Lock()
+fragment_tokenizer_lock = threading.Lock()
+
+
+def tokenize_fragments(pipe: StableDiffusionPipeline, fragments: Iterable[str]) -> Dict[str, List[int]]:
+    r"""
+    Tokenize prompt fragments, without starting and ending tokens.
+    Fragments not in the cache are tokenized in one batched call.
+
+    `pipe.fragment_tokenizer` is used instead of `pipe.tokenizer` if set, e.g. a fast tokenizer.
+    """
+    tokenizer = getattr(pipe, "fragment_tokenizer", None) or pipe.tokenizer
+    tokenizer_name = getattr(tokenizer, "name_or_path", "")
+
+    result = {}
+    missing = []
+    with fragment_token_cache_lock:
+        for fragment in fragments:
+            if fragment in result:
+                continue
+            token = fragment_token_cache.get((tokenizer_name, fragment))
+            if token is None:
+                missing.append(fragment)
+                result[fragment] = None
+            else:
+                fragment_token_cache.move_to_end((tokenizer_name, fragment))
+                result[fragment] = token
+
+    if len(missing) > 0:
+        # tokenize and discard the starting and the ending token
+        # fast tokenizers raise "Already borrowed" when called from two threads at once
+        with fragment_tokenizer_lock:
+            missing_tokens = [token[1:-1] for token in tokenizer(missing).input_ids]
+
+        with fragment_token_cache_lock:
+            for fragment, token in zip(missing, missing_tokens):
+                result[fragment] = token
+                fragment_token_cache[(tokenizer_name, fragment)] = token
+            while len(fragment_token_cache) > fragment_token_cache_size:
+                fragment_token_cache.popitem(last=False)
+
+    return result
+
+
 def get_prompts_with_weights(pipe: StableDiffusionPipeline, prompt: List[str], max_length: int):
     r"""
     Tokenize a list of prompts and return its tokens with weights of each token.
@@ -165,13 +232,17 @@ def get_prompts_with_weights(pipe: StableDiffusionPipeline, prompt: List[str], m
     tokens = []
     weights = []
     truncated = False
-    for text in prompt:
-        texts_and_weights = parse_prompt_attention(text)
+
+    parsed_prompts = [parse_prompt_attention(text) for text in prompt]
+    fragment_tokens = tokenize_fragments(
+        pipe, [word for texts_and_weights in parsed_prompts for word, _ in texts_and_weights]
+    )
+
+    for texts_and_weights in parsed_prompts:
         text_token = []
         text_weight = []
         for word, weight in texts_and_weights:
-            # tokenize and discard the starting and the ending token
-            token = pipe.tokenizer(word).input_ids[1:-1]
+            token = fragment_tokens[word]
             text_token += token
             # copy the weight by length of token
             text_weight += [weight] * len(token)
@@ -194,26 +265,32 @@ def get_prompts_with_weights(pipe: StableDiffusionPipeline, prompt: List[str], m
 def pad_tokens_and_weights(tokens, weights, max_length, bos, eos, no_boseos_middle=True, chunk_length=77):
     r"""
     Pad the tokens (with starting and ending tokens) and weights (with 1.0) to max_length.
+
+    Returns preallocated numpy arrays, (batch, max_length) of int64 tokens and (batch, weights_length) of
+    float64 weights. Tokens longer than max_length - 2 are not expected (get_prompts_with_weights truncates).
     """
     max_embeddings_multiples = (max_length - 2) // (chunk_length - 2)
     weights_length = max_length if no_boseos_middle else max_embeddings_multiples * chunk_length
-    for i in range(len(tokens)):
-        tokens[i] = [bos] + tokens[i] + [eos] * (max_length - 1 - len(tokens[i]))
-        if no_boseos_middle:
-            weights[i] = [1.0] + weights[i] + [1.0] * (max_length - 1 - len(weights[i]))
-        else:
-            w = []
-            if len(weights[i]) == 0:
-                w = [1.0] * weights_length
-            else:
-                for j in range(max_embeddings_multiples):
-                    w.append(1.0)  # weight for starting token in this chunk
-                    w += weights[i][j * (chunk_length - 2) : min(len(weights[i]), (j + 1) * (chunk_length - 2))]
-                    w.append(1.0)  # weight for ending token in this chunk
-                w += [1.0] * (weights_length - len(w))
-            weights[i] = w[:]
+    batch_size = len(tokens)
 
-    return tokens, weights
+    padded_tokens = np.full((batch_size, max_length), eos, dtype=np.int64)
+    padded_tokens[:, 0] = bos
+    for i in range(batch_size):
+        padded_tokens[i, 1 : 1 + len(tokens[i])] = tokens[i]
+
+    padded_weights = np.ones((batch_size, weights_length), dtype=np.float64)
+    if no_boseos_middle:
+        for i in range(batch_size):
+            padded_weights[i, 1 : 1 + len(weights[i])] = weights[i]
+    else:
+        # weights of the j-th chunk go between its starting and ending token, everything else is 1.0
+        chunk_weights = np.ones((batch_size, max_embeddings_multiples * (chunk_length - 2)), dtype=np.float64)
+        for i in range(batch_size):
+            chunk_weights[i, : len(weights[i])] = weights[i]
+        padded_weights.reshape(batch_size, max_embeddings_multiples, chunk_length)[:, :, 1:-1] = \
+            chunk_weights.reshape(batch_size, max_embeddings_multiples, chunk_length - 2)
+
+    return padded_tokens, padded_weights
 
 
 def get_unweighted_text_embeddings(
@@ -225,18 +302,35 @@ def get_unweighted_text_embeddings(
     """
     When the length of tokens is a multiple of the capacity of the text encoder,
     it should be split into chunks and sent to the text encoder individually.
+
+    Chunks of all rows are stacked along the batch dimension and encoded in a single forward.
     """
     max_embeddings_multiples = (text_input.shape[1] - 2) // (chunk_length - 2)
     if max_embeddings_multiples > 1:
+        batch_size = text_input.shape[0]
+
+        # (multiples, batch, chunk_length), the i-th chunk of every row
+        text_input_chunks = torch.stack(
+            [
+                text_input[:, i * (chunk_length - 2) : (i + 1) * (chunk_length - 2) + 2]
+                for i in range(max_embeddings_multiples)
+            ]
+        ).clone()
+
+        # cover the head and the tail by the starting and the ending tokens
+        text_input_chunks[:, :, 0] = text_input[0, 0]
+        text_input_chunks[:, :, -1] = text_input[0, -1]
+
+        text_embedding_chunks = pipe.text_encoder(
+            text_input_chunks.view(max_embeddings_multiples * batch_size, chunk_length)
+        )[0]
+        text_embedding_chunks = text_embedding_chunks.view(
+            max_embeddings_multiples, batch_size, chunk_length, text_embedding_chunks.shape[-1]
+        )
+
         text_embeddings = []
         for i in range(max_embeddings_multiples):
-            # extract the i-th chunk
-            text_input_chunk = text_input[:, i * (chunk_length - 2) : (i + 1) * (chunk_length - 2) + 2].clone()
-
-            # cover the head and the tail by the starting and the ending tokens
-            text_input_chunk[:, 0] = text_input[0, 0]
-            text_input_chunk[:, -1] = text_input[0, -1]
-            text_embedding = pipe.text_encoder(text_input_chunk)[0]
+            text_embedding = text_embedding_chunks[i]
 
             if no_boseos_middle:
                 if i == 0:
@@ -264,6 +358,7 @@ def get_weighted_text_embeddings(
     no_boseos_middle: Optional[bool] = False,
     skip_parsing: Optional[bool] = False,
     skip_weighting: Optional[bool] = False,
+    min_embeddings_multiples: Optional[int] = 1,
     **kwargs,
 ):
     r"""
@@ -290,17 +385,25 @@ def get_weighted_text_embeddings(
             Skip the parsing of brackets.
         skip_weighting (`bool`, *optional*, defaults to `False`):
             Skip the weighting. When the parsing is skipped, it is forced True.
+        min_embeddings_multiples (`int`, *optional*, defaults to `1`):
+            Pad the embeddings to at least this multiple, up to `max_embeddings_multiples`. Used to match the
+            length of embeddings computed separately.
     """
+    requested_max_embeddings_multiples = max_embeddings_multiples
     max_length = (pipe.tokenizer.model_max_length - 2) * max_embeddings_multiples + 2
     if isinstance(prompt, str):
         prompt = [prompt]
 
     if not skip_parsing:
-        prompt_tokens, prompt_weights = get_prompts_with_weights(pipe, prompt, max_length - 2)
-        if uncond_prompt is not None:
+        if uncond_prompt is None:
+            prompt_tokens, prompt_weights = get_prompts_with_weights(pipe, prompt, max_length - 2)
+        else:
             if isinstance(uncond_prompt, str):
                 uncond_prompt = [uncond_prompt]
-            uncond_tokens, uncond_weights = get_prompts_with_weights(pipe, uncond_prompt, max_length - 2)
+            # fragments of both are tokenized together
+            all_tokens, all_weights = get_prompts_with_weights(pipe, prompt + uncond_prompt, max_length - 2)
+            prompt_tokens, uncond_tokens = all_tokens[: len(prompt)], all_tokens[len(prompt) :]
+            prompt_weights, uncond_weights = all_weights[: len(prompt)], all_weights[len(prompt) :]
     else:
         prompt_tokens = [
             token[1:-1] for token in pipe.tokenizer(prompt, max_length=max_length, truncation=True).input_ids
@@ -325,66 +428,137 @@ def get_weighted_text_embeddings(
         (max_length - 1) // (pipe.tokenizer.model_max_length - 2) + 1,
     )
     max_embeddings_multiples = max(1, max_embeddings_multiples)
+    max_embeddings_multiples = max(
+        max_embeddings_multiples, min(min_embeddings_multiples, requested_max_embeddings_multiples)
+    )
     max_length = (pipe.tokenizer.model_max_length - 2) * max_embeddings_multiples + 2
 
+    weighting = (not skip_parsing) and (not skip_weighting)
+    embed_kwargs = dict(max_length=max_length, no_boseos_middle=no_boseos_middle, weighting=weighting)
+
+    # rows are encoded independently, so they can be reused for the same text and options
+    cache = getattr(pipe, "text_embedding_cache", None)
+    cache_options = (max_embeddings_multiples, no_boseos_middle, skip_parsing, skip_weighting)
+
+    # prompts and negatives go through the text encoder together
+    texts = prompt + (uncond_prompt if uncond_prompt is not None else [])
+    tokens = prompt_tokens + (uncond_tokens if uncond_prompt is not None else [])
+    weights = prompt_weights + (uncond_weights if uncond_prompt is not None else [])
+
+    if cache is None:
+        embeddings = embed_tokens_and_weights(pipe, tokens, weights, **embed_kwargs)
+    else:
+        embeddings = embed_texts_cached(pipe, cache, cache_options, texts, tokens, weights, **embed_kwargs)
+
+    text_embeddings = embeddings[: len(prompt)]
+    if uncond_prompt is not None:
+        uncond_embeddings = embeddings[len(prompt) :]
+        return text_embeddings, uncond_embeddings
+    return text_embeddings, None
+
+
+def embeddings_multiples_of(
+    pipe: StableDiffusionPipeline,
+    prompt: str,
+    uncond_prompt: Optional[str] = None,
+    max_embeddings_multiples: Optional[int] = 3,
+) -> int:
+    r"""
+    The multiple of the text encoder length `get_weighted_text_embeddings` pads a prompt and its unconditional
+    prompt to, when they are the only ones in the batch.
+
+    Rows of a batch are padded to the longest one, and the weighting keeps the mean over the padded row, so a
+    prompt gives the same embeddings in a batch only when every row there needs the same multiple.
+    """
+    chunk_length = pipe.tokenizer.model_max_length - 2
+    texts = [prompt] + ([uncond_prompt] if uncond_prompt is not None else [])
+    tokens, _ = get_prompts_with_weights(pipe, texts, chunk_length * max_embeddings_multiples)
+    longest = max(len(token) for token in tokens)
+    return max(1, min(max_embeddings_multiples, (longest - 1) // chunk_length + 1))
+
+
+def embed_tokens_and_weights(
+    pipe: StableDiffusionPipeline,
+    tokens: List[List[int]],
+    weights: List[List[float]],
+    max_length: int,
+    no_boseos_middle: bool,
+    weighting: bool,
+):
+    r"""
+    Pads, encodes and weights tokens of prompts (without starting and ending tokens), one row per prompt.
+    """
     # pad the length of tokens and weights
     bos = pipe.tokenizer.bos_token_id
     eos = pipe.tokenizer.eos_token_id
-    prompt_tokens, prompt_weights = pad_tokens_and_weights(
-        prompt_tokens,
-        prompt_weights,
+    tokens, weights = pad_tokens_and_weights(
+        tokens,
+        weights,
         max_length,
         bos,
         eos,
         no_boseos_middle=no_boseos_middle,
         chunk_length=pipe.tokenizer.model_max_length,
     )
-    prompt_tokens = torch.tensor(prompt_tokens, dtype=torch.long, device=pipe.device)
-    if uncond_prompt is not None:
-        uncond_tokens, uncond_weights = pad_tokens_and_weights(
-            uncond_tokens,
-            uncond_weights,
-            max_length,
-            bos,
-            eos,
-            no_boseos_middle=no_boseos_middle,
-            chunk_length=pipe.tokenizer.model_max_length,
-        )
-        uncond_tokens = torch.tensor(uncond_tokens, dtype=torch.long, device=pipe.device)
+    tokens = torch.from_numpy(tokens).to(pipe.device)
 
     # get the embeddings
-    text_embeddings = get_unweighted_text_embeddings(
+    embeddings = get_unweighted_text_embeddings(
         pipe,
-        prompt_tokens,
+        tokens,
         pipe.tokenizer.model_max_length,
         no_boseos_middle=no_boseos_middle,
     )
-    prompt_weights = torch.tensor(prompt_weights, dtype=text_embeddings.dtype, device=pipe.device)
-    if uncond_prompt is not None:
-        uncond_embeddings = get_unweighted_text_embeddings(
-            pipe,
-            uncond_tokens,
-            pipe.tokenizer.model_max_length,
-            no_boseos_middle=no_boseos_middle,
-        )
-        uncond_weights = torch.tensor(uncond_weights, dtype=uncond_embeddings.dtype, device=pipe.device)
+    weights = torch.from_numpy(weights).to(device=pipe.device, dtype=embeddings.dtype)
 
     # assign weights to the prompts and normalize in the sense of mean
     # TODO: should we normalize by chunk or in a whole (current implementation)?
-    if (not skip_parsing) and (not skip_weighting):
-        previous_mean = text_embeddings.float().mean(axis=[-2, -1]).to(text_embeddings.dtype)
-        text_embeddings *= prompt_weights.unsqueeze(-1)
-        current_mean = text_embeddings.float().mean(axis=[-2, -1]).to(text_embeddings.dtype)
-        text_embeddings *= (previous_mean / current_mean).unsqueeze(-1).unsqueeze(-1)
-        if uncond_prompt is not None:
-            previous_mean = uncond_embeddings.float().mean(axis=[-2, -1]).to(uncond_embeddings.dtype)
-            uncond_embeddings *= uncond_weights.unsqueeze(-1)
-            current_mean = uncond_embeddings.float().mean(axis=[-2, -1]).to(uncond_embeddings.dtype)
-            uncond_embeddings *= (previous_mean / current_mean).unsqueeze(-1).unsqueeze(-1)
+    if weighting:
+        previous_mean = embeddings.float().mean(axis=[-2, -1]).to(embeddings.dtype)
+        embeddings *= weights.unsqueeze(-1)
+        current_mean = embeddings.float().mean(axis=[-2, -1]).to(embeddings.dtype)
+        embeddings *= (previous_mean / current_mean).unsqueeze(-1).unsqueeze(-1)
 
-    if uncond_prompt is not None:
-        return text_embeddings, uncond_embeddings
-    return text_embeddings, None
+    return embeddings
+
+
+def embed_texts_cached(
+    pipe: StableDiffusionPipeline,
+    cache,
+    cache_options: tuple,
+    texts: List[str],
+    tokens: List[List[int]],
+    weights: List[List[float]],
+    **embed_kwargs,
+):
+    r"""
+    Same as `embed_tokens_and_weights`, but takes rows from the cache when possible.
+    Only texts missing from the cache are encoded, each distinct text once.
+    """
+    keys = [cache.key_of(pipe, text, *cache_options) for text in texts]
+    rows = [cache.get(key, pipe.device) for key in keys]
+
+    # text -> first index, so a negative prompt repeated in the batch is encoded once
+    missing = {}
+    for i, row in enumerate(rows):
+        if row is None and texts[i] not in missing:
+            missing[texts[i]] = i
+
+    if len(missing) > 0:
+        missing_indices = list(missing.values())
+        embeddings = embed_tokens_and_weights(
+            pipe,
+            [tokens[i] for i in missing_indices],
+            [weights[i] for i in missing_indices],
+            **embed_kwargs,
+        )
+        encoded = {}
+        for j, i in enumerate(missing_indices):
+            cache.put(keys[i], embeddings[j])
+            encoded[texts[i]] = embeddings[j]
+        rows = [row if row is not None else encoded[texts[i]] for i, row in enumerate(rows)]
+
+    return torch.stack(rows)
 
 
 def preprocess_image(image):
@@ -491,6 +665,37 @@ class StableDiffusionLongPromptWeightingPipeline(StableDiffusionPipeline):
         if not hasattr(self, "vae_scale_factor"):
             setattr(self, "vae_scale_factor", 2 ** (len(self.vae.config.block_out_channels) - 1))
 
+        # (num_inference_steps, device) -> scheduler with timesteps set, copied for each call
+        self._scheduler_templates: collections.OrderedDict = collections.OrderedDict()
+        self._scheduler_templates_source = None
+        self._scheduler_templates_lock = threading.Lock()
+
+    _scheduler_templates_size = 16
+
+    def scheduler_for(self, num_inference_steps, device):
+        r"""
+        A private copy of `self.scheduler` with timesteps set, so concurrent calls do not share scheduler state.
+        Timesteps and sigma tables are computed once per step count and device, and copied afterwards.
+        Templates are dropped when `self.scheduler` is replaced.
+        """
+        key = (num_inference_steps, str(device))
+        with self._scheduler_templates_lock:
+            if self._scheduler_templates_source is not self.scheduler:
+                self._scheduler_templates.clear()
+                self._scheduler_templates_source = self.scheduler
+
+            template = self._scheduler_templates.get(key)
+            if template is None:
+                template = copy.deepcopy(self.scheduler)
+                template.set_timesteps(num_inference_steps, device=device)
+                self._scheduler_templates[key] = template
+                while len(self._scheduler_templates) > self._scheduler_templates_size:
+                    self._scheduler_templates.popitem(last=False)
+            else:
+                self._scheduler_templates.move_to_end(key)
+
+            return copy.deepcopy(template)
+
     @property
     def _execution_device(self):
         r"""
@@ -549,6 +754,31 @@ class StableDiffusionLongPromptWeightingPipeline(StableDiffusionPipeline):
                 " the batch size of `prompt`."
             )
 
+        # negatives encoded ahead of time (e.g. the default one), when the whole batch shares one
+        resident = getattr(self, "resident_negative_embeddings", None)
+        resident_entry = None
+        if do_classifier_free_guidance and resident is not None and len(set(negative_prompt)) == 1:
+            resident_entry = resident.get(self, negative_prompt[0], max_embeddings_multiples)
+
+        if resident_entry is not None:
+            text_embeddings, _ = get_weighted_text_embeddings(
+                pipe=self,
+                prompt=prompt,
+                uncond_prompt=None,
+                max_embeddings_multiples=max_embeddings_multiples,
+                min_embeddings_multiples=resident_entry["needed_multiples"],
+            )
+            bs_embed, seq_len, _ = text_embeddings.shape
+            text_embeddings = text_embeddings.repeat(1, num_images_per_prompt, 1)
+            text_embeddings = text_embeddings.view(bs_embed * num_images_per_prompt, seq_len, -1)
+
+            # no_boseos_middle is False, each chunk keeps its starting and ending tokens
+            uncond_embeddings = resident_entry["embeddings"][seq_len // self.tokenizer.model_max_length]
+            uncond_embeddings = uncond_embeddings.to(text_embeddings.dtype).expand(
+                bs_embed * num_images_per_prompt, -1, -1
+            )
+            return torch.cat([uncond_embeddings, text_embeddings])
+
         text_embeddings, uncond_embeddings = get_weighted_text_embeddings(
             pipe=self,
             prompt=prompt,
@@ -585,17 +815,18 @@ class StableDiffusionLongPromptWeightingPipeline(StableDiffusionPipeline):
                 f" {type(callback_steps)}."
             )
 
-    def get_timesteps(self, num_inference_steps, strength, device, is_text2img):
+    def get_timesteps(self, num_inference_steps, strength, device, is_text2img, scheduler=None):
+        scheduler = scheduler if scheduler is not None else self.scheduler
         if is_text2img:
-            return self.scheduler.timesteps.to(device), num_inference_steps
+            return scheduler.timesteps.to(device), num_inference_steps
         else:
             # get the original timestep using init_timestep
-            offset = self.scheduler.config.get("steps_offset", 0)
+            offset = scheduler.config.get("steps_offset", 0)
             init_timestep = int(num_inference_steps * strength) + offset
             init_timestep = min(init_timestep, num_inference_steps)
 
             t_start = max(num_inference_steps - init_timestep + offset, 0)
-            timesteps = self.scheduler.timesteps[t_start:].to(device)
+            timesteps = scheduler.timesteps[t_start:].to(device)
             return timesteps, num_inference_steps - t_start
 
     def run_safety_checker(self, image, device, dtype):
@@ -608,32 +839,211 @@ class StableDiffusionLongPromptWeightingPipeline(StableDiffusionPipeline):
             has_nsfw_concept = None
         return image, has_nsfw_concept
 
-    def decode_latents(self, latents):
+    def decode_latents_on_device(self, latents):
+        r"""
+        Decodes to (batch, 3, height, width) in [0, 1], left on the execution device.
+        """
         latents = 1 / 0.18215 * latents
-        image = self.vae.decode(latents).sample
-        image = (image / 2 + 0.5).clamp(0, 1)
+        # set by the bot, in megabytes. None decodes the whole batch at once.
+        decode_memory_mb = getattr(self, "vae_decode_memory_mb", None)
+        if decode_memory_mb is None:
+            image = self.vae.decode(latents).sample
+        else:
+            image = self.decode_latents_bounded(latents, int(decode_memory_mb * 1024 * 1024))
+        return (image / 2 + 0.5).clamp(0, 1)
+
+    def decode_latents(self, latents):
+        image = self.decode_latents_on_device(latents)
         # we always cast to float32 as this does not cause significant overhead and is compatible with bfloa16
         image = image.cpu().permute(0, 2, 3, 1).float().numpy()
         return image
 
-    def prepare_extra_step_kwargs(self, generator, eta):
+    def decode_latents_uint8(self, latents):
+        r"""
+        `decode_latents` and the scaling of `numpy_to_pil` in one, quantized on the execution device,
+        so only a contiguous uint8 NHWC buffer is copied to the host.
+        Scaled in float32 like `numpy_to_pil`, and torch rounds half to even like numpy, so pixels are the same.
+        """
+        image = self.decode_latents_on_device(latents)
+        image = (image.float() * 255).round().to(torch.uint8)
+        return image.permute(0, 2, 3, 1).contiguous().cpu().numpy()
+
+    @staticmethod
+    def uint8_to_pil(images):
+        r"""
+        (batch, height, width, 3) uint8 -> PIL images, without going through float.
+        """
+        return [PIL.Image.fromarray(image) for image in images]
+
+    @staticmethod
+    def estimate_vae_decode_bytes(latent_height, latent_width, element_size):
+        r"""
+        Rough peak memory of decoding one sample with the SD VAE: a few 256 channel activations at the output
+        resolution, and the attention scores of the mid block, which grow with the square of the latent size.
+        """
+        pixels = latent_height * 8 * latent_width * 8
+        tokens = latent_height * latent_width
+        return element_size * (pixels * 256 * 4 + tokens * tokens * 3)
+
+    def decode_latents_bounded(self, latents, max_bytes):
+        r"""
+        Decodes in slices of samples which fit in `max_bytes`.
+        A sample which does not fit by itself is decoded in overlapping spatial tiles.
+        """
+        batch_size, _, latent_height, latent_width = latents.shape
+        element_size = latents.element_size()
+
+        sample_bytes = self.estimate_vae_decode_bytes(latent_height, latent_width, element_size)
+        if sample_bytes <= max_bytes:
+            slice_size = max(1, int(max_bytes // sample_bytes))
+            if slice_size >= batch_size:
+                return self.vae.decode(latents).sample
+            return torch.cat(
+                [self.vae.decode(latents[i : i + slice_size]).sample for i in range(0, batch_size, slice_size)]
+            )
+
+        # largest square tile, in latent pixels, which fits
+        tile_size = max(latent_height, latent_width)
+        while tile_size > 32 and self.estimate_vae_decode_bytes(tile_size, tile_size, element_size) > max_bytes:
+            tile_size -= 8
+        overlap = tile_size // 4
+
+        return torch.cat(
+            [self.decode_latents_tiled(latents[i : i + 1], tile_size, overlap) for i in range(batch_size)]
+        )
+
+    def decode_latents_tiled(self, latents, tile_size, overlap):
+        r"""
+        Decodes one sample (1, 4, h, w) tile by tile, blending overlaps with linear ramps to hide seams.
+        `tile_size` and `overlap` are in latent pixels.
+        """
+        _, _, latent_height, latent_width = latents.shape
+        scale = self.vae_scale_factor
+        stride = max(1, tile_size - overlap)
+
+        def tile_starts(size):
+            if size <= tile_size:
+                return [0]
+            starts = list(range(0, size - tile_size + 1, stride))
+            if starts[-1] != size - tile_size:
+                starts.append(size - tile_size)
+            return starts
+
+        def ramp(length, ramp_length, ramp_start, ramp_end):
+            weights = torch.ones(length, device=latents.device, dtype=torch.float32)
+            ramp_length = min(ramp_length, length // 2)
+            if ramp_length > 0:
+                edge = torch.linspace(0, 1, ramp_length + 2, device=latents.device, dtype=torch.float32)[1:-1]
+                if ramp_start:
+                    weights[:ramp_length] = edge
+                if ramp_end:
+                    weights[-ramp_length:] = edge.flip(0)
+            return weights
+
+        output = None
+        output_weights = None
+
+        for top in tile_starts(latent_height):
+            for left in tile_starts(latent_width):
+                tile = latents[:, :, top : top + tile_size, left : left + tile_size]
+                decoded = self.vae.decode(tile).sample.float()
+                if output is None:
+                    output = torch.zeros(
+                        (1, decoded.shape[1], latent_height * scale, latent_width * scale),
+                        device=decoded.device,
+                        dtype=torch.float32,
+                    )
+                    output_weights = torch.zeros_like(output[:, :1])
+
+                # ramps only on the sides which overlap a neighbour tile
+                tile_height, tile_width = decoded.shape[2], decoded.shape[3]
+                weights = ramp(
+                    tile_height, overlap * scale, top > 0, top + tile_size < latent_height
+                )[:, None] * ramp(
+                    tile_width, overlap * scale, left > 0, left + tile_size < latent_width
+                )[None, :]
+
+                y, x = top * scale, left * scale
+                output[:, :, y : y + tile_height, x : x + tile_width] += decoded * weights
+                output_weights[:, :, y : y + tile_height, x : x + tile_width] += weights
+
+        return (output / output_weights).to(latents.dtype)
+
+    def prepare_extra_step_kwargs(self, generator, eta, scheduler=None, device=None):
         # prepare extra kwargs for the scheduler step, since not all schedulers have the same signature
         # eta (η) is only used with the DDIMScheduler, it will be ignored for other schedulers.
         # eta corresponds to η in DDIM paper: https://arxiv.org/abs/2010.02502
         # and should be between [0, 1]
 
-        accepts_eta = "eta" in set(inspect.signature(self.scheduler.step).parameters.keys())
+        scheduler = scheduler if scheduler is not None else self.scheduler
+        accepts_eta = "eta" in set(inspect.signature(scheduler.step).parameters.keys())
         extra_step_kwargs = {}
         if accepts_eta:
             extra_step_kwargs["eta"] = eta
 
         # check if the scheduler accepts generator
-        accepts_generator = "generator" in set(inspect.signature(self.scheduler.step).parameters.keys())
+        accepts_generator = "generator" in set(inspect.signature(scheduler.step).parameters.keys())
         if accepts_generator:
-            extra_step_kwargs["generator"] = generator
+            if isinstance(generator, list):
+                # one per row, see `scheduler_step`
+                device = device if device is not None else self._execution_device
+                extra_step_kwargs["generator"] = [self.step_generator_of(g, device) for g in generator]
+            else:
+                extra_step_kwargs["generator"] = generator
         return extra_step_kwargs
 
-    def prepare_latents(self, image, timestep, batch_size, height, width, dtype, device, generator, latents=None):
+    @staticmethod
+    def step_generator_of(generator: torch.Generator, device) -> torch.Generator:
+        r"""
+        A generator on `device` for the noise drawn by scheduler steps (ancestral samplers, DDPM, DDIM with eta),
+        seeded from the sample's own generator. Schedulers draw this noise on the device of the model output,
+        which a generator on another device can not do.
+        """
+        seed = int(torch.randint(0, 2**62, (1,), generator=generator, device=generator.device))
+        # schedulers draw on cpu for mps, same as the initial noise
+        step_device = "cpu" if torch.device(device).type == "mps" else device
+        return torch.Generator(device=step_device).manual_seed(seed)
+
+    @staticmethod
+    def scheduler_step(scheduler, noise_pred, t, latents, extra_step_kwargs):
+        r"""
+        `scheduler.step`, row by row when there is a generator per row.
+        Schedulers draw one noise tensor for the whole batch from a single generator, so a sample would depend on
+        the other samples of its batch. Schedulers taking a generator (DDPM, DDIM, Euler, Euler ancestral)
+        keep no state between steps, so stepping each row separately gives the same result otherwise.
+        """
+        generator = extra_step_kwargs.get("generator")
+        if not isinstance(generator, list):
+            return scheduler.step(noise_pred, t, latents, **extra_step_kwargs).prev_sample
+
+        if len(generator) != latents.shape[0]:
+            raise ValueError(f"Got {len(generator)} generators for a batch of {latents.shape[0]}")
+
+        return torch.cat([
+            scheduler.step(
+                noise_pred[i : i + 1], t, latents[i : i + 1], **{**extra_step_kwargs, "generator": row_generator}
+            ).prev_sample
+            for i, row_generator in enumerate(generator)
+        ])
+
+    @staticmethod
+    def randn_per_generator(shape, generators: List[torch.Generator], device, dtype):
+        """
+        one row per generator, so each sample only depends on its own seed and not on the batch it ran in.
+        sampled in float32 on the generator's device, so a seed gives the same noise on any execution device.
+        """
+        if len(generators) != shape[0]:
+            raise ValueError(f"Got {len(generators)} generators for a batch of {shape[0]}")
+
+        return torch.cat([
+            torch.randn((1,) + tuple(shape[1:]), generator=generator, device=generator.device, dtype=torch.float32)
+            for generator in generators
+        ]).to(device=device, dtype=dtype)
+
+    def prepare_latents(
+        self, image, timestep, batch_size, height, width, dtype, device, generator, latents=None, scheduler=None
+    ):
+        scheduler = scheduler if scheduler is not None else self.scheduler
         if image is None:
             shape = (
                 batch_size,
@@ -643,7 +1053,9 @@ class StableDiffusionLongPromptWeightingPipeline(StableDiffusionPipeline):
             )
 
             if latents is None:
-                if device.type == "mps":
+                if isinstance(generator, list):
+                    latents = self.randn_per_generator(shape, generator, device, dtype)
+                elif device.type == "mps":
                     # randn does not work reproducibly on mps
                     latents = torch.randn(shape, generator=generator, device="cpu", dtype=dtype).to(device)
                 else:
@@ -654,22 +1066,35 @@ class StableDiffusionLongPromptWeightingPipeline(StableDiffusionPipeline):
                 latents = latents.to(device)
 
             # scale the initial noise by the standard deviation required by the scheduler
-            latents = latents * self.scheduler.init_noise_sigma
+            latents = latents * scheduler.init_noise_sigma
             return latents, None, None
         else:
             init_latent_dist = self.vae.encode(image).latent_dist
-            init_latents = init_latent_dist.sample(generator=generator)
+            if isinstance(generator, list):
+                if len(generator) != batch_size:
+                    raise ValueError(f"Got {len(generator)} generators for a batch of {batch_size}")
+                init_latents = torch.cat([
+                    init_latent_dist.mean
+                    + init_latent_dist.std * self.randn_per_generator(
+                        init_latent_dist.mean.shape, [g], device, init_latent_dist.mean.dtype
+                    )
+                    for g in generator
+                ], dim=0)
+            else:
+                init_latents = init_latent_dist.sample(generator=generator)
+                init_latents = torch.cat([init_latents] * batch_size, dim=0)
             init_latents = 0.18215 * init_latents
-            init_latents = torch.cat([init_latents] * batch_size, dim=0)
             init_latents_orig = init_latents
             shape = init_latents.shape
 
             # add noise to latents using the timesteps
-            if device.type == "mps":
+            if isinstance(generator, list):
+                noise = self.randn_per_generator(shape, generator, device, dtype)
+            elif device.type == "mps":
                 noise = torch.randn(shape, generator=generator, device="cpu", dtype=dtype).to(device)
             else:
                 noise = torch.randn(shape, generator=generator, device=device, dtype=dtype)
-            latents = self.scheduler.add_noise(init_latents, noise, timestep)
+            latents = scheduler.add_noise(init_latents, noise, timestep)
             return latents, init_latents_orig, noise
 
     @torch.no_grad()
@@ -686,7 +1111,7 @@ class StableDiffusionLongPromptWeightingPipeline(StableDiffusionPipeline):
         strength: float = 0.8,
         num_images_per_prompt: Optional[int] = 1,
         eta: float = 0.0,
-        generator: Optional[torch.Generator] = None,
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
         latents: Optional[torch.FloatTensor] = None,
         max_embeddings_multiples: Optional[int] = 3,
         output_type: Optional[str] = "pil",
@@ -739,7 +1164,7 @@ class StableDiffusionLongPromptWeightingPipeline(StableDiffusionPipeline):
                 [`schedulers.DDIMScheduler`], will be ignored for others.
             generator (`torch.Generator`, *optional*):
                 A [torch generator](https://pytorch.org/docs/stable/generated/torch.Generator.html) to make generation
-                deterministic.
+                deterministic. A list of generators, one per image, makes each image depend only on its own generator.
             latents (`torch.FloatTensor`, *optional*):
                 Pre-generated noisy latents, sampled from a Gaussian distribution, to be used as inputs for image
                 generation. Can be used to tweak the same generation with different prompts. If not provided, a latents
@@ -813,9 +1238,11 @@ class StableDiffusionLongPromptWeightingPipeline(StableDiffusionPipeline):
         else:
             mask = None
 
-        # 5. set timesteps
-        self.scheduler.set_timesteps(num_inference_steps, device=device)
-        timesteps, num_inference_steps = self.get_timesteps(num_inference_steps, strength, device, image is None)
+        # 5. set timesteps, on a copy of the scheduler so the pipeline can be called from several threads
+        scheduler = self.scheduler_for(num_inference_steps, device)
+        timesteps, num_inference_steps = self.get_timesteps(
+            num_inference_steps, strength, device, image is None, scheduler=scheduler
+        )
         latent_timestep = timesteps[:1].repeat(batch_size * num_images_per_prompt)
 
         # 6. Prepare latent variables
@@ -829,16 +1256,17 @@ class StableDiffusionLongPromptWeightingPipeline(StableDiffusionPipeline):
             device,
             generator,
             latents,
+            scheduler=scheduler,
         )
 
         # 7. Prepare extra step kwargs. TODO: Logic should ideally just be moved out of the pipeline
-        extra_step_kwargs = self.prepare_extra_step_kwargs(generator, eta)
+        extra_step_kwargs = self.prepare_extra_step_kwargs(generator, eta, scheduler=scheduler, device=device)
 
         # 8. Denoising loop
         for i, t in enumerate(self.progress_bar(timesteps)):
             # expand the latents if we are doing classifier free guidance
             latent_model_input = torch.cat([latents] * 2) if do_classifier_free_guidance else latents
-            latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
+            latent_model_input = scheduler.scale_model_input(latent_model_input, t)
 
             # predict the noise residual
             noise_pred = self.unet(latent_model_input, t, encoder_hidden_states=text_embeddings).sample
@@ -849,11 +1277,11 @@ class StableDiffusionLongPromptWeightingPipeline(StableDiffusionPipeline):
                 noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
 
             # compute the previous noisy sample x_t -> x_t-1
-            latents = self.scheduler.step(noise_pred, t, latents, **extra_step_kwargs).prev_sample
+            latents = self.scheduler_step(scheduler, noise_pred, t, latents, extra_step_kwargs)
 
             if mask is not None:
                 # masking
-                init_latents_proper = self.scheduler.add_noise(init_latents_orig, noise, torch.tensor([t]))
+                init_latents_proper = scheduler.add_noise(init_latents_orig, noise, torch.tensor([t]))
                 latents = (init_latents_proper * mask) + (latents * (1 - mask))
 
             # call the callback, if provided
@@ -863,15 +1291,20 @@ class StableDiffusionLongPromptWeightingPipeline(StableDiffusionPipeline):
                 if is_cancelled_callback is not None and is_cancelled_callback():
                     return None
 
-        # 9. Post-processing
-        image = self.decode_latents(latents)
+        if output_type == "pil" and self.safety_checker is None:
+            # 9 - 11. nothing needs float images on the host, quantize before copying
+            image = self.uint8_to_pil(self.decode_latents_uint8(latents))
+            has_nsfw_concept = None
+        else:
+            # 9. Post-processing
+            image = self.decode_latents(latents)
 
-        # 10. Run safety checker
-        image, has_nsfw_concept = self.run_safety_checker(image, device, text_embeddings.dtype)
+            # 10. Run safety checker
+            image, has_nsfw_concept = self.run_safety_checker(image, device, text_embeddings.dtype)
 
-        # 11. Convert to PIL
-        if output_type == "pil":
-            image = self.numpy_to_pil(image)
+            # 11. Convert to PIL
+            if output_type == "pil":
+                image = self.numpy_to_pil(image)
 
         if not return_dict:
             return image, has_nsfw_concept
@@ -888,7 +1321,7 @@ class StableDiffusionLongPromptWeightingPipeline(StableDiffusionPipeline):
         guidance_scale: float = 7.5,
         num_images_per_prompt: Optional[int] = 1,
         eta: float = 0.0,
-        generator: Optional[torch.Generator] = None,
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
         latents: Optional[torch.FloatTensor] = None,
         max_embeddings_multiples: Optional[int] = 3,
         output_type: Optional[str] = "pil",
@@ -926,7 +1359,7 @@ class StableDiffusionLongPromptWeightingPipeline(StableDiffusionPipeline):
                 [`schedulers.DDIMScheduler`], will be ignored for others.
             generator (`torch.Generator`, *optional*):
                 A [torch generator](https://pytorch.org/docs/stable/generated/torch.Generator.html) to make generation
-                deterministic.
+                deterministic. A list of generators, one per image, makes each image depend only on its own generator.
             latents (`torch.FloatTensor`, *optional*):
                 Pre-generated noisy latents, sampled from a Gaussian distribution, to be used as inputs for image
                 generation. Can be used to tweak the same generation with different prompts. If not provided, a latents
@@ -985,7 +1418,7 @@ class StableDiffusionLongPromptWeightingPipeline(StableDiffusionPipeline):
         guidance_scale: Optional[float] = 7.5,
         num_images_per_prompt: Optional[int] = 1,
         eta: Optional[float] = 0.0,
-        generator: Optional[torch.Generator] = None,
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
         max_embeddings_multiples: Optional[int] = 3,
         output_type: Optional[str] = "pil",
         return_dict: bool = True,
@@ -1027,7 +1460,7 @@ class StableDiffusionLongPromptWeightingPipeline(StableDiffusionPipeline):
                 [`schedulers.DDIMScheduler`], will be ignored for others.
             generator (`torch.Generator`, *optional*):
                 A [torch generator](https://pytorch.org/docs/stable/generated/torch.Generator.html) to make generation
-                deterministic.
+                deterministic. A list of generators, one per image, makes each image depend only on its own generator.
             max_embeddings_multiples (`int`, *optional*, defaults to `3`):
                 The max multiple length of prompt embeddings compared to the max output length of text encoder.
             output_type (`str`, *optional*, defaults to `"pil"`):
@@ -1082,7 +1515,7 @@ class StableDiffusionLongPromptWeightingPipeline(StableDiffusionPipeline):
         guidance_scale: Optional[float] = 7.5,
         num_images_per_prompt: Optional[int] = 1,
         eta: Optional[float] = 0.0,
-        generator: Optional[torch.Generator] = None,
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
         max_embeddings_multiples: Optional[int] = 3,
         output_type: Optional[str] = "pil",
         return_dict: bool = True,
@@ -1128,7 +1561,7 @@ class StableDiffusionLongPromptWeightingPipeline(StableDiffusionPipeline):
                 [`schedulers.DDIMScheduler`], will be ignored for others.
             generator (`torch.Generator`, *optional*):
                 A [torch generator](https://pytorch.org/docs/stable/generated/torch.Generator.html) to make generation
-                deterministic.
+                deterministic. A list of generators, one per image, makes each image depend only on its own generator.
             max_embeddings_multiples (`int`, *optional*, defaults to `3`):
                 The max multiple length of prompt embeddings compared to the max output length of text encoder.
             output_type (`str`, *optional*, defaults to `"pil"`):
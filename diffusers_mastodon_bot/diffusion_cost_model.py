@@ -0,0 +1,138 @@
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import *
+
+
+logger = logging.getLogger(__name__)
+
+
+class DiffusionCostModel:
+    """
+    predicts gpu-seconds of a diffusion job, as a linear function per scheduler of
+    `work = (width * height / 512^2) * steps * image_count`.
+
+    the model is refit online from measured runtimes, with exponential forgetting
+    so it follows changes like a new gpu or attention backend.
+    """
+
+    # of diffusers pipelines
+    default_steps = 50
+    default_strength = 0.8
+
+    class _Fit(TypedDict):
+        n: float
+        sx: float
+        sy: float
+        sxx: float
+        sxy: float
+
+    def __init__(self,
+                 initial_sec_per_work: float = 0.1,
+                 forgetting: float = 0.98,
+                 persist_path: Optional[str] = None
+                 ):
+        """
+        :param initial_sec_per_work: prior, seconds per 512x512 image step, used until there are measurements
+        :param forgetting: weight kept by older measurements on each new measurement
+        :param persist_path: json file to keep calibration across restarts
+        """
+        self.initial_sec_per_work = initial_sec_per_work
+        self.forgetting = forgetting
+        self.persist_path = Path(persist_path) if persist_path is not None else None
+
+        self.lock = threading.Lock()
+        self.fits: Dict[str, DiffusionCostModel._Fit] = {}
+
+        if self.persist_path is not None and self.persist_path.is_file():
+            self.fits = json.loads(self.persist_path.read_text(encoding='utf8'))
+            logger.info(f'loaded cost model calibration for {list(self.fits.keys())}')
+
+    @staticmethod
+    def scheduler_of(pipe: Any) -> str:
+        return type(pipe.scheduler).__name__
+
+    @staticmethod
+    def work_of(width: int, height: int, steps: int, image_count: int) -> float:
+        return (width * height / (512 * 512)) * steps * image_count
+
+    @staticmethod
+    def steps_run(steps: int, strength: Optional[float] = None) -> int:
+        """
+        :param strength: img2img strength, only that fraction of steps is run
+        :return: denoising steps the pipeline runs
+        """
+        return int(steps * strength) if strength is not None else steps
+
+    def _coefficients(self, scheduler: str) -> Tuple[float, float]:
+        fit = self.fits.get(scheduler)
+        if fit is None or fit['n'] < 1e-6:
+            return self.initial_sec_per_work, 0.0
+
+        n, sx, sy, sxx, sxy = fit['n'], fit['sx'], fit['sy'], fit['sxx'], fit['sxy']
+        denominator = n * sxx - sx * sx
+
+        # not enough spread in the measurements for a slope and an intercept
+        if n < 2 or denominator <= 1e-9 * max(1.0, n * sxx):
+            return (sy / sx if sx > 0 else self.initial_sec_per_work), 0.0
+
+        slope = (n * sxy - sx * sy) / denominator
+        intercept = (sy - slope * sx) / n
+
+        if slope <= 0:
+            return (sy / sx if sx > 0 else self.initial_sec_per_work), 0.0
+
+        return slope, max(0.0, intercept)
+
+    def predict(self, width: int, height: int, steps: int, image_count: int, scheduler: str) -> float:
+        with self.lock:
+            slope, intercept = self._coefficients(scheduler)
+        return slope * DiffusionCostModel.work_of(width, height, steps, image_count) + intercept
+
+    def observe(self, width: int, height: int, steps: int, image_count: int, scheduler: str, seconds: float):
+        x = DiffusionCostModel.work_of(width, height, steps, image_count)
+        if x <= 0 or seconds <= 0:
+            return
+
+        with self.lock:
+            fit = self.fits.get(scheduler, {"n": 0.0, "sx": 0.0, "sy": 0.0, "sxx": 0.0, "sxy": 0.0})
+            fit = {key: value * self.forgetting for key, value in fit.items()}
+            fit['n'] += 1
+            fit['sx'] += x
+            fit['sy'] += seconds
+            fit['sxx'] += x * x
+            fit['sxy'] += x * seconds
+            self.fits[scheduler] = fit
+
+            if self.persist_path is not None:
+                self.persist_path.parent.mkdir(parents=True, exist_ok=True)
+                temp_path = self.persist_path.with_suffix(self.persist_path.suffix + '.tmp')
+                temp_path.write_text(json.dumps(self.fits), encoding='utf8')
+                os.replace(temp_path, self.persist_path)
+
+    def observe_pipe_call(self, pipe: Any, proc_kwargs: Dict[str, Any], image_count: int, seconds: float,
+                          strength: Optional[float] = None):
+        """
+        :param proc_kwargs: kwargs given to the pipeline, missing or None values are pipeline defaults
+        :param strength: img2img strength, only that fraction of steps is run
+        """
+        def key_or_default(key, default):
+            return proc_kwargs[key] if proc_kwargs.get(key) is not None else default
+
+        steps = DiffusionCostModel.steps_run(
+            key_or_default('num_inference_steps', DiffusionCostModel.default_steps), strength
+        )
+
+        try:
+            self.observe(
+                width=key_or_default('width', 512),
+                height=key_or_default('height', 512),
+                steps=steps,
+                image_count=image_count,
+                scheduler=DiffusionCostModel.scheduler_of(pipe),
+                seconds=seconds
+            )
+        except Exception as ex:
+            logger.warning(f'failed to update cost model: {ex}')
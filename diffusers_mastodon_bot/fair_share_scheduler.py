@@ -0,0 +1,207 @@
+import collections
+import itertools
+import logging
+import math
+import threading
+import time
+from typing import *
+
+
+logger = logging.getLogger(__name__)
+
+
+class FairShareScheduler:
+    """
+    per-account job scheduler.
+
+    - pending jobs are kept per account, and the next job comes from the account
+      with the fewest running jobs, then the least (decayed) gpu-seconds used divided by its weight.
+      (weighted fair queuing)
+    - per-account token buckets limit how many images an account can request over time.
+    - deferred jobs go to a low priority lane, which is served only when no regular job is pending.
+    """
+
+    def __init__(self,
+                 max_size: int = 16,
+                 account_weights: Optional[Dict[str, float]] = None,
+                 usage_half_life_sec: float = 60 * 60,
+                 rate_limit_burst: Optional[float] = None,
+                 rate_limit_per_hour: Optional[float] = None,
+                 ):
+        """
+        :param max_size: max pending jobs over all accounts
+        :param account_weights: acct -> weight, 1.0 if not listed. higher weight gets more gpu share.
+        :param usage_half_life_sec: how fast past gpu usage is forgotten
+        :param rate_limit_burst: token bucket size per account (in images), None to disable rate limiting
+        :param rate_limit_per_hour: token refill rate per account (in images per hour)
+        """
+        self.max_size = max(1, max_size)
+        self.account_weights = account_weights if account_weights is not None else {}
+        self.usage_half_life_sec = usage_half_life_sec
+        self.rate_limit_burst = rate_limit_burst
+        self.rate_limit_per_sec = rate_limit_per_hour / 3600 if rate_limit_per_hour is not None else None
+
+        self.condition = threading.Condition()
+        self.sequence = itertools.count()
+        self.size = 0
+
+        # acct -> deque of (sequence, item)
+        self.pending: Dict[str, Deque[Tuple[int, Any]]] = {}
+        # same, for deferred jobs
+        self.deferred: Dict[str, Deque[Tuple[int, Any]]] = {}
+        # acct -> running job count
+        self.running: Dict[str, int] = collections.defaultdict(int)
+        # acct -> (gpu seconds, updated at)
+        self.usage: Dict[str, Tuple[float, float]] = {}
+        # acct -> (tokens, updated at)
+        self.buckets: Dict[str, Tuple[float, float]] = {}
+
+    def weight_of(self, account: str) -> float:
+        return float(self.account_weights.get(account, 1.0))
+
+    def _decayed_usage(self, account: str, now: float) -> float:
+        if account not in self.usage:
+            return 0.0
+        gpu_seconds, updated_at = self.usage[account]
+        return gpu_seconds * math.pow(0.5, (now - updated_at) / self.usage_half_life_sec)
+
+    def finish(self, account: str, gpu_seconds: float):
+        """
+        call when a job taken by `get` is done.
+        """
+        now = time.time()
+        with self.condition:
+            self.running[account] -= 1
+            if self.running[account] <= 0:
+                del self.running[account]
+
+            self.usage[account] = (self._decayed_usage(account, now) + gpu_seconds, now)
+
+            # forget accounts whose usage decayed away
+            if len(self.usage) > 1024:
+                for stale_account in [acct for acct in self.usage.keys() if self._decayed_usage(acct, now) < 1.0]:
+                    del self.usage[stale_account]
+
+    def try_admit(self, account: str, cost: float) -> Tuple[bool, float]:
+        """
+        takes `cost` tokens from the account's bucket.
+        :return: (admitted, estimated seconds to wait until it would be admitted)
+        """
+        if self.rate_limit_burst is None or self.rate_limit_per_sec is None or cost <= 0:
+            return True, 0.0
+
+        # a request bigger than the bucket would never pass
+        cost = min(cost, self.rate_limit_burst)
+        now = time.time()
+
+        with self.condition:
+            tokens, updated_at = self.buckets.get(account, (self.rate_limit_burst, now))
+            tokens = min(self.rate_limit_burst, tokens + (now - updated_at) * self.rate_limit_per_sec)
+
+            if tokens < cost:
+                self.buckets[account] = (tokens, now)
+                return False, (cost - tokens) / self.rate_limit_per_sec
+
+            self.buckets[account] = (tokens - cost, now)
+
+            # full buckets carry no information
+            if len(self.buckets) > 1024:
+                refill_sec = self.rate_limit_burst / self.rate_limit_per_sec
+                for stale_account in [acct for acct, (_, at) in self.buckets.items() if now - at > refill_sec]:
+                    del self.buckets[stale_account]
+
+        return True, 0.0
+
+    def refund(self, account: str, cost: float):
+        """
+        gives back tokens taken by `try_admit`, for jobs that are admitted but not queued after all.
+        """
+        if self.rate_limit_burst is None or self.rate_limit_per_sec is None or cost <= 0:
+            return
+
+        cost = min(cost, self.rate_limit_burst)
+        now = time.time()
+
+        with self.condition:
+            if account not in self.buckets:
+                # forgotten buckets are full
+                return
+            tokens, updated_at = self.buckets[account]
+            tokens = min(self.rate_limit_burst, tokens + (now - updated_at) * self.rate_limit_per_sec + cost)
+            self.buckets[account] = (tokens, now)
+
+    def try_put(self, account: str, item: Any, deferred: bool = False) -> bool:
+        """
+        :param deferred: put into the low priority lane
+        :return: False if the scheduler is full, never blocks
+        """
+        with self.condition:
+            if self.size >= self.max_size:
+                return False
+            self._put(account, item, deferred)
+        return True
+
+    def put(self, account: str, item: Any, deferred: bool = False):
+        """
+        enqueue regardless of max_size, for already accepted jobs
+        """
+        with self.condition:
+            self._put(account, item, deferred)
+
+    def _put(self, account: str, item: Any, deferred: bool):
+        lane = self.deferred if deferred else self.pending
+        if account not in lane:
+            lane[account] = collections.deque()
+        lane[account].append((next(self.sequence), item))
+        self.size += 1
+        self.condition.notify()
+
+    def remove(self, account: str, item: Any) -> bool:
+        """
+        :return: True if the item was pending and is removed, False if it is already taken by `get`
+        """
+        with self.condition:
+            for lane in [self.pending, self.deferred]:
+                if account not in lane:
+                    continue
+                for entry in lane[account]:
+                    if entry[1] is item:
+                        lane[account].remove(entry)
+                        if len(lane[account]) == 0:
+                            del lane[account]
+                        self.size -= 1
+                        return True
+        return False
+
+    def get(self) -> Tuple[str, Any]:
+        """
+        blocks until a job is available. `finish` should be called with the account after the job.
+        :return: (account, job)
+        """
+        with self.condition:
+            while self.size == 0:
+                self.condition.wait()
+
+            lane = self.pending if len(self.pending) > 0 else self.deferred
+
+            now = time.time()
+            account = min(
+                lane.keys(),
+                key=lambda acct: (
+                    self.running.get(acct, 0),
+                    self._decayed_usage(acct, now) / self.weight_of(acct),
+                    lane[acct][0][0]
+                )
+            )
+
+            _, item = lane[account].popleft()
+            if len(lane[account]) == 0:
+                del lane[account]
+            self.size -= 1
+            self.running[account] += 1
+
+            return account, item
+
+    def qsize(self) -> int:
+        with self.condition:
+            return self.size
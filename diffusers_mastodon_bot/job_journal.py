@@ -0,0 +1,123 @@
+import dataclasses
+import json
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import *
+
+from diffusers_mastodon_bot.bot_request_handlers.bot_request_handler import BotRequestHandler
+from diffusers_mastodon_bot.bot_request_handlers.proc_args_context import ProcArgsContext
+
+
+logger = logging.getLogger(__name__)
+
+
+class JobJournal:
+    """
+    on-disk (sqlite) record of accepted jobs, so queued and running jobs survive a restart.
+    """
+
+    class Entry(TypedDict):
+        id: int
+        status_id: str
+        handler_name: str
+        args_ctx: ProcArgsContext
+        state: str
+        created_at: float
+        # times the job was resumed after it had been running, i.e. the bot went down while running it
+        attempts: int
+
+    STATE_QUEUED = 'queued'
+    STATE_RUNNING = 'running'
+    STATE_DONE = 'done'
+    STATE_FAILED = 'failed'
+    STATE_REJECTED = 'rejected'
+    STATE_DROPPED = 'dropped'
+    STATE_CANCELLED = 'cancelled'
+
+    def __init__(self, path: str):
+        self.path = path
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                '  id INTEGER PRIMARY KEY AUTOINCREMENT,'
+                '  status_id TEXT NOT NULL,'
+                '  handler_name TEXT NOT NULL,'
+                '  args_json TEXT NOT NULL,'
+                '  state TEXT NOT NULL,'
+                '  created_at REAL NOT NULL,'
+                '  updated_at REAL NOT NULL,'
+                '  attempts INTEGER NOT NULL DEFAULT 0'
+                ')'
+            )
+            # recovery reads only unfinished rows, in arrival order
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS jobs_unfinished ON jobs (id) '
+                f"WHERE state IN ('{JobJournal.STATE_QUEUED}', '{JobJournal.STATE_RUNNING}')"
+            )
+
+    @staticmethod
+    def handler_name(handler: BotRequestHandler) -> str:
+        return f'{type(handler).__name__}:{getattr(handler, "tag_name", "")}'
+
+    def add(self, status_id: Any, handler: BotRequestHandler, args_ctx: ProcArgsContext) -> int:
+        now = time.time()
+        args_json = json.dumps(dataclasses.asdict(args_ctx), ensure_ascii=False)
+
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                'INSERT INTO jobs (status_id, handler_name, args_json, state, created_at, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (str(status_id), JobJournal.handler_name(handler), args_json, JobJournal.STATE_QUEUED, now, now)
+            )
+            return cursor.lastrowid
+
+    def set_state(self, job_id: int, state: str):
+        with self.lock, self.connection:
+            self.connection.execute(
+                'UPDATE jobs SET state = ?, updated_at = ? WHERE id = ?',
+                (state, time.time(), job_id)
+            )
+
+    def add_attempt(self, job_id: int) -> int:
+        """
+        :return: attempts of the job, after counting this one
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                'UPDATE jobs SET attempts = attempts + 1, updated_at = ? WHERE id = ?',
+                (time.time(), job_id)
+            )
+            row = self.connection.execute('SELECT attempts FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def unfinished(self) -> List[Entry]:
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT id, status_id, handler_name, args_json, state, created_at, attempts FROM jobs '
+                f"WHERE state IN ('{JobJournal.STATE_QUEUED}', '{JobJournal.STATE_RUNNING}') "
+                'ORDER BY id'
+            ).fetchall()
+
+        entries: List[JobJournal.Entry] = []
+        for job_id, status_id, handler_name, args_json, state, created_at, attempts in rows:
+            entries.append({
+                "id": job_id,
+                "status_id": status_id,
+                "handler_name": handler_name,
+                "args_ctx": ProcArgsContext(**json.loads(args_json)),
+                "state": state,
+                "created_at": created_at,
+                "attempts": attempts,
+            })
+
+        return entries
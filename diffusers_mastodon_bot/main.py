@@ -1,5 +1,6 @@
 import logging
 import sys
+import time
 from pathlib import Path
 from typing import *
 import json
@@ -14,6 +15,8 @@ from pyChatGPT import ChatGPT
 from pbwrap import Pastebin
 
 from diffusers_mastodon_bot.app_stream_listener import AppStreamListener
+from diffusers_mastodon_bot.pipeline_pool import PipelinePool, PipelineWorker
+from diffusers_mastodon_bot.text_embedding_cache import TextEmbeddingCache
 from diffusers_mastodon_bot.bot_request_handlers.bot_request_handler import BotRequestHandler
 from diffusers_mastodon_bot.bot_request_handlers.game.diffuse_game_handler import DiffuseGameHandler
 from diffusers_mastodon_bot.bot_request_handlers.diffuse_me_handler import DiffuseMeHandler
@@ -24,6 +27,8 @@ from diffusers_mastodon_bot.community_pipeline.lpw_stable_diffusion \
 
 logger = logging.getLogger(__name__)
 
+stream_reconnect_delay_sec = 10
+
 def create_diffusers_pipeline(device_name='cuda', pipe_kwargs: Optional[Dict[str, Any]] = None):
     if pipe_kwargs is None:
         pipe_kwargs = {}
@@ -42,12 +47,22 @@ def create_diffusers_pipeline(device_name='cuda', pipe_kwargs: Optional[Dict[str
     model_name_or_path = pipe_kwargs['pretrained_model_name_or_path']
     del pipe_kwargs['pretrained_model_name_or_path']
 
+    # 0 to disable
+    text_embedding_cache_mb = pipe_kwargs.pop('text_embedding_cache_mb', 256)
+    # 'cpu' to keep cached embeddings off the gpu
+    text_embedding_cache_device = pipe_kwargs.pop('text_embedding_cache_device', None)
+    # tokenizes weighted prompt fragments with CLIPTokenizerFast, ids may rarely differ from the slow one
+    fast_tokenizer = pipe_kwargs.pop('fast_tokenizer', False)
+    # memory ceiling of vae decoding, decodes in slices or tiles to stay under it. None to decode the batch at once
+    vae_decode_memory_mb = pipe_kwargs.pop('vae_decode_memory_mb', None)
+
     torch_dtype = torch.float32
     if 'torch_dtype' in pipe_kwargs:
         dtype_param = pipe_kwargs['torch_dtype']
         del pipe_kwargs['torch_dtype']
 
-        if dtype_param == 'torch.float16':
+        # fp16 is too slow or unsupported on cpu
+        if dtype_param == 'torch.float16' and device_name.startswith('cuda'):
             torch_dtype = torch.float16
 
     if 'scheduler' in pipe_kwargs:
@@ -76,7 +91,19 @@ def create_diffusers_pipeline(device_name='cuda', pipe_kwargs: Optional[Dict[str
     pipe = pipe.to(device_name)
     pipe.enable_attention_slicing()
 
-    if is_xformers_available():
+    if fast_tokenizer:
+        from transformers import CLIPTokenizerFast
+        pipe.fragment_tokenizer = CLIPTokenizerFast.from_pretrained(model_name_or_path, subfolder="tokenizer")
+
+    pipe.vae_decode_memory_mb = vae_decode_memory_mb
+
+    if text_embedding_cache_mb > 0:
+        pipe.text_embedding_cache = TextEmbeddingCache(
+            max_bytes=int(text_embedding_cache_mb * 1024 * 1024),
+            storage_device=text_embedding_cache_device,
+        )
+
+    if is_xformers_available() and device_name.startswith('cuda'):
         try:
             pipe.unet.enable_xformers_memory_efficient_attention(True)
         except Exception as e:
@@ -92,6 +119,37 @@ def create_diffusers_pipeline(device_name='cuda', pipe_kwargs: Optional[Dict[str
     return pipe, pipe_kwargs
 
 
+def create_pipeline_pool(device_names: List[str], pipe_kwargs: Optional[Dict[str, Any]] = None,
+                         concurrency_per_device: int = 1):
+    """
+    loads a pipeline per device. devices failing to load are skipped, and cpu is used when none is left.
+    :param concurrency_per_device: pipeline calls running at once on a device
+    :return: pool, normalized pipe_kwargs (of the first worker)
+    """
+    workers: List[PipelineWorker] = []
+    result_pipe_kwargs = None
+
+    for device_name in device_names:
+        try:
+            pipe, worker_pipe_kwargs = create_diffusers_pipeline(device_name, pipe_kwargs)
+        except Exception as ex:
+            logger.error(f'failed to load pipeline on {device_name}, skipping: {ex}')
+            continue
+
+        workers.append(PipelineWorker(str(len(workers)), device_name, pipe, concurrency=concurrency_per_device))
+        if result_pipe_kwargs is None:
+            result_pipe_kwargs = worker_pipe_kwargs
+
+    if len(workers) == 0:
+        logger.warning('no pipeline could be loaded on given devices, falling back to cpu')
+        pipe, result_pipe_kwargs = create_diffusers_pipeline('cpu', pipe_kwargs)
+        workers.append(PipelineWorker('0', 'cpu', pipe, concurrency=concurrency_per_device))
+
+    logger.info(f'pipeline workers: {[(worker.name, worker.device_name, worker.concurrency) for worker in workers]}')
+
+    return PipelinePool(workers), result_pipe_kwargs
+
+
 def read_text_file(filename: str) -> Union[str, None]:
     path = Path(filename)
     if not Path(filename).is_file():
@@ -161,9 +219,23 @@ def main():
     logger.info(f'you are, acct: {my_acct} / url: {my_url}')
 
     logger.info('loading model')
-    device_name = 'cuda'
+    device_names = ['cuda'] if torch.cuda.is_available() else ['cpu']
+    if pipe_kwargs is not None and 'devices' in pipe_kwargs:
+        pipe_kwargs = pipe_kwargs.copy()
+        device_names = pipe_kwargs['devices']
+        del pipe_kwargs['devices']
+
+    concurrency_per_device = 1
+    if pipe_kwargs is not None and 'concurrency_per_device' in pipe_kwargs:
+        pipe_kwargs = pipe_kwargs.copy()
+        concurrency_per_device = int(pipe_kwargs['concurrency_per_device'])
+        del pipe_kwargs['concurrency_per_device']
 
-    pipe, pipe_kwargs = create_diffusers_pipeline(device_name, pipe_kwargs)
+    pipeline_pool, pipe_kwargs = create_pipeline_pool(device_names, pipe_kwargs, concurrency_per_device)
+
+    # handlers hold the first one, DiffusionRunner spreads the work across the pool
+    pipe = pipeline_pool.primary.pipe
+    device_name = pipeline_pool.primary.device_name
 
     logger.info('creating handlers')
 
@@ -200,10 +272,21 @@ def main():
                                  device=device_name,
                                  proc_kwargs=proc_kwargs,
                                  pipe_kwargs=pipe_kwargs,
+                                 pipeline_pool=pipeline_pool,
                                  **app_stream_listener_kwargs
                                  )
 
-    mastodon.stream_user(listener, run_async=False, timeout=10000)
+    listener.resume_journaled_jobs()
+
+    while True:
+        listener.catch_up_notifications()
+
+        try:
+            mastodon.stream_user(listener, run_async=False, timeout=10000)
+            logger.warning('stream closed, reconnecting')
+        except Exception as ex:
+            logger.warning(f'stream disconnected, reconnecting in {stream_reconnect_delay_sec}s: {ex}')
+            time.sleep(stream_reconnect_delay_sec)
 
 
 if __name__ == '__main__':
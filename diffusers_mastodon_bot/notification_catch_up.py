@@ -0,0 +1,104 @@
+import collections
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import *
+
+from mastodon import Mastodon
+
+
+logger = logging.getLogger(__name__)
+
+
+class NotificationCatchUp:
+    """
+    remembers the last processed notification id on disk,
+    and replays notifications missed while the stream was not connected.
+    """
+
+    def __init__(self,
+                 mastodon: Mastodon,
+                 state_path: str,
+                 page_size: int = 80,
+                 seen_index_size: int = 4096
+                 ):
+        """
+        :param mastodon: client
+        :param state_path: text file to store the last processed notification id
+        :param page_size: notifications per request. 80 is the maximum of mastodon api.
+        :param seen_index_size: how many recent notification ids to remember for duplicate suppression
+        """
+        self.mastodon = mastodon
+        self.state_path = Path(state_path)
+        self.page_size = page_size
+        self.seen_index_size = seen_index_size
+
+        self.lock = threading.Lock()
+        self.seen_ids: collections.OrderedDict = collections.OrderedDict()
+
+        self.last_id: Optional[int] = None
+        if self.state_path.is_file():
+            content = self.state_path.read_text(encoding='utf8').strip()
+            if len(content) > 0:
+                self.last_id = int(content)
+
+    def mark_seen(self, notification_id: Any) -> bool:
+        """
+        :return: False if the notification was already seen (duplicate)
+        """
+        notification_id = int(notification_id)
+
+        with self.lock:
+            if notification_id in self.seen_ids:
+                return False
+
+            self.seen_ids[notification_id] = True
+            if len(self.seen_ids) > self.seen_index_size:
+                self.seen_ids.popitem(last=False)
+
+            if self.last_id is None or notification_id > self.last_id:
+                self.last_id = notification_id
+                self._write_last_id()
+
+        return True
+
+    def _write_last_id(self):
+        self.state_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.state_path.with_suffix(self.state_path.suffix + '.tmp')
+        temp_path.write_text(str(self.last_id), encoding='utf8')
+        os.replace(temp_path, self.state_path)
+
+    def catch_up(self, dispatch: Callable[[Dict[str, Any]], None]):
+        """
+        pages through notifications newer than the last processed one, oldest first.
+        :param dispatch: same callback as the stream uses, e.g. listener.on_notification.
+            notifications are marked seen before it returns, so it should not drop them (e.g. on a full queue)
+        """
+        if self.last_id is None:
+            # first run: do not replay the whole history, just remember where we are
+            newest = self.mastodon.notifications(limit=1)
+            if len(newest) > 0:
+                self.mark_seen(newest[0]['id'])
+            logger.info(f'no notification checkpoint, starting from {self.last_id}')
+            return
+
+        logger.info(f'catching up notifications after {self.last_id}')
+
+        cursor = self.last_id
+        caught_up_count = 0
+
+        while True:
+            # min_id returns the page right after the cursor, so pages can be walked oldest first
+            page = self.mastodon.notifications(min_id=cursor, limit=self.page_size)
+            if len(page) == 0:
+                break
+
+            page = sorted(page, key=lambda notification: int(notification['id']))
+            for notification in page:
+                dispatch(notification)
+
+            caught_up_count += len(page)
+            cursor = int(page[-1]['id'])
+
+        logger.info(f'caught up {caught_up_count} notifications')
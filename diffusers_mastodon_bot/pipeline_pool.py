@@ -0,0 +1,121 @@
+import contextlib
+import logging
+import threading
+import time
+from typing import *
+
+from diffusers_mastodon_bot.bot_request_handlers.diffusion_batcher import DiffusionBatcher
+from diffusers_mastodon_bot.bot_request_handlers.request_cancelled_error import RequestCancelledError
+from diffusers_mastodon_bot.community_pipeline.lpw_stable_diffusion \
+    import StableDiffusionLongPromptWeightingPipeline as StableDiffusionLpw
+
+
+logger = logging.getLogger(__name__)
+
+
+class PipelineWorker:
+    """
+    a pipeline loaded on one device, with its own lock and batcher.
+    """
+
+    def __init__(self, name: str, device_name: str, pipe: StableDiffusionLpw, concurrency: int = 1):
+        """
+        :param concurrency: pipeline calls running at once on this worker, sharing the loaded weights
+        """
+        self.name = name
+        self.device_name = device_name
+        self.pipe = pipe
+        self.concurrency = max(1, concurrency)
+
+        # pipeline calls of the lpw pipeline work on their own scheduler copy, so more than one can run at a time.
+        # one call at a time is usually the fastest on a gpu.
+        self.lock: Union[threading.RLock, threading.BoundedSemaphore] = \
+            threading.RLock() if self.concurrency == 1 else threading.BoundedSemaphore(self.concurrency)
+        # set by the listener, text2img of this worker goes through it
+        self.batcher: Optional[DiffusionBatcher] = None
+
+        # images checked out and not finished yet
+        self.load = 0
+        self.consecutive_failures = 0
+        self.isolated_until = 0.0
+
+    def is_healthy(self, now: float) -> bool:
+        return now >= self.isolated_until
+
+
+class PipelinePool:
+    """
+    dispatches diffusion work to the least loaded pipeline worker.
+    a worker failing repeatedly is isolated for a while, others keep serving.
+    """
+
+    def __init__(self,
+                 workers: List[PipelineWorker],
+                 failure_threshold: int = 3,
+                 isolation_sec: float = 5 * 60
+                 ):
+        """
+        :param workers: at least one
+        :param failure_threshold: consecutive failures before isolating a worker
+        :param isolation_sec: how long an isolated worker gets no work
+        """
+        if len(workers) == 0:
+            raise ValueError('pipeline pool needs at least one worker')
+
+        self.workers = workers
+        self.failure_threshold = failure_threshold
+        self.isolation_sec = isolation_sec
+
+        self.lock = threading.Lock()
+
+    @property
+    def primary(self) -> PipelineWorker:
+        return self.workers[0]
+
+    def worker_of(self, pipe: Any) -> Optional[PipelineWorker]:
+        for worker in self.workers:
+            if worker.pipe is pipe:
+                return worker
+        return None
+
+    def _pick(self) -> PipelineWorker:
+        now = time.time()
+        healthy_workers = [worker for worker in self.workers if worker.is_healthy(now)]
+        if len(healthy_workers) == 0:
+            # everyone is isolated, try the one which would come back first rather than failing the job
+            return min(self.workers, key=lambda worker: worker.isolated_until)
+
+        # index breaks ties, so the first (usually fastest) device is preferred
+        return min(healthy_workers, key=lambda worker: (worker.load, self.workers.index(worker)))
+
+    @contextlib.contextmanager
+    def checkout(self, image_count: int = 1) -> Iterator[PipelineWorker]:
+        """
+        with pool.checkout(4) as worker:
+            worker.pipe.text2img(...)
+
+        exceptions other than cancellation count as failures of the worker.
+        """
+        with self.lock:
+            worker = self._pick()
+            worker.load += image_count
+
+        try:
+            yield worker
+        except RequestCancelledError:
+            raise
+        except Exception:
+            with self.lock:
+                worker.consecutive_failures += 1
+                if worker.consecutive_failures >= self.failure_threshold:
+                    worker.isolated_until = time.time() + self.isolation_sec
+                    worker.consecutive_failures = 0
+                    logger.error(f'pipeline worker {worker.name} ({worker.device_name}) failed repeatedly, '
+                                 f'isolating for {self.isolation_sec}s')
+            raise
+        else:
+            with self.lock:
+                worker.consecutive_failures = 0
+        finally:
+            with self.lock:
+                worker.load -= image_count
@@ -0,0 +1,96 @@
+import logging
+import threading
+from typing import *
+
+import torch
+
+from diffusers_mastodon_bot.community_pipeline.lpw_stable_diffusion import get_weighted_text_embeddings
+
+
+logger = logging.getLogger(__name__)
+
+
+class ResidentNegativeEmbeddings:
+    """
+    uncond embeddings of frequently used negative prompts ("" and the default negative prompt),
+    encoded once and kept on the pipeline device.
+    consulted by `_encode_prompt` of the lpw pipeline through `pipe.resident_negative_embeddings`,
+    which expands them to the batch instead of encoding and repeating.
+
+    rebuilt when the text encoder or tokenizer of the pipeline is replaced, or `set_texts` is called.
+    """
+
+    class Entry(TypedDict):
+        # multiples the text needs by itself
+        needed_multiples: int
+        # effective max_embeddings_multiples of the batch -> (1, seq_len, dim)
+        embeddings: Dict[int, torch.Tensor]
+
+    def __init__(self, texts: List[str], max_embeddings_multiples: int = 3):
+        """
+        :param texts: negative prompts to keep, as they are given to the pipeline
+        :param max_embeddings_multiples: same as the pipeline call, entries are not used for other values
+        """
+        self.texts = list(dict.fromkeys(texts))
+        self.max_embeddings_multiples = max_embeddings_multiples
+
+        self.lock = threading.Lock()
+        self.model_key: Optional[Tuple] = None
+        self.entries: Dict[str, ResidentNegativeEmbeddings.Entry] = {}
+
+    @staticmethod
+    def model_key_of(pipe: Any) -> Tuple:
+        return id(pipe.text_encoder), id(pipe.tokenizer), str(pipe.device)
+
+    def set_texts(self, texts: List[str]):
+        with self.lock:
+            self.texts = list(dict.fromkeys(texts))
+            self.model_key = None
+
+    def warm_up(self, pipe: Any):
+        """
+        builds now instead of on the first use.
+        call with the pipeline lock held, and under autocast if the pipeline runs with it.
+        """
+        with self.lock:
+            self._build(pipe)
+
+    @torch.no_grad()
+    def _build(self, pipe: Any):
+        entries = {}
+        chunk_length = pipe.tokenizer.model_max_length
+
+        for text in self.texts:
+            embeddings = {}
+            needed_multiples = None
+            for multiples in range(1, self.max_embeddings_multiples + 1):
+                # the text alone decides the smallest multiples, larger ones are padded further
+                embedding, _ = get_weighted_text_embeddings(
+                    pipe=pipe,
+                    prompt=text,
+                    max_embeddings_multiples=self.max_embeddings_multiples,
+                    min_embeddings_multiples=multiples,
+                )
+                actual_multiples = embedding.shape[1] // chunk_length
+                if needed_multiples is None:
+                    needed_multiples = actual_multiples
+                embeddings[actual_multiples] = embedding
+
+            entries[text] = {"needed_multiples": needed_multiples, "embeddings": embeddings}
+
+        self.entries = entries
+        self.model_key = ResidentNegativeEmbeddings.model_key_of(pipe)
+        logger.info(f'built resident negative embeddings for {len(entries)} prompts')
+
+    def get(self, pipe: Any, text: str, max_embeddings_multiples: int) -> Optional[Entry]:
+        if max_embeddings_multiples != self.max_embeddings_multiples:
+            return None
+
+        with self.lock:
+            if text not in self.texts:
+                return None
+
+            if self.model_key != ResidentNegativeEmbeddings.model_key_of(pipe):
+                self._build(pipe)
+
+            return self.entries.get(text)
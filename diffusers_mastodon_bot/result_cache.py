@@ -0,0 +1,149 @@
+import collections
+import hashlib
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import *
+
+
+logger = logging.getLogger(__name__)
+
+
+class ResultCache:
+    """
+    disk cache of generated images as png bytes, addressed by everything which decides the image:
+    model, scheduler, prompts, seed, size, steps and guidance scale.
+    a repeated request with the same seed is served from here without touching the gpu.
+
+    least recently used files are deleted over the byte budget.
+    """
+
+    class Stats(TypedDict):
+        entries: int
+        bytes: int
+        hits: int
+        misses: int
+        evictions: int
+
+    def __init__(self, path: str, max_bytes: int = 512 * 1024 * 1024):
+        """
+        :param path: directory to keep png files in, created if missing
+        :param max_bytes: byte budget of stored files
+        """
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+
+        self.lock = threading.Lock()
+        # digest -> file size, oldest first
+        self.entries: collections.OrderedDict = collections.OrderedDict()
+        self.total_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        for file in sorted(self.path.glob('*.png'), key=lambda file: file.stat().st_mtime):
+            size = file.stat().st_size
+            self.entries[file.stem] = size
+            self.total_bytes += size
+
+        logger.info(f'result cache: {len(self.entries)} files, {self.total_bytes} bytes')
+
+    @staticmethod
+    def key_of(pipe: Any, positive: str, negative: Optional[str], seed: int,
+               width: Optional[int], height: Optional[int],
+               num_inference_steps: Optional[int], guidance_scale: Optional[float]) -> str:
+        """
+        :return: hex digest, None values are pipeline defaults
+        """
+        key = {
+            "model": getattr(pipe.unet.config, '_name_or_path', ''),
+            "scheduler": type(pipe.scheduler).__name__,
+            "positive": positive,
+            "negative": negative if negative is not None else '',
+            "seed": seed,
+            "width": width,
+            "height": height,
+            "num_inference_steps": num_inference_steps,
+            "guidance_scale": guidance_scale,
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True, ensure_ascii=False).encode('utf8')).hexdigest()
+
+    @staticmethod
+    def seed_of(positive: str, negative: Optional[str]) -> int:
+        """
+        stable seed of prompts, for requests without a seed which should still hit the cache on repeats.
+        """
+        text = json.dumps([positive, negative if negative is not None else ''], ensure_ascii=False)
+        return int.from_bytes(hashlib.sha256(text.encode('utf8')).digest()[:4], 'big')
+
+    def _file_of(self, digest: str) -> Path:
+        return self.path / f'{digest}.png'
+
+    def get(self, digest: str) -> Optional[bytes]:
+        with self.lock:
+            if digest not in self.entries:
+                self.misses += 1
+                return None
+
+            try:
+                data = self._file_of(digest).read_bytes()
+            except OSError as ex:
+                logger.warning(f'can not read cached result {digest}: {ex}')
+                self.total_bytes -= self.entries.pop(digest)
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(digest)
+
+        # keeps lru order across restarts
+        try:
+            os.utime(self._file_of(digest))
+        except OSError:
+            pass
+
+        return data
+
+    def put(self, digest: str, png_bytes: bytes):
+        if len(png_bytes) > self.max_bytes:
+            return
+
+        file = self._file_of(digest)
+        temp_file = file.with_suffix('.tmp')
+
+        with self.lock:
+            try:
+                temp_file.write_bytes(png_bytes)
+                os.replace(temp_file, file)
+            except OSError as ex:
+                logger.warning(f'can not write cached result {digest}: {ex}')
+                return
+
+            if digest in self.entries:
+                self.total_bytes -= self.entries.pop(digest)
+
+            self.entries[digest] = len(png_bytes)
+            self.total_bytes += len(png_bytes)
+
+            while self.total_bytes > self.max_bytes:
+                evicted, size = self.entries.popitem(last=False)
+                self.total_bytes -= size
+                self.evictions += 1
+                try:
+                    self._file_of(evicted).unlink()
+                except OSError:
+                    pass
+
+    def stats(self) -> Stats:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,120 @@
+import collections
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import *
+
+
+logger = logging.getLogger(__name__)
+
+
+class StatusDedupeIndex:
+    """
+    bounded set of recently handled status ids, so one toot is never processed twice.
+    entries are dropped when over capacity (oldest first) or older than ttl.
+    optionally backed by an append-only file, compacted on load.
+    """
+
+    class Stats(TypedDict):
+        size: int
+        hits: int
+        misses: int
+        evictions: int
+
+    def __init__(self,
+                 capacity: int = 8192,
+                 ttl_sec: Optional[float] = 60 * 60 * 24,
+                 persist_path: Optional[str] = None
+                 ):
+        self.capacity = max(1, capacity)
+        self.ttl_sec = ttl_sec
+        self.persist_path = Path(persist_path) if persist_path is not None else None
+
+        self.lock = threading.Lock()
+        # status id -> first seen time. insertion order is age order, as hits do not refresh entries.
+        self.entries: collections.OrderedDict = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.persisted_line_count = 0
+
+        if self.persist_path is not None:
+            self._load()
+
+    def check_and_add(self, status_id: Any) -> bool:
+        """
+        :return: True if the status is new, False if it is a duplicate
+        """
+        status_id = int(status_id)
+        now = time.time()
+
+        with self.lock:
+            self._evict_expired(now)
+
+            if status_id in self.entries:
+                self.hits += 1
+                return False
+
+            self.misses += 1
+            self.entries[status_id] = now
+            if len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+            if self.persist_path is not None:
+                if self.persisted_line_count >= self.capacity * 2:
+                    self._compact()
+                else:
+                    with self.persist_path.open('a', encoding='utf8') as f:
+                        f.write(f'{status_id} {now}\n')
+                    self.persisted_line_count += 1
+
+        return True
+
+    def stats(self) -> Stats:
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _evict_expired(self, now: float):
+        if self.ttl_sec is None:
+            return
+
+        while len(self.entries) > 0:
+            oldest_id, seen_at = next(iter(self.entries.items()))
+            if now - seen_at <= self.ttl_sec:
+                break
+            del self.entries[oldest_id]
+            self.evictions += 1
+
+    def _load(self):
+        self.persist_path.parent.mkdir(parents=True, exist_ok=True)
+
+        if self.persist_path.is_file():
+            for line in self.persist_path.read_text(encoding='utf8').splitlines():
+                parts = line.split(' ')
+                if len(parts) != 2:
+                    continue
+                self.entries[int(parts[0])] = float(parts[1])
+
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+            self._evict_expired(time.time())
+
+        self._compact()
+
+        logger.info(f'loaded {len(self.entries)} seen status ids')
+
+    def _compact(self):
+        self.persist_path.write_text(
+            ''.join(f'{status_id} {seen_at}\n' for status_id, seen_at in self.entries.items()),
+            encoding='utf8'
+        )
+        self.persisted_line_count = len(self.entries)
@@ -0,0 +1,117 @@
+import collections
+import logging
+import threading
+from typing import *
+
+import torch
+
+
+logger = logging.getLogger(__name__)
+
+
+class TextEmbeddingCache:
+    """
+    lru cache of weighted text embeddings, one row (seq_len, dim) per prompt text.
+    consulted by get_weighted_text_embeddings of the lpw pipeline through `pipe.text_embedding_cache`.
+
+    the text encoder sees each row independently, so a row can be reused in any batch
+    which ends up with the same max_embeddings_multiples.
+    """
+
+    class Stats(TypedDict):
+        entries: int
+        bytes: int
+        hits: int
+        misses: int
+        evictions: int
+
+    def __init__(self,
+                 max_bytes: int = 256 * 1024 * 1024,
+                 storage_device: Optional[str] = None,
+                 log_every: int = 200
+                 ):
+        """
+        :param max_bytes: byte budget of stored embeddings
+        :param storage_device: 'cpu' to keep embeddings in host memory, None to keep them on the pipeline device
+        :param log_every: log stats every this many lookups, 0 to disable
+        """
+        self.max_bytes = max_bytes
+        self.storage_device = storage_device
+        self.log_every = log_every
+
+        self.lock = threading.Lock()
+        self.entries: collections.OrderedDict = collections.OrderedDict()
+        self.total_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key_of(pipe: Any, text: str, *options: Any) -> Tuple:
+        # id() keeps two loaded copies of one model (e.g. on two devices) apart
+        model_id = (getattr(pipe.text_encoder.config, '_name_or_path', ''), id(pipe.text_encoder))
+        return (model_id, text) + tuple(options)
+
+    def get(self, key: Tuple, device: torch.device) -> Optional[torch.Tensor]:
+        with self.lock:
+            embedding = self.entries.get(key)
+            if embedding is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            self._maybe_log()
+
+        if embedding is None:
+            return None
+        return embedding.to(device, non_blocking=True)
+
+    def put(self, key: Tuple, embedding: torch.Tensor):
+        embedding = embedding.detach()
+        if self.storage_device is not None:
+            embedding = embedding.to(self.storage_device)
+        # do not keep the whole batch alive through a view
+        embedding = embedding.clone()
+
+        size = embedding.element_size() * embedding.nelement()
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self._size_of(self.entries.pop(key))
+
+            self.entries[key] = embedding
+            self.total_bytes += size
+
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= self._size_of(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def stats(self) -> Stats:
+        with self.lock:
+            return self._stats()
+
+    def _stats(self) -> Stats:
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _maybe_log(self):
+        if self.log_every > 0 and (self.hits + self.misses) % self.log_every == 0:
+            logger.info(f'text embedding cache: {self._stats()}')
+
+    @staticmethod
+    def _size_of(embedding: torch.Tensor) -> int:
+        return embedding.element_size() * embedding.nelement()
@@ -0,0 +1,82 @@
+import io
+import logging
+from typing import *
+
+import PIL
+import PIL.Image
+
+
+logger = logging.getLogger(__name__)
+
+
+class UploadFormat:
+    """
+    codec of uploaded attachments, written as 'name' or 'name:value'.
+
+    - 'png:6': lossless, zlib level 0 (fastest, largest) to 9
+    - 'jpeg:90': quality 1 to 95
+    - 'webp:85': quality 1 to 100
+
+    mastodon re-encodes uploads anyway, so a lossy codec mostly saves uplink time.
+    saved images stay lossless png regardless.
+    """
+
+    # name -> (mime type, default value, min value, max value)
+    formats: Dict[str, Tuple[str, int, int, int]] = {
+        "png": ('image/png', 6, 0, 9),
+        "jpeg": ('image/jpeg', 90, 1, 95),
+        "webp": ('image/webp', 85, 1, 100),
+    }
+
+    aliases = {"jpg": "jpeg"}
+
+    # zlib level of pillow without compress_level, which saved images use
+    archive_png_level = 6
+
+    def __init__(self, name: str, value: Optional[int] = None):
+        name = UploadFormat.aliases.get(name, name)
+        if name not in UploadFormat.formats:
+            raise ValueError(f'unknown upload format {name}, one of {list(UploadFormat.formats.keys())}')
+
+        mime_type, default_value, min_value, max_value = UploadFormat.formats[name]
+        if value is None:
+            value = default_value
+        if not min_value <= value <= max_value:
+            raise ValueError(f'{name} takes {min_value} to {max_value}, got {value}')
+
+        self.name = name
+        self.value = value
+        self.mime_type = mime_type
+
+    @staticmethod
+    def parse(spec: str) -> 'UploadFormat':
+        """
+        :param spec: e.g. 'webp', 'jpeg:80', 'png:1'
+        :raises ValueError: on unknown names or values out of range
+        """
+        name, _, value = spec.strip().lower().partition(':')
+        return UploadFormat(name, int(value) if value != '' else None)
+
+    def __str__(self):
+        return f'{self.name}:{self.value}'
+
+    @property
+    def same_as_archive(self) -> bool:
+        """
+        True if encoded bytes of saved images can be uploaded as they are.
+        """
+        return self.name == 'png' and self.value == UploadFormat.archive_png_level
+
+    def encode(self, image: PIL.Image.Image) -> bytes:
+        image_bytes = io.BytesIO()
+
+        if self.name == 'png':
+            image.save(image_bytes, format='PNG', compress_level=self.value)
+        elif self.name == 'jpeg':
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            image.save(image_bytes, format='JPEG', quality=self.value)
+        elif self.name == 'webp':
+            image.save(image_bytes, format='WEBP', quality=self.value, method=4)
+
+        return image_bytes.getvalue()
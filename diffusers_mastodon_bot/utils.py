@@ -1,3 +1,9 @@
+import contextlib
+import struct
+import zlib
+from typing import *
+
+import torch
 from PIL import Image
 from bs4 import BeautifulSoup
 
@@ -19,3 +25,47 @@ def image_grid(imgs, rows, cols):
         grid.paste(img, box=(i % cols * w, i // cols * h))
     return grid
 
+
+def png_text_chunk(key: str, text: str, compress: bool = False) -> bytes:
+    """
+    tEXt (or zTXt if compress) chunk, iTXt if the text is not latin-1. same as PngInfo.add_text,
+    but built once and spliced into any number of encoded pngs with png_with_chunks.
+    """
+    key_bytes = key.encode('latin-1')
+    try:
+        text_bytes = text.encode('latin-1')
+        if compress:
+            return _png_chunk(b'zTXt', key_bytes + b'\0\0' + zlib.compress(text_bytes))
+        return _png_chunk(b'tEXt', key_bytes + b'\0' + text_bytes)
+    except UnicodeError:
+        text_bytes = text.encode('utf-8')
+        if compress:
+            return _png_chunk(b'iTXt', key_bytes + b'\0\1\0\0\0' + zlib.compress(text_bytes))
+        return _png_chunk(b'iTXt', key_bytes + b'\0\0\0\0\0' + text_bytes)
+
+
+def _png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+
+_png_iend = _png_chunk(b'IEND', b'')
+
+
+def png_with_chunks(png_bytes: bytes, chunks: List[bytes]) -> bytes:
+    """
+    inserts chunks before IEND of an encoded png, without touching the image data.
+    """
+    if len(chunks) == 0:
+        return png_bytes
+    if not png_bytes.endswith(_png_iend):
+        raise ValueError('not a png ending with IEND')
+    return b''.join([png_bytes[:-len(_png_iend)]] + chunks + [_png_iend])
+
+
+def autocast_for(device_name: str):
+    """
+    fp16 autocast on cuda devices (including 'cuda:1' and so on), nothing on cpu, which runs in float32
+    """
+    if device_name.startswith('cuda'):
+        return torch.autocast(device_type='cuda')
+    return contextlib.nullcontext()
@@ -0,0 +1,64 @@
+import json
+import string
+
+import pytest
+
+
+@pytest.fixture(scope='session')
+def tiny_tokenizer_files(tmp_path_factory):
+    """
+    vocab of single characters, so a clip tokenizer can be built without downloading one.
+    """
+    path = tmp_path_factory.mktemp('tiny_tokenizer')
+    vocab = {"<|startoftext|>": 0, "<|endoftext|>": 1}
+    for c in string.ascii_lowercase + string.digits + ',.':
+        vocab[c] = len(vocab)
+        vocab[c + '</w>'] = len(vocab)
+
+    (path / 'vocab.json').write_text(json.dumps(vocab))
+    (path / 'merges.txt').write_text('#version: 0.2\n')
+    return path / 'vocab.json', path / 'merges.txt', len(vocab)
+
+
+@pytest.fixture
+def tiny_pipe(tiny_tokenizer_files):
+    """
+    lpw pipeline of randomly initialized tiny models on cpu, for checking what the pipeline does with them.
+    :return: pipeline with an euler ancestral scheduler and no safety checker
+    """
+    torch = pytest.importorskip('torch')
+    pytest.importorskip('diffusers')
+    from diffusers import AutoencoderKL, UNet2DConditionModel, EulerAncestralDiscreteScheduler
+    from transformers import CLIPTokenizer, CLIPTextConfig, CLIPTextModel
+    from diffusers_mastodon_bot.community_pipeline.lpw_stable_diffusion \
+        import StableDiffusionLongPromptWeightingPipeline as StableDiffusionLpw
+
+    vocab_file, merges_file, vocab_size = tiny_tokenizer_files
+    tokenizer = CLIPTokenizer(str(vocab_file), str(merges_file), model_max_length=77)
+
+    torch.manual_seed(0)
+    text_encoder = CLIPTextModel(CLIPTextConfig(
+        bos_token_id=0, eos_token_id=1, pad_token_id=1, vocab_size=vocab_size, max_position_embeddings=77,
+        hidden_size=32, intermediate_size=37, num_attention_heads=4, num_hidden_layers=2,
+    ))
+    # zero bias makes the embedding mean 0, which the prompt weighting divides by
+    text_encoder.text_model.final_layer_norm.bias.data.normal_()
+
+    unet = UNet2DConditionModel(
+        sample_size=8, in_channels=4, out_channels=4, layers_per_block=1, block_out_channels=(32, 64),
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        cross_attention_dim=32, attention_head_dim=8,
+    )
+    vae = AutoencoderKL(
+        in_channels=3, out_channels=3, latent_channels=4, block_out_channels=[32, 64],
+        down_block_types=["DownEncoderBlock2D"] * 2, up_block_types=["UpDecoderBlock2D"] * 2,
+    )
+    scheduler = EulerAncestralDiscreteScheduler(beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear")
+
+    pipe = StableDiffusionLpw(
+        vae=vae, text_encoder=text_encoder, tokenizer=tokenizer, unet=unet, scheduler=scheduler,
+        safety_checker=None, feature_extractor=None, requires_safety_checker=False,
+    )
+    pipe.set_progress_bar_config(disable=True)
+    return pipe
@@ -0,0 +1,104 @@
+"""
+implementations of the lpw pipeline before they were optimized, as given by the community pipeline.
+tests check the current ones against these, and benchmarks/ compares their speed.
+"""
+import random
+
+from diffusers_mastodon_bot.community_pipeline.lpw_stable_diffusion import re_attention
+
+
+def parse_prompt_attention(text):
+    res = []
+    round_brackets = []
+    square_brackets = []
+
+    round_bracket_multiplier = 1.1
+    square_bracket_multiplier = 1 / 1.1
+
+    def multiply_range(start_position, multiplier):
+        for p in range(start_position, len(res)):
+            res[p][1] *= multiplier
+
+    for m in re_attention.finditer(text):
+        text = m.group(0)
+        weight = m.group(1)
+
+        if text.startswith("\\"):
+            res.append([text[1:], 1.0])
+        elif text == "(":
+            round_brackets.append(len(res))
+        elif text == "[":
+            square_brackets.append(len(res))
+        elif weight is not None and len(round_brackets) > 0:
+            multiply_range(round_brackets.pop(), float(weight))
+        elif text == ")" and len(round_brackets) > 0:
+            multiply_range(round_brackets.pop(), round_bracket_multiplier)
+        elif text == "]" and len(square_brackets) > 0:
+            multiply_range(square_brackets.pop(), square_bracket_multiplier)
+        else:
+            res.append([text, 1.0])
+
+    for pos in round_brackets:
+        multiply_range(pos, round_bracket_multiplier)
+
+    for pos in square_brackets:
+        multiply_range(pos, square_bracket_multiplier)
+
+    if len(res) == 0:
+        res = [["", 1.0]]
+
+    # merge runs of identical weights
+    i = 0
+    while i + 1 < len(res):
+        if res[i][1] == res[i + 1][1]:
+            res[i][0] += res[i + 1][0]
+            res.pop(i + 1)
+        else:
+            i += 1
+
+    return res
+
+
+def pad_tokens_and_weights(tokens, weights, max_length, bos, eos, no_boseos_middle=True, chunk_length=77):
+    max_embeddings_multiples = (max_length - 2) // (chunk_length - 2)
+    weights_length = max_length if no_boseos_middle else max_embeddings_multiples * chunk_length
+    for i in range(len(tokens)):
+        tokens[i] = [bos] + tokens[i] + [eos] * (max_length - 1 - len(tokens[i]))
+        if no_boseos_middle:
+            weights[i] = [1.0] + weights[i] + [1.0] * (max_length - 1 - len(weights[i]))
+        else:
+            w = []
+            if len(weights[i]) == 0:
+                w = [1.0] * weights_length
+            else:
+                for j in range(max_embeddings_multiples):
+                    w.append(1.0)  # weight for starting token in this chunk
+                    w += weights[i][j * (chunk_length - 2) : min(len(weights[i]), (j + 1) * (chunk_length - 2))]
+                    w.append(1.0)  # weight for ending token in this chunk
+                w += [1.0] * (weights_length - len(w))
+            weights[i] = w[:]
+
+    return tokens, weights
+
+
+prompt_pieces = [
+    'a', 'b', 'cat', ' ', ', ', '1', '.', '(', ')', '[', ']', ':', '\\', '\\(', '\\)', '\\[', '\\]',
+    ':1.3)', ':0.5)', ':-1)', ':+2.)', ':.5)', '((', '))', '[[', ']]', 'masterpiece', 'high res',
+]
+
+
+def random_prompt(rng: random.Random, max_pieces: int = 24) -> str:
+    """
+    mostly bracket and escape pieces, so unbalanced and nested cases come up often.
+    """
+    return ''.join(rng.choice(prompt_pieces) for _ in range(rng.randrange(max_pieces + 1)))
+
+
+def random_tokens_and_weights(rng: random.Random, batch_size: int, max_token_count: int):
+    tokens = []
+    weights = []
+    for _ in range(batch_size):
+        count = rng.randrange(max_token_count + 1)
+        tokens.append([rng.randrange(2, 1000) for _ in range(count)])
+        weights.append([rng.choice([1.0, 1.1, 1 / 1.1, 1.3, 0.5]) for _ in range(count)])
+    return tokens, weights
@@ -0,0 +1,73 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from diffusers_mastodon_bot.archive_writer import ArchiveWriter
+
+
+def test_written_in_background(tmp_path):
+    writer = ArchiveWriter()
+    path = tmp_path / 'a.png'
+
+    assert writer.write(str(path), b'data')
+    writer.flush()
+
+    assert path.read_bytes() == b'data'
+    assert not (tmp_path / 'a.png.tmp').exists()
+    assert writer.stats()['written'] == 1
+    writer.close()
+
+
+def test_closed_writer_drops(tmp_path):
+    writer = ArchiveWriter()
+    writer.close()
+
+    assert not writer.write(str(tmp_path / 'a.png'), b'data')
+    assert not (tmp_path / 'a.png').exists()
+    assert writer.stats()['dropped'] == 1
+
+
+def test_full_queue_drops_without_waiting(tmp_path):
+    writer = ArchiveWriter(max_queue_size=1)
+    release = threading.Event()
+    write_now = writer._write_now
+    writer._write_now = lambda path, data: (release.wait(timeout=10), write_now(path, data))
+
+    assert writer.write(str(tmp_path / 'taken.png'), b'data')
+    # the writer thread is stuck on the first file
+    deadline = time.time() + 5
+    while writer.queue.qsize() > 0 and time.time() < deadline:
+        time.sleep(0.01)
+    assert writer.write(str(tmp_path / 'queued.png'), b'data')
+
+    start_time = time.time()
+    assert not writer.write(str(tmp_path / 'dropped.png'), b'data')
+    assert time.time() - start_time < 0.1
+    assert writer.stats()['dropped'] == 1
+
+    release.set()
+    writer.close()
+    assert sorted(file.name for file in tmp_path.iterdir()) == ['queued.png', 'taken.png']
+
+
+def test_saved_list_leaves_out_dropped_images(tmp_path):
+    pytest.importorskip('torch')
+    pytest.importorskip('diffusers')
+    Image = pytest.importorskip('PIL.Image')
+    from diffusers_mastodon_bot.bot_request_handlers.diffusion_runner import DiffusionRunner
+
+    writer = ArchiveWriter()
+    ctx = SimpleNamespace(
+        status={"url": 'https://example.com/1'},
+        bot_ctx=SimpleNamespace(output_save_path=str(tmp_path), archive_writer=writer),
+    )
+    images = [Image.new('RGB', (8, 8)) for _ in range(2)]
+
+    saved = DiffusionRunner.save_images(ctx, None, 'root', images, save_args=False)
+    writer.flush()
+    assert [filename.split('/')[-1] for filename in saved] == ['root_0.png', 'root_1.png']
+
+    writer.close()
+    assert DiffusionRunner.save_images(ctx, None, 'dropped', images, save_args=False) == []
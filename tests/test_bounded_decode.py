@@ -0,0 +1,47 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('diffusers')
+
+
+def test_sliced_decode_matches_full_decode(tiny_pipe):
+    torch.manual_seed(0)
+    latents = torch.randn(3, 4, 8, 8)
+    sample_bytes = tiny_pipe.estimate_vae_decode_bytes(8, 8, latents.element_size())
+
+    with torch.no_grad():
+        full = tiny_pipe.vae.decode(latents).sample
+        # two samples per slice, the last slice has one
+        sliced = tiny_pipe.decode_latents_bounded(latents, max_bytes=sample_bytes * 2)
+        one_by_one = tiny_pipe.decode_latents_bounded(latents, max_bytes=sample_bytes)
+
+    assert sliced.shape == full.shape
+    assert (sliced - full).abs().max() < 1e-4
+    assert (one_by_one - full).abs().max() < 1e-4
+
+
+def test_tiled_decode_shape_and_values(tiny_pipe):
+    torch.manual_seed(0)
+    latents = torch.randn(2, 4, 40, 48)
+    scale = tiny_pipe.vae_scale_factor
+    # too small for a whole sample, so it is decoded in 32x32 tiles
+    max_bytes = tiny_pipe.estimate_vae_decode_bytes(32, 32, latents.element_size())
+    assert tiny_pipe.estimate_vae_decode_bytes(40, 48, latents.element_size()) > max_bytes
+
+    with torch.no_grad():
+        tiled = tiny_pipe.decode_latents_bounded(latents, max_bytes=max_bytes)
+
+    assert tiled.shape == (2, 3, 40 * scale, 48 * scale)
+    assert torch.isfinite(tiled).all()
+
+
+def test_single_tile_is_plain_decode(tiny_pipe):
+    torch.manual_seed(0)
+    latents = torch.randn(1, 4, 16, 16)
+
+    with torch.no_grad():
+        full = tiny_pipe.vae.decode(latents).sample
+        tiled = tiny_pipe.decode_latents_tiled(latents, tile_size=16, overlap=4)
+
+    assert tiled.shape == full.shape
+    assert (tiled - full).abs().max() < 1e-4
@@ -0,0 +1,78 @@
+import threading
+
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('diffusers')
+
+from diffusers_mastodon_bot.bot_request_handlers.diffusion_runner import DiffusionRunner
+
+
+def generate(pipe, seed, num_inference_steps, callback=None):
+    return pipe.text2img(
+        prompt=['ab'],
+        width=32,
+        height=32,
+        num_inference_steps=num_inference_steps,
+        generator=DiffusionRunner.generators_of([seed]),
+        output_type='np',
+        callback=callback,
+        callback_steps=1,
+    ).images
+
+
+def test_concurrent_calls_match_sequential(tiny_pipe):
+    # different step counts, so the calls would clobber each other's timesteps and sigmas on a shared scheduler
+    jobs = [(1, 3), (2, 5)]
+    sequential = [generate(tiny_pipe, seed, steps) for seed, steps in jobs]
+
+    # both calls are past set_timesteps and in the denoising loop before either goes on
+    barrier = threading.Barrier(len(jobs), timeout=60)
+
+    def callback(i, t, latents):
+        if i == 0:
+            barrier.wait()
+
+    results = [None] * len(jobs)
+    errors = []
+
+    def run(index, seed, steps):
+        try:
+            results[index] = generate(tiny_pipe, seed, steps, callback=callback)
+        except Exception as ex:
+            errors.append(ex)
+            barrier.abort()
+
+    threads = [threading.Thread(target=run, args=(index, seed, steps)) for index, (seed, steps) in enumerate(jobs)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    for concurrent_result, sequential_result in zip(results, sequential):
+        assert abs(concurrent_result[0] - sequential_result[0]).max() < 1e-5
+
+
+def test_scheduler_copies_are_private(tiny_pipe):
+    first = tiny_pipe.scheduler_for(3, torch.device('cpu'))
+    second = tiny_pipe.scheduler_for(3, torch.device('cpu'))
+
+    assert first is not second
+    assert first is not tiny_pipe.scheduler
+    assert torch.equal(first.timesteps, second.timesteps)
+
+    first.sigmas[0] = -1.0
+    assert second.sigmas[0] != -1.0
+    assert tiny_pipe.scheduler_for(3, torch.device('cpu')).sigmas[0] != -1.0
+
+
+def test_replaced_scheduler_drops_templates(tiny_pipe):
+    import diffusers
+
+    before = tiny_pipe.scheduler_for(3, torch.device('cpu'))
+    tiny_pipe.scheduler = diffusers.DDPMScheduler.from_config(tiny_pipe.scheduler.config)
+    after = tiny_pipe.scheduler_for(3, torch.device('cpu'))
+
+    assert type(before) is not type(after)
+    assert isinstance(after, diffusers.DDPMScheduler)
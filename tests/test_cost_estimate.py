@@ -0,0 +1,57 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('diffusers')
+
+from diffusers_mastodon_bot.app_stream_listener import AppStreamListener
+from diffusers_mastodon_bot.bot_request_handlers.diffuse_it_handler import DiffuseItHandler
+from diffusers_mastodon_bot.bot_request_handlers.diffuse_me_handler import DiffuseMeHandler
+from diffusers_mastodon_bot.bot_request_handlers.proc_args_context import ProcArgsContext
+from diffusers_mastodon_bot.diffusion_cost_model import DiffusionCostModel
+
+
+def args_ctx_of(**proc_kwargs):
+    return ProcArgsContext(
+        prompts={"positive": 'a cat', "negative": None, "negative_with_default": None},
+        proc_kwargs=proc_kwargs,
+        target_image_count=2,
+        pipe_kwargs={},
+    )
+
+
+@pytest.mark.parametrize('proc_kwargs, expected', [
+    ({}, 40),
+    ({"strength": 0.5}, 25),
+    ({"num_inference_steps": 30}, 29),
+    ({"num_inference_steps": 30, "strength": 0.5}, 30),
+    ({"num_inference_steps": 20, "strength": 0.3}, 19),
+])
+def test_img2img_steps_are_what_the_pipeline_runs(proc_kwargs, expected):
+    handler = DiffuseItHandler(pipe=None)
+    args_ctx = args_ctx_of(**proc_kwargs)
+
+    assert handler.estimated_steps(None, args_ctx) == expected
+
+    # the same steps respond_to gives the pipeline, times strength as the cost model observes
+    pipeline_steps = DiffuseItHandler.pipeline_steps_of(args_ctx)
+    assert expected == DiffusionCostModel.steps_run(
+        pipeline_steps if pipeline_steps is not None else DiffusionCostModel.default_steps,
+        DiffuseItHandler.strength_of(args_ctx)
+    )
+
+
+def test_img2img_is_priced_by_steps_run():
+    cost_model = DiffusionCostModel(initial_sec_per_work=0.1)
+    listener = SimpleNamespace(
+        bot_ctx=SimpleNamespace(cost_model=cost_model),
+        diffusers_pipeline=SimpleNamespace(scheduler=object()),
+    )
+    args_ctx = args_ctx_of(width=512, height=512, strength=0.5)
+
+    img2img_sec = AppStreamListener.estimate_gpu_sec(listener, DiffuseItHandler(pipe=None), None, args_ctx)
+    text2img_sec = AppStreamListener.estimate_gpu_sec(listener, DiffuseMeHandler(pipe=None), None, args_ctx)
+
+    assert img2img_sec == pytest.approx(0.1 * 25 * 2)
+    assert text2img_sec == pytest.approx(0.1 * 50 * 2)
@@ -0,0 +1,77 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('diffusers')
+
+from diffusers_mastodon_bot.bot_request_handlers.diffusion_batcher import DiffusionBatcher
+from diffusers_mastodon_bot.fair_share_scheduler import FairShareScheduler
+
+
+class SleepingPipe:
+    def __init__(self, tokenizer, sleep_sec: float):
+        self.tokenizer = tokenizer
+        self.sleep_sec = sleep_sec
+        self.calls = []
+
+    def text2img(self, prompt, negative_prompt=None, generator=None, callback=None, is_cancelled_callback=None,
+                 **kwargs):
+        self.calls.append(len(prompt))
+        time.sleep(self.sleep_sec)
+        return SimpleNamespace(images=[None] * len(prompt), nsfw_content_detected=[False] * len(prompt))
+
+
+def samples(count):
+    return [{"positive": 'a', "negative": None, "seed": seed} for seed in range(count)]
+
+
+def test_shared_batch_is_charged_by_rows(tiny_tokenizer_files):
+    from transformers import CLIPTokenizer
+
+    vocab_file, merges_file, _ = tiny_tokenizer_files
+    pipe = SleepingPipe(CLIPTokenizer(str(vocab_file), str(merges_file), model_max_length=77), 0.2)
+    batcher = DiffusionBatcher(pipe, threading.RLock(), 'cpu', max_batch_size=4, window_sec=5.0,
+                               scheduler_name='EulerAncestralDiscreteScheduler')
+
+    charged = {'big': [], 'small': []}
+    proc_kwargs = {'width': 32, 'height': 32}
+    futures = [
+        batcher.submit(proc_kwargs, samples(3), on_gpu_seconds=charged['big'].append),
+        batcher.submit(proc_kwargs, samples(1), on_gpu_seconds=charged['small'].append),
+    ]
+    for future in futures:
+        future.result(timeout=30)
+
+    assert pipe.calls == [4]
+    assert len(charged['big']) == 1 and len(charged['small']) == 1
+    assert charged['big'][0] == pytest.approx(charged['small'][0] * 3)
+    # only the pipeline call, not the batching window
+    assert 0.2 <= charged['big'][0] + charged['small'][0] < 1.0
+
+
+def test_refund_gives_back_admitted_tokens():
+    scheduler = FairShareScheduler(rate_limit_burst=4, rate_limit_per_hour=0.001)
+
+    assert scheduler.try_admit('a', 4)[0]
+    assert not scheduler.try_admit('a', 1)[0]
+
+    scheduler.refund('a', 4)
+
+    assert scheduler.try_admit('a', 4)[0]
+
+
+def test_refund_does_not_overfill():
+    scheduler = FairShareScheduler(rate_limit_burst=4, rate_limit_per_hour=0.001)
+
+    assert scheduler.try_admit('a', 1)[0]
+    scheduler.refund('a', 1)
+    scheduler.refund('a', 100)
+    scheduler.refund('b', 100)
+
+    assert scheduler.try_admit('a', 4)[0]
+    assert not scheduler.try_admit('a', 1)[0]
+    assert scheduler.try_admit('b', 4)[0]
+    assert not scheduler.try_admit('b', 1)[0]
@@ -0,0 +1,33 @@
+from diffusers_mastodon_bot.bot_request_handlers.proc_args_context import ProcArgsContext
+from diffusers_mastodon_bot.job_journal import JobJournal
+
+
+class FakeHandler:
+    tag_name = 'diffuse_me'
+
+
+def args_ctx():
+    return ProcArgsContext(
+        prompts={"positive": 'a cat', "negative": None, "negative_with_default": None},
+        proc_kwargs={"seed": 1},
+        target_image_count=4,
+        pipe_kwargs={},
+    )
+
+
+def test_attempts_are_counted_and_kept(tmp_path):
+    path = str(tmp_path / 'journal.sqlite3')
+    journal = JobJournal(path)
+    job_id = journal.add(1234, FakeHandler(), args_ctx())
+    journal.set_state(job_id, JobJournal.STATE_RUNNING)
+
+    assert journal.unfinished()[0]['attempts'] == 0
+    assert journal.add_attempt(job_id) == 1
+    assert journal.add_attempt(job_id) == 2
+
+    # survives reopening, as after a restart
+    entry = JobJournal(path).unfinished()[0]
+    assert entry['attempts'] == 2
+    assert entry['state'] == JobJournal.STATE_RUNNING
+    assert entry['args_ctx'] == args_ctx()
+
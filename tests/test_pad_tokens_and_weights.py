@@ -0,0 +1,58 @@
+import copy
+import random
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('torch')
+pytest.importorskip('diffusers')
+
+import lpw_reference
+from diffusers_mastodon_bot.community_pipeline import lpw_stable_diffusion as lpw
+
+
+def both(tokens, weights, max_length, no_boseos_middle, chunk_length):
+    # the reference pads the given lists in place
+    expected_tokens, expected_weights = lpw_reference.pad_tokens_and_weights(
+        copy.deepcopy(tokens), copy.deepcopy(weights), max_length, 0, 1,
+        no_boseos_middle=no_boseos_middle, chunk_length=chunk_length
+    )
+    padded_tokens, padded_weights = lpw.pad_tokens_and_weights(
+        tokens, weights, max_length, 0, 1, no_boseos_middle=no_boseos_middle, chunk_length=chunk_length
+    )
+    return (np.array(expected_tokens), np.array(expected_weights)), (padded_tokens, padded_weights)
+
+
+@pytest.mark.parametrize('no_boseos_middle', [True, False])
+@pytest.mark.parametrize('chunk_length', [77, 7])
+@pytest.mark.parametrize('multiples', [1, 2, 3])
+def test_matches_reference(no_boseos_middle, chunk_length, multiples):
+    rng = random.Random(multiples * 100 + chunk_length)
+    max_length = (chunk_length - 2) * multiples + 2
+
+    for batch_size in [1, 2, 5, 16]:
+        for _ in range(50):
+            tokens, weights = lpw_reference.random_tokens_and_weights(rng, batch_size, max_length - 2)
+            (expected_tokens, expected_weights), (padded_tokens, padded_weights) = \
+                both(tokens, weights, max_length, no_boseos_middle, chunk_length)
+
+            assert padded_tokens.dtype == np.int64
+            assert padded_weights.dtype == np.float64
+            assert np.array_equal(padded_tokens, expected_tokens)
+            assert np.array_equal(padded_weights, expected_weights)
+
+
+@pytest.mark.parametrize('no_boseos_middle', [True, False])
+def test_chunk_boundaries(no_boseos_middle):
+    chunk_length = 7
+    max_length = (chunk_length - 2) * 3 + 2
+
+    # empty, exactly one chunk, one over a chunk and full
+    tokens = [[], list(range(2, 7)), list(range(2, 8)), list(range(2, 17))]
+    weights = [[], [1.1] * 5, [0.5] * 6, [1.3] * 15]
+
+    (expected_tokens, expected_weights), (padded_tokens, padded_weights) = \
+        both(tokens, weights, max_length, no_boseos_middle, chunk_length)
+
+    assert np.array_equal(padded_tokens, expected_tokens)
+    assert np.array_equal(padded_weights, expected_weights)
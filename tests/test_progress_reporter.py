@@ -0,0 +1,100 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from diffusers_mastodon_bot.bot_request_handlers import progress_reporter as progress_reporter_module
+from diffusers_mastodon_bot.bot_request_handlers.progress_reporter import ProgressReporter
+
+
+class FakeMastodon:
+    """
+    client without status_update, like Mastodonplus.py
+    """
+    def __init__(self):
+        self.requests = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def _Mastodon__api_request(self, method, endpoint, params={}, use_json=False):
+        self.release.wait(timeout=10)
+        self.requests.append((method, endpoint, params, use_json))
+        return {}
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(progress_reporter_module, 'time', clock)
+    return clock
+
+
+def reporter_of(mastodon, total_batches=2, steps_per_batch=10):
+    ctx = SimpleNamespace(status={"id": '1'}, mastodon=mastodon, mention_text_of=lambda status: '@someone')
+    return ProgressReporter(ctx, {"id": '99'}, total_batches=total_batches, steps_per_batch=steps_per_batch,
+                            interval_sec=15)
+
+
+def step(reporter, clock, at, index):
+    clock.now = 1000.0 + at
+    reporter.callback(index, 0, torch.zeros(1, 4, 8, 8))
+    if reporter.in_flight is not None:
+        reporter.in_flight.result(timeout=10)
+
+
+def test_edits_are_throttled_and_eta_counts_batches(clock):
+    mastodon = FakeMastodon()
+    reporter = reporter_of(mastodon)
+
+    step(reporter, clock, 0, 0)
+    step(reporter, clock, 10, 5)
+    assert mastodon.requests == []
+
+    # 10 of 20 steps in 20s
+    step(reporter, clock, 20, 9)
+    # the second pipeline call starts over from step 0, too soon after the last edit
+    step(reporter, clock, 25, 0)
+    # 15 of 20 steps in 40s
+    step(reporter, clock, 40, 4)
+
+    assert [(method, endpoint, use_json) for method, endpoint, _, use_json in mastodon.requests] == \
+        [('PUT', '/api/v1/statuses/99', True)] * 2
+    assert mastodon.requests[0][2] == {"status": '@someone 처리중... 10/20 steps, 약 20초 남음'}
+    assert mastodon.requests[1][2] == {"status": '@someone 처리중... 15/20 steps, 약 14초 남음'}
+
+
+def test_update_is_skipped_while_previous_is_in_flight(clock):
+    mastodon = FakeMastodon()
+    reporter = reporter_of(mastodon, total_batches=1, steps_per_batch=100)
+
+    mastodon.release.clear()
+    clock.now = 1020.0
+    reporter.callback(0, 0, torch.zeros(1, 4, 8, 8))
+    in_flight = reporter.in_flight
+
+    clock.now = 1040.0
+    reporter.callback(1, 0, torch.zeros(1, 4, 8, 8))
+    assert reporter.in_flight is in_flight
+
+    mastodon.release.set()
+    in_flight.result(timeout=10)
+    assert len(mastodon.requests) == 1
+
+
+def test_status_update_of_client_is_used_when_present():
+    calls = []
+    mastodon = SimpleNamespace(status_update=lambda status_id, **kwargs: calls.append((status_id, kwargs)))
+
+    ProgressReporter.status_update(mastodon, '99', status='hi', media_ids=[3], sensitive=True)
+
+    assert calls == [('99', {"status": 'hi', "media_ids": [3], "sensitive": True})]
@@ -0,0 +1,64 @@
+import random
+
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('diffusers')
+
+import lpw_reference
+from diffusers_mastodon_bot.community_pipeline import lpw_stable_diffusion as lpw
+
+
+def outcome_of(fn, text):
+    # a few random prompts are invalid (e.g. ':.)'), both should fail the same way then
+    try:
+        return fn(text)
+    except Exception as ex:
+        return type(ex)
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_matches_reference_on_random_prompts(seed):
+    rng = random.Random(seed)
+    lpw._parse_prompt_attention_cached.cache_clear()
+
+    prompts = [lpw_reference.random_prompt(rng) for _ in range(5000)]
+    # repeats go through the cache
+    prompts += rng.sample(prompts, 1000)
+
+    for prompt in prompts:
+        assert outcome_of(lpw.parse_prompt_attention, prompt) == outcome_of(lpw_reference.parse_prompt_attention, prompt), \
+            repr(prompt)
+
+
+@pytest.mark.parametrize('prompt', [
+    '',
+    'plain text without anything special',
+    'a (((house:1.3)) [on] a (hill:0.5), sun, (((sky))).',
+    '\\(literal\\]',
+    '(unbalanced',
+    'unbalanced]',
+    'colon: only',
+    '\\',
+])
+def test_matches_reference_on_known_prompts(prompt):
+    assert lpw.parse_prompt_attention(prompt) == lpw_reference.parse_prompt_attention(prompt)
+
+
+@pytest.mark.parametrize('prompt', ['plain text', 'an (important) word'])
+def test_result_can_be_modified_without_touching_the_cache(prompt):
+    expected = lpw_reference.parse_prompt_attention(prompt)
+
+    first = lpw.parse_prompt_attention(prompt)
+    first[0][0] = 'changed'
+    first[0][1] = 100.0
+    first.append(['extra', 1.0])
+
+    assert lpw.parse_prompt_attention(prompt) == expected
+
+
+def test_cached_parse_is_immutable():
+    cached = lpw._parse_prompt_attention_cached('an (important) word')
+
+    assert isinstance(cached, tuple)
+    assert all(isinstance(pair, tuple) for pair in cached)
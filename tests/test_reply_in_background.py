@@ -0,0 +1,30 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('diffusers')
+
+from diffusers_mastodon_bot.app_stream_listener import AppStreamListener
+
+
+def test_reply_does_not_wait_for_the_api():
+    release = threading.Event()
+    replies = []
+
+    def reply_to(status, body):
+        release.wait(timeout=10)
+        replies.append((status['id'], body))
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    listener = SimpleNamespace(bot_ctx=SimpleNamespace(upload_executor=executor))
+    req_ctx = SimpleNamespace(reply_to=reply_to)
+
+    AppStreamListener.reply_in_background(listener, req_ctx, {"id": '1', "url": 'https://example.com/1'}, 'busy')
+    assert replies == []
+
+    release.set()
+    executor.shutdown(wait=True)
+    assert replies == [('1', 'busy')]
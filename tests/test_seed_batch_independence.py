@@ -0,0 +1,77 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+diffusers = pytest.importorskip('diffusers')
+
+from diffusers_mastodon_bot.bot_request_handlers.diffusion_runner import DiffusionRunner
+
+
+def generate(pipe, prompts, seeds, **kwargs):
+    return pipe.text2img(
+        prompt=prompts,
+        width=32,
+        height=32,
+        num_inference_steps=3,
+        generator=DiffusionRunner.generators_of(seeds),
+        output_type='np',
+        **kwargs
+    ).images
+
+
+@pytest.mark.parametrize('scheduler_class', [
+    diffusers.EulerAncestralDiscreteScheduler,
+    diffusers.EulerDiscreteScheduler,
+    diffusers.DDPMScheduler,
+])
+def test_image_depends_only_on_its_seed(tiny_pipe, scheduler_class):
+    tiny_pipe.scheduler = scheduler_class.from_config(tiny_pipe.scheduler.config)
+
+    alone = generate(tiny_pipe, ['ab'], [1234])
+    batched = generate(tiny_pipe, ['cd', 'ab', 'ef 12'], [7, 1234, 2 ** 32 - 1])
+
+    # the same up to float error of a larger batch in the unet
+    assert abs(alone[0] - batched[1]).max() < 1e-4
+
+
+def test_other_seed_gives_other_image(tiny_pipe):
+    first = generate(tiny_pipe, ['ab'], [1])
+    second = generate(tiny_pipe, ['ab'], [2])
+
+    assert abs(first[0] - second[0]).max() > 1e-3
+
+
+def batched_images(tiny_pipe, submissions):
+    import threading
+    import numpy as np
+    from diffusers_mastodon_bot.bot_request_handlers.diffusion_batcher import DiffusionBatcher
+
+    batcher = DiffusionBatcher(tiny_pipe, threading.RLock(), 'cpu', max_batch_size=8, window_sec=1.0)
+    proc_kwargs = {"width": 32, "height": 32, "num_inference_steps": 3}
+    futures = [
+        batcher.submit(proc_kwargs, [{"positive": positive, "negative": negative, "seed": seed}])
+        for positive, negative, seed in submissions
+    ]
+    return [np.asarray(future.result(timeout=120)["images"][0], dtype=np.int16) for future in futures]
+
+
+def test_short_prompt_is_not_padded_by_long_one_in_batcher(tiny_pipe):
+    from diffusers_mastodon_bot.community_pipeline.lpw_stable_diffusion import embeddings_multiples_of
+
+    long_prompt = ' '.join(['ab'] * 60)
+    assert embeddings_multiples_of(tiny_pipe, 'ab', '') == 1
+    assert embeddings_multiples_of(tiny_pipe, long_prompt, '') == 2
+    assert embeddings_multiples_of(tiny_pipe, 'ab', long_prompt) == 2
+
+    # a short prompt next to a long one in the pipeline gets padded like the long one
+    in_pipe = generate(tiny_pipe, ['ab', long_prompt], [1234, 5])[0]
+    assert abs(generate(tiny_pipe, ['ab'], [1234])[0] - in_pipe).max() > 1e-3
+
+    alone, = batched_images(tiny_pipe, [('ab', None, 1234)])
+    with_long, _, with_long_negative, _ = batched_images(tiny_pipe, [
+        ('ab', None, 1234), (long_prompt, None, 5), ('ab', 'cd', 1234), ('cd', long_prompt, 6),
+    ])
+    alone_negative, = batched_images(tiny_pipe, [('ab', 'cd', 1234)])
+
+    # the same up to a rounding step of 8 bit pixels
+    assert abs(alone - with_long).max() <= 1
+    assert abs(alone_negative - with_long_negative).max() <= 1
@@ -0,0 +1,54 @@
+import io
+
+import pytest
+
+from diffusers_mastodon_bot.upload_format import UploadFormat
+
+
+@pytest.mark.parametrize('level', range(0, 10))
+def test_png_level_round_trip(level):
+    upload_format = UploadFormat.parse(f'png:{level}')
+
+    assert upload_format.name == 'png'
+    assert upload_format.value == level
+    assert upload_format.mime_type == 'image/png'
+    assert UploadFormat.parse(str(upload_format)).value == level
+    assert str(UploadFormat.parse(str(upload_format))) == f'png:{level}'
+
+
+@pytest.mark.parametrize('spec, expected', [
+    ('png', 'png:6'),
+    ('PNG', 'png:6'),
+    (' webp ', 'webp:85'),
+    ('webp:100', 'webp:100'),
+    ('jpg', 'jpeg:90'),
+    ('jpeg:1', 'jpeg:1'),
+])
+def test_parse_defaults_and_aliases(spec, expected):
+    assert str(UploadFormat.parse(spec)) == expected
+
+
+@pytest.mark.parametrize('spec', ['png:10', 'png:-1', 'jpeg:0', 'jpeg:96', 'webp:101', 'gif', 'png:high', ''])
+def test_parse_rejects(spec):
+    with pytest.raises(ValueError):
+        UploadFormat.parse(spec)
+
+
+def test_only_archive_png_is_same_as_archive():
+    assert UploadFormat.parse('png').same_as_archive
+    assert not UploadFormat.parse('png:1').same_as_archive
+    assert not UploadFormat.parse('webp').same_as_archive
+
+
+@pytest.mark.parametrize('spec, pil_format', [('png:1', 'PNG'), ('jpeg:80', 'JPEG'), ('webp:80', 'WEBP')])
+def test_encode_decodes_as_the_format(spec, pil_format):
+    Image = pytest.importorskip('PIL.Image')
+    features = pytest.importorskip('PIL.features')
+    if pil_format == 'WEBP' and not features.check('webp'):
+        pytest.skip('pillow without webp')
+
+    image = Image.new('RGB', (64, 48), color=(10, 200, 30))
+    decoded = Image.open(io.BytesIO(UploadFormat.parse(spec).encode(image)))
+
+    assert decoded.format == pil_format
+    assert decoded.size == (64, 48)